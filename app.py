@@ -1,13 +1,21 @@
 import os
 import logging
-from flask import Flask, request, render_template, redirect, url_for, flash, session, jsonify
+from flask import Flask, request, render_template, redirect, url_for, flash, session, jsonify, Response, stream_with_context
 import tempfile
 import uuid
+import zipfile
+from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.utils import secure_filename
 
-from ocr_processor import preprocess_image, perform_ocr
-from nlp_processor import extract_medical_terms
-from hcc_mapper import map_to_hcc_codes
+from processing import process_document
+from result_store import (
+    save_results, result_exists, load_metadata, load_summary, load_patient_profile,
+    read_terms_page, read_codes_page, read_text_page, PATIENT_ID_PATTERN, PAGE_SIZE
+)
+from batch_processor import submit_batch, get_batch_status, expand_zip, BATCH_MAX_FILES
+from exporter import stream_export, EXPORT_FORMATS
+from snapshot import warm_start
+from patient_aggregator import add_document
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)
@@ -21,7 +29,25 @@ app.secret_key = os.environ.get("SESSION_SECRET", "dev_secret_key")
 ALLOWED_EXTENSIONS = {'pdf', 'png', 'jpg', 'jpeg'}
 UPLOAD_FOLDER = tempfile.gettempdir()
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16 MB max file size
+app.config['UPLOAD_MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16 MB max file size
+app.config['BATCH_MAX_CONTENT_LENGTH'] = 512 * 1024 * 1024  # 512 MB max batch size
+# Werkzeug's hard limit, for bodies sent without a Content-Length; the
+# per-route limits are checked in limit_request_size
+app.config['MAX_CONTENT_LENGTH'] = app.config['BATCH_MAX_CONTENT_LENGTH']
+
+# Install the prebuilt extraction indexes, if a current snapshot exists
+warm_start()
+
+def _request_size_limit():
+    # Batches carry many scans, so they get a larger request body limit
+    if request.endpoint == 'upload_batch':
+        return app.config['BATCH_MAX_CONTENT_LENGTH']
+    return app.config['UPLOAD_MAX_CONTENT_LENGTH']
+
+@app.before_request
+def limit_request_size():
+    if request.content_length is not None and request.content_length > _request_size_limit():
+        raise RequestEntityTooLarge()
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
@@ -42,6 +68,11 @@ def upload_file():
         flash('No selected file', 'danger')
         return redirect(request.url)
     
+    patient_id = request.form.get('patient_id', '').strip() or None
+    if patient_id and not PATIENT_ID_PATTERN.match(patient_id):
+        flash('Patient id may only contain letters, digits, ".", "_" and "-"', 'danger')
+        return redirect(request.url)
+    
     if file and allowed_file(file.filename):
         # Generate a unique filename
         original_filename = secure_filename(file.filename)
@@ -55,24 +86,30 @@ def upload_file():
         
         try:
             # Process the document
-            preprocessed_image = preprocess_image(filepath, file_extension)
-            extracted_text = perform_ocr(preprocessed_image)
+            results = process_document(filepath, file_extension)
             
-            if not extracted_text:
+            if not results['extracted_text']:
                 flash('No text could be extracted from the document', 'warning')
                 return redirect(url_for('index'))
             
-            # Extract medical terms
-            medical_terms = extract_medical_terms(extracted_text)
+            # Store results on the server and keep only the id in the session
+            result_id = save_results(
+                original_filename,
+                results['extracted_text'],
+                results['medical_terms'],
+                results['hcc_codes'],
+                warnings=results['warnings'],
+                profile=results['profile'],
+                patient_id=patient_id,
+                ocr_words=results['ocr_words']
+            )
+            session['result_id'] = result_id
             
-            # Map to HCC codes
-            hcc_codes = map_to_hcc_codes(medical_terms)
-            
-            # Store results in session
-            session['extracted_text'] = extracted_text
-            session['medical_terms'] = medical_terms
-            session['hcc_codes'] = hcc_codes
-            session['original_filename'] = original_filename
+            if patient_id:
+                try:
+                    add_document(patient_id, result_id, results['medical_terms'], results['hcc_codes'])
+                except Exception as e:
+                    flash(f'Document processed, but the patient profile could not be updated: {str(e)}', 'warning')
             
             return redirect(url_for('show_results'))
             
@@ -91,53 +128,211 @@ def upload_file():
         flash(f'Allowed file types are: {", ".join(ALLOWED_EXTENSIONS)}', 'warning')
         return redirect(request.url)
 
+@app.route('/batch/upload', methods=['POST'])
+def upload_batch():
+    files = [f for f in request.files.getlist('documents') if f.filename]
+    if not files:
+        return jsonify({'error': 'No files in request'}), 400
+    
+    patient_id = request.form.get('patient_id', '').strip() or None
+    if patient_id and not PATIENT_ID_PATTERN.match(patient_id):
+        return jsonify({'error': 'Invalid patient id'}), 400
+    
+    documents = []
+    skipped = []
+    try:
+        for file in files:
+            original_filename = secure_filename(file.filename)
+            file_extension = original_filename.rsplit('.', 1)[1].lower() if '.' in original_filename else ''
+            
+            if file_extension == 'zip':
+                zip_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{uuid.uuid4().hex}.zip")
+                file.save(zip_path)
+                try:
+                    zip_documents, zip_skipped = expand_zip(zip_path, ALLOWED_EXTENSIONS, app.config['UPLOAD_FOLDER'])
+                    documents.extend(zip_documents)
+                    skipped.extend(f"{original_filename}/{name}" for name in zip_skipped)
+                except zipfile.BadZipFile:
+                    skipped.append(original_filename)
+                finally:
+                    os.remove(zip_path)
+            elif allowed_file(original_filename):
+                filepath = os.path.join(app.config['UPLOAD_FOLDER'], f"{uuid.uuid4().hex}.{file_extension}")
+                file.save(filepath)
+                documents.append((original_filename, filepath, file_extension))
+            else:
+                skipped.append(original_filename)
+    except Exception as e:
+        logger.error(f"Error saving batch upload: {str(e)}")
+        for _, filepath, _ in documents:
+            os.remove(filepath)
+        return jsonify({'error': f'Error saving batch upload: {str(e)}'}), 500
+    
+    if len(documents) > BATCH_MAX_FILES:
+        for _, filepath, _ in documents:
+            os.remove(filepath)
+        return jsonify({'error': f'A batch may contain at most {BATCH_MAX_FILES} documents'}), 400
+    
+    if not documents:
+        return jsonify({'error': 'No supported documents in request', 'skipped': skipped}), 400
+    
+    batch_id = submit_batch(documents, patient_id)
+    return jsonify({
+        'batch_id': batch_id,
+        'total': len(documents),
+        'skipped': skipped,
+        'status_url': url_for('batch_status', batch_id=batch_id)
+    }), 202
+
+@app.route('/batch/<batch_id>')
+def batch_status(batch_id):
+    batch = get_batch_status(batch_id)
+    if batch is None:
+        return jsonify({'error': 'Unknown batch'}), 404
+    return jsonify(batch)
+
+@app.route('/batch/<batch_id>/export')
+def export_batch(batch_id):
+    format_type = request.args.get('format', 'json')
+    if format_type not in EXPORT_FORMATS:
+        return jsonify({'error': f'Unsupported export format: {format_type}'}), 400
+    
+    batch = get_batch_status(batch_id)
+    if batch is None:
+        return jsonify({'error': 'Unknown batch'}), 404
+    
+    result_ids = [entry['result_id'] for entry in batch['files'] if entry['result_id']]
+    if not result_ids:
+        return jsonify({'error': 'No results to export'}), 400
+    
+    chunks, mimetype, extension = stream_export(result_ids, format_type)
+    return Response(
+        stream_with_context(chunks),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename=batch_{batch_id}.{extension}'}
+    )
+
+@app.route('/patients/<patient_id>')
+def patient_profile(patient_id):
+    # Patient ids can be guessed, result ids cannot: the caller must present
+    # the id of one of the patient's documents, as returned by its upload or
+    # kept in the session. Unknown patients and wrong ids get the same answer.
+    result_id = request.args.get('result_id') or session.get('result_id', '')
+    profile = load_patient_profile(patient_id)
+    if profile is None or result_id not in profile['documents']:
+        return jsonify({'error': 'Unknown patient'}), 404
+    return jsonify(profile)
+
 @app.route('/results')
 def show_results():
-    # Get results from session
-    extracted_text = session.get('extracted_text', '')
-    medical_terms = session.get('medical_terms', [])
-    hcc_codes = session.get('hcc_codes', [])
-    original_filename = session.get('original_filename', 'Unknown Document')
+    # Only the summary is rendered; terms, codes and text are paged in by the browser
+    result_id = session.get('result_id')
+    metadata = load_metadata(result_id)
     
-    if not extracted_text:
+    if not metadata:
         flash('No processing results found', 'warning')
         return redirect(url_for('index'))
     
     return render_template(
         'result.html',
-        filename=original_filename,
-        extracted_text=extracted_text,
-        medical_terms=medical_terms,
-        hcc_codes=hcc_codes
+        result_id=result_id,
+        filename=metadata['document_name'],
+        warnings=metadata.get('warnings', []),
+        term_count=metadata['term_count'],
+        hcc_code_count=metadata['hcc_code_count'],
+        summary=load_summary(result_id)
     )
 
+def _page_args():
+    """Read the cursor and page size of a paged API request"""
+    cursor = request.args.get('cursor', '0')
+    limit = request.args.get('limit', str(PAGE_SIZE))
+    if not cursor.isdigit() or not limit.isdigit():
+        raise ValueError('cursor and limit must be non-negative integers')
+    return int(cursor), int(limit)
+
+@app.route('/api/results/<result_id>')
+def api_result(result_id):
+    metadata = load_metadata(result_id)
+    if metadata is None:
+        return jsonify({'error': 'Unknown result'}), 404
+    return jsonify({**metadata, 'summary': load_summary(result_id)})
+
+@app.route('/api/results/<result_id>/terms')
+def api_result_terms(result_id):
+    metadata = load_metadata(result_id)
+    if metadata is None:
+        return jsonify({'error': 'Unknown result'}), 404
+    
+    try:
+        cursor, limit = _page_args()
+        items, next_cursor = read_terms_page(
+            result_id, cursor, limit, categories=request.args.getlist('category')
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    return jsonify({'items': items, 'next_cursor': next_cursor, 'total': metadata['term_count']})
+
+@app.route('/api/results/<result_id>/hcc_codes')
+def api_result_codes(result_id):
+    metadata = load_metadata(result_id)
+    if metadata is None:
+        return jsonify({'error': 'Unknown result'}), 404
+    
+    try:
+        cursor, limit = _page_args()
+        items, next_cursor = read_codes_page(
+            result_id, cursor, limit,
+            confidences=request.args.getlist('confidence'),
+            hcc_codes=request.args.getlist('hcc_code')
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    return jsonify({'items': items, 'next_cursor': next_cursor, 'total': metadata['hcc_code_count']})
+
+@app.route('/api/results/<result_id>/text')
+def api_result_text(result_id):
+    if not result_exists(result_id):
+        return jsonify({'error': 'Unknown result'}), 404
+    
+    try:
+        cursor, _ = _page_args()
+        text, next_cursor = read_text_page(result_id, cursor)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    return jsonify({'text': text, 'next_cursor': next_cursor})
+
 @app.route('/export', methods=['POST'])
 def export_results():
     format_type = request.form.get('format', 'json')
+    if format_type not in EXPORT_FORMATS:
+        return jsonify({'error': f'Unsupported export format: {format_type}'}), 400
     
-    # Get results from session
-    extracted_text = session.get('extracted_text', '')
-    medical_terms = session.get('medical_terms', [])
-    hcc_codes = session.get('hcc_codes', [])
-    original_filename = session.get('original_filename', 'Unknown Document')
+    # Export the requested results, falling back to the current session's result
+    result_ids = request.form.getlist('result_id') or [session.get('result_id')]
+    result_ids = [result_id for result_id in result_ids if result_exists(result_id)]
     
-    if not extracted_text:
+    if not result_ids:
         return jsonify({'error': 'No results to export'}), 400
     
-    export_data = {
-        'document_name': original_filename,
-        'extracted_text': extracted_text,
-        'medical_terms': medical_terms,
-        'hcc_codes': hcc_codes
-    }
-    
-    # For now, we only support JSON export
-    return jsonify(export_data)
+    # Stream the export so large results are never built in memory
+    chunks, mimetype, extension = stream_export(result_ids, format_type)
+    return Response(
+        stream_with_context(chunks),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename=medical_document_analysis.{extension}'}
+    )
 
 # Error handlers
 @app.errorhandler(413)
 def too_large(e):
-    flash('File too large. Maximum size is 16MB', 'danger')
+    limit_mb = _request_size_limit() // (1024 * 1024)
+    if request.endpoint == 'upload_batch':
+        return jsonify({'error': f'Batch too large. Maximum size is {limit_mb}MB'}), 413
+    flash(f'File too large. Maximum size is {limit_mb}MB', 'danger')
     return redirect(url_for('index'))
 
 @app.errorhandler(500)
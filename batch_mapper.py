@@ -0,0 +1,186 @@
+import logging
+
+import numpy as np
+
+from hcc_mapper import (
+    get_hcc_codes, _map_term, LOW_OCR_CONFIDENCE,
+    SKIPPED_ASSERTIONS, DOWNGRADED_ASSERTIONS
+)
+from result_store import iter_medical_terms
+
+# Optional: only needed to hand results to Arrow or write Parquet
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+logger = logging.getLogger(__name__)
+
+# Confidence levels by rank; a downgrade moves one rank down, stopping at "low"
+CONFIDENCE_LEVELS = np.array(["high", "medium", "low"], dtype=object)
+_CONFIDENCE_RANKS = {"high": 0, "medium": 1, "low": 2}
+
+TERM_COLUMNS = ["doc_id", "term", "category", "assertion", "ocr_confidence", "match_distance"]
+CODE_COLUMNS = ["doc_id", "term", "hcc_code", "description", "confidence", "assertion"]
+
+
+def columns_from_results(result_ids):
+    """
+    Read the stored terms of many results into columns
+
+    Args:
+        result_ids: Ids of stored results
+
+    Returns:
+        Dictionary of TERM_COLUMNS lists, one row per term, with the
+        result id as doc_id
+    """
+    columns = {name: [] for name in TERM_COLUMNS}
+    for result_id in result_ids:
+        for term_data in iter_medical_terms(result_id):
+            columns["doc_id"].append(result_id)
+            for name in TERM_COLUMNS[1:]:
+                columns[name].append(term_data.get(name))
+    return columns
+
+
+def map_columns(columns, hcc_mapping=None):
+    """
+    Map the terms of many documents to HCC codes in one pass
+
+    Gives the same codes, in the same per-document order, as calling
+    map_to_hcc_codes on every document's terms, but every distinct
+    (term, category) pair in the batch is mapped only once.
+
+    Args:
+        columns: Dictionary of equal-length sequences. "doc_id", "term" and
+            "category" are required; "assertion", "ocr_confidence" and
+            "match_distance" are optional and may contain None.
+        hcc_mapping: Optional HCC codes mapping to use instead of the cached table
+
+    Returns:
+        Dictionary of CODE_COLUMNS numpy arrays, grouped by document in
+        order of first appearance and sorted by confidence within each
+        document
+    """
+    try:
+        if hcc_mapping is None:
+            hcc_mapping = get_hcc_codes()
+
+        terms = np.asarray(columns["term"], dtype=object)
+        row_count = len(terms)
+        if row_count == 0:
+            return {name: np.empty(0, dtype=object) for name in CODE_COLUMNS}
+
+        def optional(name):
+            values = columns.get(name)
+            return np.asarray(values if values is not None else [None] * row_count, dtype=object)
+
+        doc_ids = np.asarray(columns["doc_id"], dtype=object)
+        categories = np.asarray(columns["category"], dtype=object)
+        assertions = optional("assertion")
+        ocr_confidences = optional("ocr_confidence")
+        match_distances = optional("match_distance")
+
+        # Normalize once per distinct spelling, not once per row
+        spellings, spelling_index = np.unique(terms.astype(str), return_inverse=True)
+        lowered, lowered_index = np.unique(np.char.lower(spellings), return_inverse=True)
+        term_index = lowered_index[spelling_index]
+
+        # Documents are numbered in order of first appearance
+        _, doc_first_row, doc_index = np.unique(doc_ids.astype(str), return_index=True, return_inverse=True)
+        doc_order = np.argsort(np.argsort(doc_first_row, kind="stable"), kind="stable")[doc_index]
+
+        # Negated, hypothetical and family-history mentions are not coded
+        kept = np.flatnonzero([assertion not in SKIPPED_ASSERTIONS for assertion in assertions])
+
+        # The first mention of each term in each document is the one mapped
+        pair_keys = doc_index[kept].astype(np.int64) * len(lowered) + term_index[kept]
+        _, first_mention = np.unique(pair_keys, return_index=True)
+        rows = np.sort(kept[first_mention])
+
+        # Map every distinct (term, category) pair once; _map_term only looks
+        # at the lowercased term
+        category_values, category_index = np.unique(categories[rows].astype(str), return_inverse=True)
+        mapping_keys = term_index[rows].astype(np.int64) * len(category_values) + category_index
+        unique_keys, key_index = np.unique(mapping_keys, return_inverse=True)
+
+        mapped_codes = np.empty(len(unique_keys), dtype=object)
+        mapped_descriptions = np.empty(len(unique_keys), dtype=object)
+        mapped_ranks = np.empty(len(unique_keys), dtype=np.int64)
+        for position, key in enumerate(unique_keys):
+            code = _map_term(str(lowered[key // len(category_values)]), str(category_values[key % len(category_values)]), hcc_mapping)
+            mapped_codes[position] = code["hcc_code"]
+            mapped_descriptions[position] = code["description"]
+            mapped_ranks[position] = _CONFIDENCE_RANKS[code["confidence"]]
+        logger.debug(f"Mapped {len(unique_keys)} distinct terms for {len(rows)} document terms")
+
+        # Same downgrades as _adjust_confidence, for all rows at once
+        row_ocr = ocr_confidences[rows]
+        low_ocr = np.array([value is not None and value < LOW_OCR_CONFIDENCE for value in row_ocr], dtype=np.int64)
+        distances = np.array([value or 0 for value in match_distances[rows]], dtype=np.int64)
+        downgraded = np.array([assertion in DOWNGRADED_ASSERTIONS for assertion in assertions[rows]], dtype=bool)
+        ranks = np.minimum(mapped_ranks[key_index] + low_ocr + distances + downgraded, len(CONFIDENCE_LEVELS) - 1)
+
+        # Group by document, then sort by confidence keeping extraction order
+        order = np.lexsort((rows, ranks, doc_order[rows]))
+        rows, key_index, ranks, downgraded = rows[order], key_index[order], ranks[order], downgraded[order]
+
+        return {
+            "doc_id": doc_ids[rows],
+            "term": terms[rows],
+            "hcc_code": mapped_codes[key_index],
+            "description": mapped_descriptions[key_index],
+            "confidence": CONFIDENCE_LEVELS[ranks],
+            "assertion": np.where(downgraded, assertions[rows], None),
+        }
+
+    except Exception as e:
+        logger.error(f"Error during batch HCC code mapping: {str(e)}")
+        raise
+
+
+def columns_to_records(code_columns):
+    """
+    Convert mapped code columns back to per-document lists of code dictionaries
+
+    Args:
+        code_columns: Output of map_columns
+
+    Returns:
+        Dictionary of doc_id to the list map_to_hcc_codes would return
+    """
+    documents = {}
+    for doc_id, term, hcc_code, description, confidence, assertion in zip(*(code_columns[name] for name in CODE_COLUMNS)):
+        code = {"term": term, "hcc_code": hcc_code, "description": description, "confidence": confidence}
+        if assertion is not None:
+            code["assertion"] = assertion
+        documents.setdefault(doc_id, []).append(code)
+    return documents
+
+
+def to_arrow_table(code_columns):
+    """
+    Convert mapped code columns to a pyarrow Table
+
+    Args:
+        code_columns: Output of map_columns
+
+    Returns:
+        pyarrow.Table with one string column per CODE_COLUMNS entry
+    """
+    if pa is None:
+        raise RuntimeError("pyarrow is required for Arrow and Parquet output")
+    return pa.table({name: pa.array(code_columns[name].tolist(), type=pa.string()) for name in CODE_COLUMNS})
+
+
+def write_parquet(code_columns, path):
+    """
+    Write mapped code columns to a Parquet file
+
+    Args:
+        code_columns: Output of map_columns
+        path: File to write
+    """
+    pq.write_table(to_arrow_table(code_columns), path)
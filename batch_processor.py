@@ -0,0 +1,211 @@
+import os
+import logging
+import threading
+import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from werkzeug.utils import secure_filename
+
+from processing import process_document
+from result_store import save_results, save_batch, load_batch
+from patient_aggregator import add_document
+
+logger = logging.getLogger(__name__)
+
+# Worker pool shared by all batch uploads. Threads are enough here: Tesseract
+# runs as a subprocess and OpenCV releases the GIL, so pages overlap well.
+BATCH_WORKERS = int(os.environ.get("BATCH_WORKERS", os.cpu_count() or 4))
+BATCH_MAX_FILES = int(os.environ.get("BATCH_MAX_FILES", 200))
+
+# Total uncompressed size of the documents taken from one zip archive. Zip
+# members cannot inflate past their declared size, so that size is checked
+# before anything is extracted.
+BATCH_MAX_UNCOMPRESSED_BYTES = int(os.environ.get("BATCH_MAX_UNCOMPRESSED_BYTES", 2 * 1024 * 1024 * 1024))
+
+_executor = ThreadPoolExecutor(max_workers=BATCH_WORKERS, thread_name_prefix="batch-worker")
+
+# Guards read-modify-write of batch manifests between worker threads
+_batch_lock = threading.Lock()
+
+
+def expand_zip(zip_path, allowed_extensions, upload_folder):
+    """
+    Extract the supported documents from an uploaded zip archive
+
+    Members past BATCH_MAX_FILES documents or BATCH_MAX_UNCOMPRESSED_BYTES
+    are not extracted, and are reported back with the unsupported ones.
+
+    Args:
+        zip_path: Path to the saved zip file
+        allowed_extensions: Set of accepted file extensions
+        upload_folder: Directory to extract the documents into
+
+    Returns:
+        Tuple of the list of (original_filename, filepath, file_extension)
+        tuples and the list of skipped member names
+    """
+    documents = []
+    skipped = []
+    total_bytes = 0
+    try:
+        with zipfile.ZipFile(zip_path) as archive:
+            for member in archive.infolist():
+                if member.is_dir() or member.filename.startswith("__MACOSX/"):
+                    continue
+
+                original_filename = secure_filename(os.path.basename(member.filename))
+                file_extension = original_filename.rsplit('.', 1)[1].lower() if '.' in original_filename else ''
+                if file_extension not in allowed_extensions:
+                    logger.debug(f"Skipping unsupported zip member: {member.filename}")
+                    skipped.append(member.filename)
+                    continue
+
+                if len(documents) >= BATCH_MAX_FILES:
+                    logger.warning(f"Zip archive exceeds {BATCH_MAX_FILES} documents, skipping {member.filename}")
+                    skipped.append(member.filename)
+                    continue
+                if total_bytes + member.file_size > BATCH_MAX_UNCOMPRESSED_BYTES:
+                    logger.warning(f"Zip archive exceeds {BATCH_MAX_UNCOMPRESSED_BYTES} bytes uncompressed, skipping {member.filename}")
+                    skipped.append(member.filename)
+                    continue
+                total_bytes += member.file_size
+
+                filepath = os.path.join(upload_folder, f"{uuid.uuid4().hex}.{file_extension}")
+                documents.append((original_filename, filepath, file_extension))
+                with archive.open(member) as source, open(filepath, 'wb') as target:
+                    while True:
+                        chunk = source.read(1024 * 1024)
+                        if not chunk:
+                            break
+                        target.write(chunk)
+    except Exception:
+        # Do not leave the documents extracted so far behind
+        for _, filepath, _ in documents:
+            if os.path.exists(filepath):
+                os.remove(filepath)
+        raise
+
+    return documents, skipped
+
+
+def _update_file(batch_id, index, **changes):
+    with _batch_lock:
+        batch = load_batch(batch_id)
+        entry = batch["files"][index]
+        previous_status = entry["status"]
+        entry.update(changes)
+
+        if entry["status"] != previous_status and entry["status"] in ("done", "failed"):
+            if entry["status"] == "done":
+                batch["completed"] += 1
+            else:
+                batch["failed"] += 1
+            if batch["completed"] + batch["failed"] == batch["total"]:
+                batch["status"] = "done"
+                batch["finished_at"] = datetime.now(timezone.utc).isoformat()
+        elif batch["status"] == "queued":
+            batch["status"] = "processing"
+
+        save_batch(batch)
+
+
+def _process_batch_file(batch_id, index, original_filename, filepath, file_extension, patient_id=None):
+    _update_file(batch_id, index, status="processing")
+    try:
+        results = process_document(filepath, file_extension)
+        if not results["extracted_text"]:
+            _update_file(batch_id, index, status="failed", error="No text could be extracted from the document")
+            return
+
+        result_id = save_results(
+            original_filename,
+            results["extracted_text"],
+            results["medical_terms"],
+            results["hcc_codes"],
+            warnings=results["warnings"],
+            profile=results["profile"],
+            patient_id=patient_id,
+            ocr_words=results["ocr_words"]
+        )
+        if patient_id:
+            add_document(patient_id, result_id, results["medical_terms"], results["hcc_codes"])
+        _update_file(
+            batch_id, index,
+            status="done",
+            result_id=result_id,
+            term_count=len(results["medical_terms"]),
+            hcc_code_count=len(results["hcc_codes"]),
+            warnings=results["warnings"]
+        )
+    except Exception as e:
+        logger.error(f"Error processing {original_filename} in batch {batch_id}: {str(e)}")
+        _update_file(batch_id, index, status="failed", error=str(e))
+    finally:
+        try:
+            os.remove(filepath)
+        except Exception as e:
+            logger.error(f"Error removing temporary file: {str(e)}")
+
+
+def submit_batch(documents, patient_id=None):
+    """
+    Schedule a set of saved documents on the worker pool
+
+    Args:
+        documents: List of (original_filename, filepath, file_extension) tuples
+        patient_id: Optional patient the documents belong to; each result is
+            added to the patient's HCC profile as it finishes
+
+    Returns:
+        The batch id
+    """
+    batch_id = uuid.uuid4().hex
+    batch = {
+        "batch_id": batch_id,
+        "patient_id": patient_id,
+        "status": "queued",
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "finished_at": None,
+        "total": len(documents),
+        "completed": 0,
+        "failed": 0,
+        "files": [
+            {
+                "filename": original_filename,
+                "status": "queued",
+                "result_id": None,
+                "error": None,
+            }
+            for original_filename, _, _ in documents
+        ],
+    }
+    save_batch(batch)
+
+    # Every file goes to the pool at once; they finish in whatever order the
+    # workers get through them, not in upload order
+    for index, (original_filename, filepath, file_extension) in enumerate(documents):
+        _executor.submit(_process_batch_file, batch_id, index, original_filename, filepath, file_extension, patient_id)
+
+    logger.debug(f"Submitted batch {batch_id} with {len(documents)} documents")
+    return batch_id
+
+
+def get_batch_status(batch_id):
+    """
+    Get the aggregate progress and per-file results of a batch
+
+    Args:
+        batch_id: Hex batch identifier
+
+    Returns:
+        Batch dictionary with a progress percentage, or None if unknown
+    """
+    batch = load_batch(batch_id)
+    if batch is None:
+        return None
+
+    finished = batch["completed"] + batch["failed"]
+    batch["progress"] = round(100 * finished / batch["total"]) if batch["total"] else 100
+    return batch
@@ -0,0 +1,175 @@
+import re
+import logging
+
+logger = logging.getLogger(__name__)
+
+# NegEx/ConText-style trigger phrases. A pre-trigger applies to a term that
+# follows it within the same clause; a post-trigger to a term just before it.
+PRE_TRIGGERS = {
+    "family": [
+        "family history of", "family hx of", "fhx of", "fh of", "family history",
+        "mother", "father", "sister", "brother", "sibling", "son", "daughter",
+        "maternal", "paternal", "grandmother", "grandfather", "aunt", "uncle",
+    ],
+    "negated": [
+        "no", "not", "denies", "denied", "denying", "without", "never",
+        "no evidence of", "no sign of", "no signs of", "no history of",
+        "negative for", "free of", "absence of", "no suspicion of",
+        "resolved", "ruled out", "rules out", "not demonstrate", "fails to reveal",
+    ],
+    "hypothetical": [
+        "if", "rule out", "r/o", "risk of", "at risk for", "risk for",
+        "screening for", "screen for", "concern for", "evaluate for",
+        "evaluation for", "assess for", "possible", "probable", "suspected",
+        "should", "in case of", "return if", "watch for", "monitor for",
+    ],
+    "historical": [
+        "history of", "hx of", "h/o", "past history of", "past medical history",
+        "pmh", "previous", "previously", "prior", "status post", "s/p",
+        "remote", "in remission",
+    ],
+}
+
+POST_TRIGGERS = {
+    "negated": [
+        "ruled out", "was ruled out", "is ruled out", "has been ruled out",
+        "not present", "not seen", "not found", "absent", "is negative",
+        "was negative", "unlikely", "resolved",
+    ],
+    "hypothetical": ["suspected", "to be ruled out", "is possible", "cannot be excluded"],
+    "historical": ["in the past", "in remission", "years ago", "previously treated"],
+}
+
+# NegEx pseudo-triggers: phrases that contain a trigger but assert nothing
+# about the term ("no change in his COPD"). They are blanked out before the
+# triggers are matched.
+PSEUDO_TRIGGERS = [
+    "no change", "no significant change", "no interval change", "no definite change",
+    "no increase", "no significant increase", "no decrease", "no further",
+    "not only", "not necessarily", "not certain if", "not certain whether",
+    "not ruled out", "not been ruled out", "without difficulty", "without any further",
+    "gram negative", "no suspicious change", "not extend", "not drain",
+]
+
+# Words and punctuation that end a trigger's scope
+TERMINATORS = [
+    "but", "however", "although", "though", "except", "aside from", "apart from",
+    "yet", "still", "which", "who", "presents", "presenting", "reports", "complains",
+    "now", "currently", "today",
+]
+
+# Order used when the same term is found several times: the first entry wins
+ASSERTION_PRIORITY = ["present", "historical", "hypothetical", "family", "negated"]
+
+# Only this many words on either side of a term are examined
+WINDOW_WORDS = 6
+
+# Upper bound on characters examined on either side of a term
+WINDOW_CHARS = 80
+
+# Structured terms where the surrounding wording carries no assertion
+UNASSERTED_CATEGORIES = {"LAB VALUE", "ABNORMAL LAB", "REFERENCE RANGE", "ICD CODE", "SERVICE DATE"}
+
+
+def _compile_triggers(phrases):
+    # Longest phrases first so "no evidence of" wins over "no"
+    alternation = "|".join(
+        re.escape(phrase).replace(r"\ ", r"\s+")
+        for phrase in sorted(set(phrases), key=len, reverse=True)
+    )
+    return re.compile(rf"(?i)(?<![\w/])(?:{alternation})(?![\w/])")
+
+
+# Precompiled once at import: one alternation per assertion type
+_PRE_PATTERNS = {assertion: _compile_triggers(phrases) for assertion, phrases in PRE_TRIGGERS.items()}
+_POST_PATTERNS = {assertion: _compile_triggers(phrases) for assertion, phrases in POST_TRIGGERS.items()}
+_TERMINATOR_PATTERN = _compile_triggers(TERMINATORS)
+_PSEUDO_PATTERN = _compile_triggers(PSEUDO_TRIGGERS)
+
+# Clause boundaries: sentence ends, semicolons, blank lines, and line breaks
+# before a list item or a "Field:" label. Other line breaks are kept, since
+# OCR wraps sentences across lines.
+_BOUNDARY_PATTERN = re.compile(
+    r"[.;!?](?:\s|$)|\n\s*\n"
+    r"|\n[ \t]*(?=[-*\u2022]\s|\(?\d{1,2}[.)]\s|[A-Za-z][A-Za-z /&-]{0,40}:)"
+)
+# A post-trigger only reaches back over the term's own phrase: "Heart
+# failure, resolved edema" says nothing about the heart failure
+_POST_SCOPE_PATTERN = re.compile(r"(?i),|\b(?:and|or)\b")
+_WORD_PATTERN = re.compile(r"\S+")
+
+
+def _blank_pseudo_triggers(window):
+    # Same length, so offsets into the window stay valid
+    return _PSEUDO_PATTERN.sub(lambda match: " " * len(match.group(0)), window)
+
+
+def _pre_window(text, start):
+    window = text[max(start - WINDOW_CHARS, 0):start]
+
+    # Only the clause the term is in
+    boundaries = list(_BOUNDARY_PATTERN.finditer(window))
+    if boundaries:
+        window = window[boundaries[-1].end():]
+    window = _blank_pseudo_triggers(window)
+
+    terminators = list(_TERMINATOR_PATTERN.finditer(window))
+    if terminators:
+        window = window[terminators[-1].end():]
+
+    words = _WORD_PATTERN.findall(window)
+    return " ".join(words[-WINDOW_WORDS:])
+
+
+def _post_window(text, end):
+    window = text[end:end + WINDOW_CHARS]
+
+    boundary = _BOUNDARY_PATTERN.search(window)
+    if boundary:
+        window = window[:boundary.start()]
+    scope = _POST_SCOPE_PATTERN.search(window)
+    if scope:
+        window = window[:scope.start()]
+    window = _blank_pseudo_triggers(window)
+
+    terminator = _TERMINATOR_PATTERN.search(window)
+    if terminator:
+        window = window[:terminator.start()]
+
+    words = _WORD_PATTERN.findall(window)
+    return " ".join(words[:WINDOW_WORDS])
+
+
+def detect_assertion(text, start, end):
+    """
+    Classify how a term found in the text is asserted
+
+    Only a bounded window of words around the term is scanned, so the cost
+    per term is constant regardless of document length.
+
+    Args:
+        text: The full document text
+        start: Start offset of the term in the text
+        end: End offset of the term in the text
+
+    Returns:
+        One of "present", "negated", "historical", "hypothetical" or "family"
+    """
+    before = _pre_window(text, start)
+    if before:
+        for assertion, pattern in _PRE_PATTERNS.items():
+            if pattern.search(before):
+                return assertion
+
+    after = _post_window(text, end)
+    if after:
+        for assertion, pattern in _POST_PATTERNS.items():
+            if pattern.search(after):
+                return assertion
+
+    return "present"
+
+
+def stronger_assertion(first, second):
+    """Pick the assertion to keep when a term occurs more than once"""
+    return min(first, second, key=ASSERTION_PRIORITY.index)
@@ -0,0 +1,270 @@
+import csv
+import io
+import json
+import re
+import logging
+import zipfile
+from xml.sax.saxutils import escape
+
+from result_store import load_metadata, read_extracted_text, iter_medical_terms, iter_hcc_codes
+
+logger = logging.getLogger(__name__)
+
+# Flush streamed output to the client in chunks of roughly this size
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+TERM_COLUMNS = ["term", "category", "source", "assertion", "ocr_confidence", "ocr_text"]
+HCC_CODE_COLUMNS = ["term", "hcc_code", "description", "confidence"]
+
+# Characters that are not allowed in XML 1.0 documents
+_ILLEGAL_XML_CHARS = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+# Spreadsheets treat text starting with these as a formula. Document names and
+# OCR text are user-controlled, so such cells are exported with a leading quote.
+_FORMULA_PREFIXES = ("=", "+", "-", "@", "\t", "\r")
+
+
+def _cell_text(value):
+    """Text of a spreadsheet cell, quoted so it is never read as a formula"""
+    if isinstance(value, str) and value.startswith(_FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+def _chunked(pieces, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Group many small string/bytes pieces into larger chunks for the response
+
+    Args:
+        pieces: Iterable of str or bytes pieces
+        chunk_size: Approximate size of each emitted chunk
+
+    Returns:
+        Generator of chunks
+    """
+    buffer = []
+    size = 0
+    for piece in pieces:
+        if not piece:
+            continue
+        buffer.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield piece[:0].join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield buffer[0][:0].join(buffer)
+
+
+def _documents(result_ids):
+    """Yield (result_id, metadata) for every stored result in the export"""
+    for result_id in result_ids:
+        metadata = load_metadata(result_id)
+        if metadata is None:
+            logger.warning(f"Skipping missing result {result_id} during export")
+            continue
+        yield result_id, metadata
+
+
+def _generate_json(result_ids):
+    # A single document keeps the original export shape; several become an array
+    single = len(result_ids) == 1
+    if not single:
+        yield "["
+
+    for index, (result_id, metadata) in enumerate(_documents(result_ids)):
+        if index:
+            yield ","
+        yield '{"document_name": ' + json.dumps(metadata["document_name"])
+        yield ', "extracted_text": ' + json.dumps(read_extracted_text(result_id))
+
+        yield ', "medical_terms": ['
+        for term_index, term in enumerate(iter_medical_terms(result_id)):
+            yield ("," if term_index else "") + json.dumps(term)
+
+        yield '], "hcc_codes": ['
+        for code_index, code in enumerate(iter_hcc_codes(result_id)):
+            yield ("," if code_index else "") + json.dumps(code)
+        yield "]}"
+
+    if not single:
+        yield "]"
+
+
+def _generate_ndjson(result_ids):
+    for result_id, metadata in _documents(result_ids):
+        document = {"record_type": "document", "result_id": result_id}
+        document.update(metadata)
+        yield json.dumps(document) + "\n"
+
+        for term in iter_medical_terms(result_id):
+            record = {"record_type": "medical_term", "result_id": result_id}
+            record.update(term)
+            yield json.dumps(record) + "\n"
+
+        for code in iter_hcc_codes(result_id):
+            record = {"record_type": "hcc_code", "result_id": result_id}
+            record.update(code)
+            yield json.dumps(record) + "\n"
+
+
+def _generate_csv(result_ids):
+    # One flat table: each row is either a medical term or an HCC code mapping
+    columns = ["record_type", "result_id", "document_name"] + TERM_COLUMNS + HCC_CODE_COLUMNS[1:]
+    line = io.StringIO()
+    writer = csv.DictWriter(line, fieldnames=columns, extrasaction='ignore')
+
+    def row(values):
+        line.seek(0)
+        line.truncate()
+        writer.writerow({column: _cell_text(value) for column, value in values.items()})
+        return line.getvalue()
+
+    yield row({column: column for column in columns})
+
+    for result_id, metadata in _documents(result_ids):
+        base = {"result_id": result_id, "document_name": metadata["document_name"]}
+        for term in iter_medical_terms(result_id):
+            yield row(dict(base, record_type="medical_term", **term))
+        for code in iter_hcc_codes(result_id):
+            yield row(dict(base, record_type="hcc_code", **code))
+
+
+class _StreamBuffer:
+    """Write-only file object that hands its contents back to a generator"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+_XLSX_CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/xl/workbook.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+    '<Override PartName="/xl/worksheets/sheet1.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+    '<Override PartName="/xl/worksheets/sheet2.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+    '</Types>'
+)
+
+_XLSX_ROOT_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+    'Target="xl/workbook.xml"/>'
+    '</Relationships>'
+)
+
+_XLSX_WORKBOOK = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+    'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+    '<sheets>'
+    '<sheet name="Medical Terms" sheetId="1" r:id="rId1"/>'
+    '<sheet name="HCC Codes" sheetId="2" r:id="rId2"/>'
+    '</sheets>'
+    '</workbook>'
+)
+
+_XLSX_WORKBOOK_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+    'Target="worksheets/sheet1.xml"/>'
+    '<Relationship Id="rId2" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+    'Target="worksheets/sheet2.xml"/>'
+    '</Relationships>'
+)
+
+
+def _xlsx_row(values):
+    cells = []
+    for value in values:
+        text = _ILLEGAL_XML_CHARS.sub("", "" if value is None else str(_cell_text(value)))
+        cells.append(f'<c t="inlineStr"><is><t xml:space="preserve">{escape(text)}</t></is></c>')
+    return "<row>" + "".join(cells) + "</row>"
+
+
+def _generate_xlsx(result_ids):
+    # The workbook is written through zipfile onto an unseekable buffer, so
+    # zipfile uses data descriptors and each part can be drained as it grows.
+    buffer = _StreamBuffer()
+    sheets = [
+        ("xl/worksheets/sheet1.xml", TERM_COLUMNS, iter_medical_terms),
+        ("xl/worksheets/sheet2.xml", HCC_CODE_COLUMNS, iter_hcc_codes),
+    ]
+
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as workbook:
+        workbook.writestr("[Content_Types].xml", _XLSX_CONTENT_TYPES)
+        workbook.writestr("_rels/.rels", _XLSX_ROOT_RELS)
+        workbook.writestr("xl/workbook.xml", _XLSX_WORKBOOK)
+        workbook.writestr("xl/_rels/workbook.xml.rels", _XLSX_WORKBOOK_RELS)
+        yield buffer.drain()
+
+        for part_name, columns, iter_records in sheets:
+            with workbook.open(part_name, 'w', force_zip64=True) as sheet:
+                sheet.write(
+                    b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                    b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+                    b'<sheetData>'
+                )
+                sheet.write(_xlsx_row(["document_name"] + columns).encode('utf-8'))
+
+                for result_id, metadata in _documents(result_ids):
+                    for record in iter_records(result_id):
+                        values = [metadata["document_name"]] + [record.get(column) for column in columns]
+                        sheet.write(_xlsx_row(values).encode('utf-8'))
+                        yield buffer.drain()
+
+                sheet.write(b'</sheetData></worksheet>')
+            yield buffer.drain()
+
+    yield buffer.drain()
+
+
+# Export format -> (generator, mimetype, file extension)
+EXPORT_FORMATS = {
+    "json": (_generate_json, "application/json", "json"),
+    "ndjson": (_generate_ndjson, "application/x-ndjson", "ndjson"),
+    "csv": (_generate_csv, "text/csv", "csv"),
+    "xlsx": (_generate_xlsx, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", "xlsx"),
+}
+
+
+def stream_export(result_ids, format_type):
+    """
+    Stream stored results in the requested export format
+
+    Args:
+        result_ids: List of stored result ids to export
+        format_type: One of the keys of EXPORT_FORMATS
+
+    Returns:
+        Tuple of (chunk generator, mimetype, file extension)
+    """
+    if format_type not in EXPORT_FORMATS:
+        raise ValueError(f"Unsupported export format: {format_type}")
+
+    generator, mimetype, extension = EXPORT_FORMATS[format_type]
+    logger.debug(f"Exporting {len(result_ids)} result(s) as {format_type}")
+    return _chunked(generator(list(result_ids))), mimetype, extension
@@ -0,0 +1,343 @@
+import os
+import re
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Largest edit distance a fuzzy match may have
+FUZZY_MAX_EDIT_DISTANCE = int(os.environ.get("FUZZY_MAX_EDIT_DISTANCE", 2))
+
+# Shortest text (in characters) allowed to match at each edit distance.
+# Short words are too easy to turn into another word by OCR noise.
+FUZZY_MIN_LENGTH = {1: 5, 2: 9}
+
+# Corrections are only trusted when there is a sign of OCR damage: every
+# edit is a character swap OCR is known to make ("rheumatold" for
+# "rheumatoid"), or, for a single edit, the token holds a digit or OCR read
+# it with low confidence. Free edits turn ordinary words into diagnoses
+# ("impression" -> "depression", "cancel" -> "cancer").
+OCR_CONFUSABLE_SEQUENCES = [("rn", "m"), ("vv", "w"), ("cl", "d"), ("li", "h")]
+OCR_CONFUSABLE_CHARACTERS = str.maketrans({
+    "1": "l", "i": "l", "|": "l", "!": "l", "0": "o", "5": "s", "8": "b", "2": "z", "9": "g", "c": "e"
+})
+
+# OCR word confidence below which a single free edit is accepted
+FUZZY_LOW_OCR_CONFIDENCE = float(os.environ.get("FUZZY_LOW_OCR_CONFIDENCE", 70))
+
+# Word list of correctly spelled words, one per line. Tokens in it are never
+# corrected. Missing files are ignored; COMMON_WORDS always applies.
+FUZZY_DICTIONARY_FILE = os.environ.get("FUZZY_DICTIONARY_FILE", "/usr/share/dict/words")
+
+# Section headers and everyday words of clinical notes. A correctly spelled
+# word is not an OCR-damaged term, however close it is to one.
+COMMON_WORDS = frozenset("""
+    addendum admission admitted allergies assessment attending chief clinical comparison complaint
+    conclusion conclusions consultation description diagnoses diagnosis discharge discussion
+    examination expression findings follow followup history illness impression impressions
+    indication indications information instructions medications microscopic objective
+    patient patients physical physician present pressure procedure procedures progress
+    provider reason recommendation recommendations referral report results review signature
+    signed specimen subjective summary systems technique treatment
+    cancel canceled cancelled strike strikes
+""".split())
+
+_dictionary_words = None
+_dictionary_lock = threading.Lock()
+
+
+def dictionary_words():
+    """
+    Get the correctly spelled words that are never treated as OCR damage
+
+    Returns:
+        Frozenset of lowercase words: COMMON_WORDS and the words of
+        FUZZY_DICTIONARY_FILE, if it exists
+    """
+    global _dictionary_words
+    with _dictionary_lock:
+        if _dictionary_words is None:
+            words = set(COMMON_WORDS)
+            try:
+                with open(FUZZY_DICTIONARY_FILE, 'r', encoding='utf-8', errors='ignore') as f:
+                    words.update(line.strip().lower() for line in f if line.strip())
+            except OSError:
+                logger.debug(f"No dictionary at {FUZZY_DICTIONARY_FILE}, using the common words only")
+            _dictionary_words = frozenset(words)
+        return _dictionary_words
+
+
+# Deletes are only generated over this many leading characters, which bounds
+# both the index size and the work per lookup (as in SymSpell)
+PREFIX_LENGTH = 7
+
+
+def _deletes(word, max_distance):
+    """All strings reachable from word by deleting up to max_distance characters"""
+    results = {word}
+    frontier = {word}
+    for _ in range(max_distance):
+        next_frontier = set()
+        for candidate in frontier:
+            for i in range(len(candidate)):
+                shorter = candidate[:i] + candidate[i + 1:]
+                if shorter not in results:
+                    next_frontier.add(shorter)
+        results |= next_frontier
+        frontier = next_frontier
+    return results
+
+
+def edit_distance(a, b, max_distance):
+    """
+    Optimal string alignment distance between two strings
+
+    Args:
+        a: First string
+        b: Second string
+        max_distance: Distance above which the exact value is not needed
+
+    Returns:
+        The distance, or max_distance + 1 if it exceeds max_distance
+    """
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+
+    previous_previous = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        row_minimum = i
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if (i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]):
+                current[j] = min(current[j], previous_previous[j - 2] + 1)
+            row_minimum = min(row_minimum, current[j])
+        if row_minimum > max_distance:
+            return max_distance + 1
+        previous_previous, previous = previous, current
+
+    return previous[-1] if previous[-1] <= max_distance else max_distance + 1
+
+
+def ocr_confusable(a, b):
+    """
+    Check whether two strings differ only by characters OCR confuses
+
+    Args:
+        a: First lowercase string
+        b: Second lowercase string
+
+    Returns:
+        True if the strings are the same once confusable characters and
+        character pairs are folded together
+    """
+    def fold(text):
+        for sequence, replacement in OCR_CONFUSABLE_SEQUENCES:
+            text = text.replace(sequence, replacement)
+        return text.translate(OCR_CONFUSABLE_CHARACTERS)
+    return fold(a) == fold(b)
+
+
+class SymSpellIndex:
+    """
+    Symmetric-delete index for approximate lookup of a fixed vocabulary
+
+    Every vocabulary entry is stored under each string obtained by deleting
+    up to max_distance characters from its prefix. A lookup generates the
+    same deletes for the query, so candidates are found with a bounded
+    number of dictionary probes instead of a scan over the vocabulary.
+    """
+
+    def __init__(self, max_distance=FUZZY_MAX_EDIT_DISTANCE, prefix_length=PREFIX_LENGTH):
+        self.max_distance = max_distance
+        self.prefix_length = prefix_length
+        self.entries = {}
+        self.deletes = {}
+        self.max_words = 1
+
+    def add(self, phrase, payload):
+        phrase = phrase.lower()
+        if phrase in self.entries:
+            return
+        self.entries[phrase] = payload
+        self.max_words = max(self.max_words, len(phrase.split()))
+        for deleted in _deletes(phrase[:self.prefix_length], self.max_distance):
+            self.deletes.setdefault(deleted, []).append(phrase)
+
+    def to_dict(self):
+        """Plain-data form of the index, for the extraction snapshot"""
+        return {
+            "max_distance": self.max_distance,
+            "prefix_length": self.prefix_length,
+            "entries": self.entries,
+            "deletes": self.deletes,
+            "max_words": self.max_words,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """Rebuild an index from its to_dict form without regenerating deletes"""
+        index = cls(data["max_distance"], data["prefix_length"])
+        index.entries = data["entries"]
+        index.deletes = data["deletes"]
+        index.max_words = data["max_words"]
+        return index
+
+    def lookup(self, text, max_distance=None):
+        """
+        Find the closest vocabulary entry to a piece of text
+
+        Args:
+            text: Lowercase text to look up
+            max_distance: Optional tighter distance limit
+
+        Returns:
+            Tuple of (phrase, distance, payload), or None if nothing is close enough
+        """
+        max_distance = self.max_distance if max_distance is None else min(max_distance, self.max_distance)
+        if text in self.entries:
+            return text, 0, self.entries[text]
+
+        best = None
+        checked = set()
+        for deleted in _deletes(text[:self.prefix_length], max_distance):
+            for phrase in self.deletes.get(deleted, ()):
+                if phrase in checked:
+                    continue
+                checked.add(phrase)
+                limit = best[1] - 1 if best else max_distance
+                distance = edit_distance(text, phrase, limit)
+                if distance <= limit:
+                    best = (phrase, distance, self.entries[phrase])
+                    if distance == 1:
+                        return best
+        return best
+
+
+# Strips regex syntax that does not change the literal text of a pattern
+_REGEX_NOISE = re.compile(r"\(\?i\)|\\b")
+_GROUP_PATTERN = re.compile(r"\(\?:([^()]*)\)(\?)?")
+_LITERAL_PATTERN = re.compile(r"^[a-z][a-z' \-]*[a-z]$")
+
+
+def pattern_literals(pattern):
+    """
+    List the plain phrases a simple regex pattern matches
+
+    Handles case-insensitive flags, word boundaries, top-level alternation,
+    whitespace classes and non-nested (optional) groups. Anything more
+    complex (character classes, \\w+, lookarounds) yields no literals.
+
+    Args:
+        pattern: Regex pattern string
+
+    Returns:
+        List of lowercase phrases
+    """
+    pattern = _REGEX_NOISE.sub("", pattern).replace(r"\s*", " ").replace(r"\s+", " ")
+
+    expanded = [pattern]
+    while any(_GROUP_PATTERN.search(candidate) for candidate in expanded):
+        next_expanded = []
+        for candidate in expanded:
+            group = _GROUP_PATTERN.search(candidate)
+            if not group:
+                next_expanded.append(candidate)
+                continue
+            options = group.group(1).split("|")
+            if group.group(2):
+                options.append("")
+            for option in options:
+                next_expanded.append(candidate[:group.start()] + option + candidate[group.end():])
+        expanded = next_expanded
+        if len(expanded) > 64:
+            return []
+
+    literals = []
+    for candidate in expanded:
+        for alternative in candidate.split("|"):
+            alternative = " ".join(alternative.lower().split())
+            if _LITERAL_PATTERN.match(alternative):
+                literals.append(alternative)
+    return literals
+
+
+_TOKEN_PATTERN = re.compile(r"[A-Za-z0-9']+")
+
+
+def _ocr_damaged(candidate, phrase, distance, confidence):
+    """Check whether a fuzzy match looks like OCR damage rather than another word"""
+    if ocr_confusable(candidate, phrase):
+        return True
+    if distance > 1:
+        return False
+    return any(ch.isdigit() for ch in candidate) or (confidence is not None and confidence < FUZZY_LOW_OCR_CONFIDENCE)
+
+
+def find_fuzzy_matches(text, index, covered=None, span_confidence=None):
+    """
+    Find OCR-damaged mentions of vocabulary phrases in the text
+
+    Every run of one to index.max_words tokens is looked up once, so the
+    work is linear in the number of tokens. Runs made only of dictionary
+    words are not looked up, and matches must look like OCR damage: only
+    confusable characters differ, or a single edit in a token with a digit
+    or a low OCR confidence.
+
+    Args:
+        text: Document text
+        index: SymSpellIndex over the vocabulary
+        covered: Optional bytearray marking characters already matched exactly;
+            text that is mostly covered is not looked up again
+        span_confidence: Optional function of (start, end) giving the lowest
+            OCR word confidence of a span, or None
+
+    Returns:
+        List of (start, end, phrase, distance, payload) tuples, in text order
+    """
+    dictionary = dictionary_words()
+    tokens = [
+        match for match in _TOKEN_PATTERN.finditer(text)
+        if sum(ch.isalpha() for ch in match.group(0)) >= 3
+    ]
+
+    matches = []
+    position = 0
+    while position < len(tokens):
+        found = None
+        # Prefer the longest phrase starting at this token
+        for size in range(min(index.max_words, len(tokens) - position), 0, -1):
+            start = tokens[position].start()
+            end = tokens[position + size - 1].end()
+            # Mostly matched exactly already (short patterns may hit inside words)
+            if covered is not None and 2 * sum(covered[start:end]) >= end - start:
+                continue
+
+            words = [token.group(0).lower() for token in tokens[position:position + size]]
+            if all(word in dictionary for word in words):
+                continue
+            candidate = " ".join(words)
+            allowed = max(
+                (distance for distance, length in FUZZY_MIN_LENGTH.items() if len(candidate) >= length),
+                default=0
+            )
+            if not allowed:
+                continue
+
+            result = index.lookup(candidate, allowed)
+            if not result or result[1] == 0:
+                continue
+            confidence = span_confidence(start, end) if span_confidence else None
+            if _ocr_damaged(candidate, result[0], result[1], confidence):
+                found = (start, end, result[0], result[1], result[2], size)
+                break
+
+        if found:
+            matches.append(found[:5])
+            position += found[5]
+        else:
+            position += 1
+
+    return matches
@@ -0,0 +1,217 @@
+import sys
+import json
+import time
+import hashlib
+import logging
+import argparse
+from pathlib import Path
+
+import regex_engine
+import resource_limits
+from nlp_processor import extract_medical_terms
+from hcc_mapper import map_to_hcc_codes
+
+logger = logging.getLogger(__name__)
+
+# Representative OCR texts (synthetic, no PHI) and their pinned outputs
+REGRESSION_DIR = Path(__file__).parent / "regression"
+CORPUS_DIR = REGRESSION_DIR / "corpus"
+EXPECTED_DIR = REGRESSION_DIR / "expected"
+
+# Time budgets used while checking outputs. The normal budgets cut extraction
+# short on a slow machine, which would make the outputs depend on its speed.
+GOLDEN_TIME_LIMIT = 3600
+
+
+def _pin_time_limits():
+    resource_limits.STAGE_TIMEOUTS["extraction"] = GOLDEN_TIME_LIMIT
+    regex_engine.REGEX_PATTERN_TIMEOUT = GOLDEN_TIME_LIMIT
+
+
+def run_document(path, repeat=1):
+    """
+    Run extraction and mapping on one corpus document
+
+    Args:
+        path: Path of the corpus text file
+        repeat: Number of runs; the fastest is reported
+
+    Returns:
+        Tuple of (output dictionary, timings dictionary in milliseconds)
+    """
+    text = path.read_text(encoding='utf-8')
+    timings = {"extraction_ms": None, "mapping_ms": None}
+
+    for _ in range(max(repeat, 1)):
+        started = time.perf_counter()
+        medical_terms = extract_medical_terms(text, fuzzy=True)
+        extracted = time.perf_counter()
+        hcc_codes = map_to_hcc_codes(medical_terms)
+        mapped = time.perf_counter()
+
+        for key, seconds in (("extraction_ms", extracted - started), ("mapping_ms", mapped - extracted)):
+            if timings[key] is None or seconds * 1000 < timings[key]:
+                timings[key] = seconds * 1000
+
+    output = {
+        "source_sha256": hashlib.sha256(text.encode('utf-8')).hexdigest(),
+        "medical_terms": medical_terms,
+        "hcc_codes": hcc_codes,
+    }
+    return output, timings
+
+
+def compare_outputs(expected, actual):
+    """
+    Compare a document's output with its golden file
+
+    Args:
+        expected: Golden output
+        actual: Output of the current code
+
+    Returns:
+        List of human-readable differences, empty if the outputs match
+    """
+    differences = []
+    if expected.get("source_sha256") != actual["source_sha256"]:
+        differences.append("corpus text changed since the golden file was written (rerun with --update)")
+
+    for field in ("medical_terms", "hcc_codes"):
+        expected_items = expected.get(field, [])
+        actual_items = actual[field]
+        if expected_items == actual_items:
+            continue
+        # Report the first position where the ordered lists diverge
+        position = next(
+            (i for i, (a, b) in enumerate(zip(expected_items, actual_items)) if a != b),
+            min(len(expected_items), len(actual_items))
+        )
+        differences.append(
+            f"{field}: {len(expected_items)} expected, {len(actual_items)} found, first difference at "
+            f"#{position}: expected {json.dumps(expected_items[position]) if position < len(expected_items) else 'nothing'}, "
+            f"found {json.dumps(actual_items[position]) if position < len(actual_items) else 'nothing'}"
+        )
+    return differences
+
+
+def _changed_setting(value):
+    if isinstance(value, bool):
+        return not value
+    if isinstance(value, (int, float)):
+        return value + 1
+    if isinstance(value, str):
+        return value + "-changed"
+    return None
+
+
+def check_page_cache_keys():
+    """
+    Check that every setting shaping a page image is part of the cache key
+    of the OCR input, so changing one never serves OCR of the old page
+
+    Needs the OCR dependencies (OpenCV, PyMuPDF, pytesseract).
+
+    Returns:
+        List of "module.NAME" settings whose change leaves the key unchanged
+    """
+    import page_geometry
+    import processing
+    from pipeline import SourceFile, settings_of
+
+    inputs = {"source": SourceFile(str(next(CORPUS_DIR.glob("*.txt"))), "pdf")}
+    baseline = processing.DOCUMENT_PIPELINE.value_key(inputs, "page_images")
+
+    settings = [(processing, "MAX_DOCUMENT_PAGES")] + [
+        (page_geometry, setting.split(".", 1)[1]) for setting in settings_of(page_geometry)
+    ]
+    unkeyed = []
+    for module, name in settings:
+        original = getattr(module, name)
+        changed = _changed_setting(original)
+        if changed is None:
+            continue
+        setattr(module, name, changed)
+        try:
+            if processing.DOCUMENT_PIPELINE.value_key(inputs, "page_images") == baseline:
+                unkeyed.append(f"{module.__name__}.{name}")
+        finally:
+            setattr(module, name, original)
+    return unkeyed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Check extraction and HCC mapping against the golden outputs of the regression corpus"
+    )
+    parser.add_argument("documents", nargs="*", help="Corpus document names to run (default: all)")
+    parser.add_argument("--update", action="store_true", help="Rewrite the golden outputs from the current code")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per document; the fastest is reported")
+    parser.add_argument("--timings", help="Write per-document timings as NDJSON to this file")
+    parser.add_argument("--baseline", help="Timings file of an earlier run to compare speed against")
+    parser.add_argument("--check-cache-keys", action="store_true",
+                        help="Also check that page settings are part of the OCR cache key (needs the OCR dependencies)")
+    args = parser.parse_args(argv)
+
+    _pin_time_limits()
+
+    paths = sorted(CORPUS_DIR.glob("*.txt"))
+    if args.documents:
+        wanted = {Path(name).stem for name in args.documents}
+        paths = [path for path in paths if path.stem in wanted]
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = {record["document"]: record for record in map(json.loads, f) if record}
+
+    timing_records = []
+    failed = 0
+    for path in paths:
+        actual, timings = run_document(path, args.repeat)
+        expected_path = EXPECTED_DIR / f"{path.stem}.json"
+
+        if args.update:
+            EXPECTED_DIR.mkdir(parents=True, exist_ok=True)
+            with open(expected_path, 'w', encoding='utf-8') as f:
+                json.dump(actual, f, indent=2, ensure_ascii=False)
+                f.write("\n")
+            status, differences = "UPDATED", []
+        elif not expected_path.exists():
+            status, differences = "MISSING", ["no golden file (run with --update)"]
+        else:
+            with open(expected_path, 'r', encoding='utf-8') as f:
+                differences = compare_outputs(json.load(f), actual)
+            status = "FAIL" if differences else "PASS"
+
+        if status in ("FAIL", "MISSING"):
+            failed += 1
+
+        line = f"{status:8} {path.stem:32} extraction {timings['extraction_ms']:8.2f} ms  mapping {timings['mapping_ms']:7.2f} ms"
+        if path.stem in baseline:
+            before = baseline[path.stem]["extraction_ms"] + baseline[path.stem]["mapping_ms"]
+            after = timings["extraction_ms"] + timings["mapping_ms"]
+            line += f"  ({before / after:.2f}x vs baseline)" if after else ""
+        print(line)
+        for difference in differences:
+            print(f"         {difference}")
+
+        timing_records.append({"document": path.stem, **timings})
+
+    if args.timings:
+        with open(args.timings, 'w', encoding='utf-8') as f:
+            for record in timing_records:
+                f.write(json.dumps(record) + "\n")
+
+    if args.check_cache_keys:
+        unkeyed = check_page_cache_keys()
+        for setting in unkeyed:
+            print(f"FAIL     cache key ignores {setting}")
+        failed += len(unkeyed)
+
+    logger.info(f"Checked {len(paths)} documents, {failed} failed")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
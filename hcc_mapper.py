@@ -1,6 +1,7 @@
 import json
 import os
 import logging
+import threading
 from pathlib import Path
 
 logger = logging.getLogger(__name__)
@@ -8,14 +9,20 @@ logger = logging.getLogger(__name__)
 # Path to the HCC codes mapping file
 HCC_CODES_FILE = Path(__file__).parent / "static" / "data" / "hcc_codes.json"
 
-def load_hcc_codes():
+def load_hcc_codes(strict=False):
     """
     Load HCC codes from the JSON file
     
+    Args:
+        strict: Raise when the file is missing or unreadable instead of
+            falling back to the built-in or an empty mapping
+    
     Returns:
         Dictionary of HCC codes mappings
     """
     try:
+        if strict and not os.path.exists(HCC_CODES_FILE):
+            raise FileNotFoundError(f"HCC codes file not found at {HCC_CODES_FILE}")
         if os.path.exists(HCC_CODES_FILE):
             with open(HCC_CODES_FILE, 'r') as f:
                 hcc_codes = json.load(f)
@@ -48,14 +55,451 @@ def load_hcc_codes():
             }
     except Exception as e:
         logger.error(f"Error loading HCC codes: {str(e)}")
+        if strict:
+            raise
         return {}
 
-def map_to_hcc_codes(medical_terms):
+# Cached HCC table, reloaded whenever the JSON file's modification time changes
+_hcc_cache = {"mtime": None, "codes": None}
+_hcc_cache_lock = threading.Lock()
+
+def get_hcc_codes():
+    """
+    Get the HCC codes mapping, loading it from disk only when the file changed
+    
+    Returns:
+        Dictionary of HCC codes mappings
+    """
+    try:
+        mtime = os.path.getmtime(HCC_CODES_FILE)
+    except OSError:
+        mtime = None
+    
+    with _hcc_cache_lock:
+        if _hcc_cache["codes"] is None or _hcc_cache["mtime"] != mtime:
+            _hcc_cache["codes"] = load_hcc_codes()
+            _hcc_cache["mtime"] = mtime
+        return _hcc_cache["codes"]
+
+def prime_hcc_cache(hcc_codes, word_index):
+    """
+    Install an HCC table and word index that were built ahead of time
+    
+    Args:
+        hcc_codes: HCC codes mapping, as loaded from the current JSON file
+        word_index: Word index of hcc_codes, from build_hcc_word_index
+    """
+    try:
+        mtime = os.path.getmtime(HCC_CODES_FILE)
+    except OSError:
+        mtime = None
+    
+    with _hcc_cache_lock:
+        _hcc_cache["codes"] = hcc_codes
+        _hcc_cache["mtime"] = mtime
+    with _hcc_word_index_lock:
+        _hcc_word_index["source"] = hcc_codes
+        _hcc_word_index["index"] = word_index
+
+def build_hcc_word_index(hcc_mapping):
+    """
+    Build an inverted index from words to the HCC keys containing them
+    
+    Args:
+        hcc_mapping: HCC codes mapping
+    
+    Returns:
+        Dictionary with the keys' positions in the mapping by word, the
+        number of distinct words per key, and the positions of keys
+        without words
+    """
+    by_word = {}
+    word_counts = []
+    wordless = []
+    for position, key in enumerate(hcc_mapping):
+        key_words = set(key.split())
+        word_counts.append(len(key_words))
+        if not key_words:
+            wordless.append(position)
+        for word in key_words:
+            by_word.setdefault(word, []).append(position)
+    return {
+        "keys": list(hcc_mapping),
+        "by_word": by_word,
+        "word_counts": word_counts,
+        "wordless": wordless
+    }
+
+# Word index of the last HCC table it was requested for
+_hcc_word_index = {"source": None, "index": None}
+_hcc_word_index_lock = threading.Lock()
+
+def get_hcc_word_index(hcc_mapping):
+    """
+    Get the word index of an HCC table, building it on first use
+    
+    Args:
+        hcc_mapping: HCC codes mapping
+    
+    Returns:
+        Word index as returned by build_hcc_word_index
+    """
+    with _hcc_word_index_lock:
+        if _hcc_word_index["source"] is not hcc_mapping:
+            _hcc_word_index["index"] = build_hcc_word_index(hcc_mapping)
+            _hcc_word_index["source"] = hcc_mapping
+        return _hcc_word_index["index"]
+
+def _first_word_subset_key(term_words, hcc_mapping):
+    """
+    Find the first HCC key, in table order, all of whose words are in the term
+    
+    Args:
+        term_words: Set of words of the term
+        hcc_mapping: HCC codes mapping
+    
+    Returns:
+        The key, or None if no key matches
+    """
+    index = get_hcc_word_index(hcc_mapping)
+    word_counts = index["word_counts"]
+    
+    # A key matches when every one of its distinct words was hit
+    hits = {}
+    first = index["wordless"][0] if index["wordless"] else None
+    for word in term_words:
+        for position in index["by_word"].get(word, ()):
+            hits[position] = hits.get(position, 0) + 1
+            if hits[position] == word_counts[position] and (first is None or position < first):
+                first = position
+    return index["keys"][first] if first is not None else None
+
+# Expanded lab test mappings for more comprehensive coverage
+LAB_TEST_MAPPINGS = {
+    # Blood glucose abnormalities
+    "glucose": {"high": {"code": "HCC 19", "description": "Diabetes without Complication"}},
+    "glu": {"high": {"code": "HCC 19", "description": "Diabetes without Complication"}},
+    "a1c": {"high": {"code": "HCC 17", "description": "Diabetes with Acute Complications"}},
+    "hba1c": {"high": {"code": "HCC 17", "description": "Diabetes with Acute Complications"}},
+    "glycosylated hemoglobin": {"high": {"code": "HCC 17", "description": "Diabetes with Acute Complications"}},
+    "fasting glucose": {"high": {"code": "HCC 19", "description": "Diabetes without Complication"}},
+    
+    # Blood cell abnormalities
+    "hemoglobin": {"low": {"code": "HCC 2", "description": "Sepsis, Severe Blood Related Conditions"}},
+    "hgb": {"low": {"code": "HCC 2", "description": "Sepsis, Severe Blood Related Conditions"}},
+    "hematocrit": {"low": {"code": "HCC 2", "description": "Sepsis, Severe Blood Related Conditions"}},
+    "hct": {"low": {"code": "HCC 2", "description": "Sepsis, Severe Blood Related Conditions"}},
+    "rbc": {"low": {"code": "HCC 2", "description": "Sepsis, Severe Blood Related Conditions"}},
+    "red blood cell": {"low": {"code": "HCC 2", "description": "Sepsis, Severe Blood Related Conditions"}},
+    "wbc": {
+        "high": {"code": "HCC 2", "description": "Sepsis, Severe Blood Related Conditions"},
+        "low": {"code": "HCC 2", "description": "Sepsis, Severe Blood Related Conditions"}
+    },
+    "white blood cell": {
+        "high": {"code": "HCC 2", "description": "Sepsis, Severe Blood Related Conditions"},
+        "low": {"code": "HCC 2", "description": "Sepsis, Severe Blood Related Conditions"}
+    },
+    "platelets": {"low": {"code": "HCC 2", "description": "Sepsis, Severe Blood Related Conditions"}},
+    "plt": {"low": {"code": "HCC 2", "description": "Sepsis, Severe Blood Related Conditions"}},
+    
+    # Cholesterol and lipids
+    "cholesterol": {"high": {"code": "HCC 88", "description": "Unstable Angina and Other Acute Ischemic Heart Disease"}},
+    "triglycerides": {"high": {"code": "HCC 88", "description": "Unstable Angina and Other Acute Ischemic Heart Disease"}},
+    "ldl": {"high": {"code": "HCC 88", "description": "Unstable Angina and Other Acute Ischemic Heart Disease"}},
+    "hdl": {"low": {"code": "HCC 88", "description": "Unstable Angina and Other Acute Ischemic Heart Disease"}},
+    
+    # Kidney function
+    "creatinine": {"high": {"code": "HCC 138", "description": "Chronic Kidney Disease, Moderate (Stage 3)"}},
+    "cre": {"high": {"code": "HCC 138", "description": "Chronic Kidney Disease, Moderate (Stage 3)"}},
+    "bun": {"high": {"code": "HCC 138", "description": "Chronic Kidney Disease, Moderate (Stage 3)"}},
+    "blood urea nitrogen": {"high": {"code": "HCC 138", "description": "Chronic Kidney Disease, Moderate (Stage 3)"}},
+    "egfr": {"low": {"code": "HCC 138", "description": "Chronic Kidney Disease, Moderate (Stage 3)"}},
+    "estimated glomerular filtration rate": {"low": {"code": "HCC 138", "description": "Chronic Kidney Disease, Moderate (Stage 3)"}},
+    
+    # Liver function
+    "alt": {"high": {"code": "HCC 29", "description": "Chronic Hepatitis"}},
+    "alanine aminotransferase": {"high": {"code": "HCC 29", "description": "Chronic Hepatitis"}},
+    "ast": {"high": {"code": "HCC 29", "description": "Chronic Hepatitis"}},
+    "aspartate aminotransferase": {"high": {"code": "HCC 29", "description": "Chronic Hepatitis"}},
+    "ggt": {"high": {"code": "HCC 29", "description": "Chronic Hepatitis"}},
+    "gamma-glutamyl transferase": {"high": {"code": "HCC 29", "description": "Chronic Hepatitis"}},
+    "alkaline phosphatase": {"high": {"code": "HCC 29", "description": "Chronic Hepatitis"}},
+    "alp": {"high": {"code": "HCC 29", "description": "Chronic Hepatitis"}},
+    "bilirubin": {"high": {"code": "HCC 29", "description": "Chronic Hepatitis"}},
+    "bili": {"high": {"code": "HCC 29", "description": "Chronic Hepatitis"}},
+    
+    # Thyroid
+    "tsh": {
+        "high": {"code": "HCC 21", "description": "Hypothyroidism"},
+        "low": {"code": "HCC 21", "description": "Hyperthyroidism"}
+    },
+    "thyroid stimulating hormone": {
+        "high": {"code": "HCC 21", "description": "Hypothyroidism"},
+        "low": {"code": "HCC 21", "description": "Hyperthyroidism"}
+    },
+    "t3": {"high": {"code": "HCC 21", "description": "Hyperthyroidism"}},
+    "t4": {"high": {"code": "HCC 21", "description": "Hyperthyroidism"}},
+    "thyroxine": {"high": {"code": "HCC 21", "description": "Hyperthyroidism"}},
+    
+    # Electrolytes
+    "sodium": {
+        "high": {"code": "HCC 22", "description": "Metabolic Disorders"},
+        "low": {"code": "HCC 22", "description": "Metabolic Disorders"}
+    },
+    "na": {
+        "high": {"code": "HCC 22", "description": "Metabolic Disorders"},
+        "low": {"code": "HCC 22", "description": "Metabolic Disorders"}
+    },
+    "potassium": {
+        "high": {"code": "HCC 22", "description": "Metabolic Disorders"},
+        "low": {"code": "HCC 22", "description": "Metabolic Disorders"}
+    },
+    "k": {
+        "high": {"code": "HCC 22", "description": "Metabolic Disorders"},
+        "low": {"code": "HCC 22", "description": "Metabolic Disorders"}
+    },
+    "calcium": {
+        "high": {"code": "HCC 22", "description": "Metabolic Disorders"},
+        "low": {"code": "HCC 22", "description": "Metabolic Disorders"}
+    },
+    "ca": {
+        "high": {"code": "HCC 22", "description": "Metabolic Disorders"},
+        "low": {"code": "HCC 22", "description": "Metabolic Disorders"}
+    },
+    "chloride": {
+        "high": {"code": "HCC 22", "description": "Metabolic Disorders"},
+        "low": {"code": "HCC 22", "description": "Metabolic Disorders"}
+    },
+    "cl": {
+        "high": {"code": "HCC 22", "description": "Metabolic Disorders"},
+        "low": {"code": "HCC 22", "description": "Metabolic Disorders"}
+    },
+    "bicarbonate": {
+        "high": {"code": "HCC 22", "description": "Metabolic Disorders"},
+        "low": {"code": "HCC 22", "description": "Metabolic Disorders"}
+    },
+    "co2": {
+        "high": {"code": "HCC 22", "description": "Metabolic Disorders"},
+        "low": {"code": "HCC 22", "description": "Metabolic Disorders"}
+    },
+    "magnesium": {
+        "high": {"code": "HCC 22", "description": "Metabolic Disorders"},
+        "low": {"code": "HCC 22", "description": "Metabolic Disorders"}
+    },
+    "mg": {
+        "high": {"code": "HCC 22", "description": "Metabolic Disorders"},
+        "low": {"code": "HCC 22", "description": "Metabolic Disorders"}
+    },
+    "phosphorus": {
+        "high": {"code": "HCC 22", "description": "Metabolic Disorders"},
+        "low": {"code": "HCC 22", "description": "Metabolic Disorders"}
+    },
+    "phos": {
+        "high": {"code": "HCC 22", "description": "Metabolic Disorders"},
+        "low": {"code": "HCC 22", "description": "Metabolic Disorders"}
+    },
+    
+    # Nutritional factors
+    "vitamin d": {"low": {"code": "HCC 22", "description": "Metabolic Disorders"}},
+    "25-oh": {"low": {"code": "HCC 22", "description": "Metabolic Disorders"}},
+    "vitamin b12": {"low": {"code": "HCC 21", "description": "Nutritional Deficiency"}},
+    "folate": {"low": {"code": "HCC 21", "description": "Nutritional Deficiency"}},
+    "folic": {"low": {"code": "HCC 21", "description": "Nutritional Deficiency"}},
+    "ferritin": {
+        "high": {"code": "HCC 22", "description": "Metabolic Disorders"},
+        "low": {"code": "HCC 2", "description": "Sepsis, Severe Blood Related Conditions"}
+    },
+    "iron": {"low": {"code": "HCC 2", "description": "Sepsis, Severe Blood Related Conditions"}},
+    "transferrin": {"low": {"code": "HCC 2", "description": "Sepsis, Severe Blood Related Conditions"}},
+    
+    # Other important lab values
+    "troponin": {"high": {"code": "HCC 86", "description": "Acute Myocardial Infarction"}},
+    "trp": {"high": {"code": "HCC 86", "description": "Acute Myocardial Infarction"}},
+    "bnp": {"high": {"code": "HCC 85", "description": "Congestive Heart Failure"}},
+    "brain natriuretic peptide": {"high": {"code": "HCC 85", "description": "Congestive Heart Failure"}},
+    "nt-probnp": {"high": {"code": "HCC 85", "description": "Congestive Heart Failure"}},
+    "crp": {"high": {"code": "HCC 2", "description": "Sepsis, Severe Blood Related Conditions"}},
+    "c-reactive protein": {"high": {"code": "HCC 2", "description": "Sepsis, Severe Blood Related Conditions"}},
+    "esr": {"high": {"code": "HCC 40", "description": "Rheumatoid Arthritis and Inflammatory Connective Tissue Disease"}},
+    "erythrocyte sedimentation rate": {"high": {"code": "HCC 40", "description": "Rheumatoid Arthritis and Inflammatory Connective Tissue Disease"}},
+    "psa": {"high": {"code": "HCC 12", "description": "Breast, Prostate, Colorectal and Other Cancers and Tumors"}},
+    "prostate specific antigen": {"high": {"code": "HCC 12", "description": "Breast, Prostate, Colorectal and Other Cancers and Tumors"}},
+    "albumin": {"low": {"code": "HCC 22", "description": "Metabolic Disorders"}},
+    "alb": {"low": {"code": "HCC 22", "description": "Metabolic Disorders"}},
+    "protein": {"low": {"code": "HCC 21", "description": "Protein-Calorie Malnutrition"}},
+    "inr": {"high": {"code": "HCC 28", "description": "Cirrhosis of Liver"}},
+    "international normalized ratio": {"high": {"code": "HCC 28", "description": "Cirrhosis of Liver"}},
+    "pt": {"high": {"code": "HCC 28", "description": "Cirrhosis of Liver"}},
+    "prothrombin time": {"high": {"code": "HCC 28", "description": "Cirrhosis of Liver"}},
+    "ptt": {"high": {"code": "HCC 28", "description": "Cirrhosis of Liver"}},
+    "partial thromboplastin time": {"high": {"code": "HCC 28", "description": "Cirrhosis of Liver"}}
+}
+
+
+# OCR word confidence (0-100) below which a mapping is downgraded one level
+LOW_OCR_CONFIDENCE = 60
+
+CONFIDENCE_DOWNGRADE = {"high": "medium", "medium": "low", "low": "low"}
+
+# Term assertions (see context_detector) that are not coded at all, and those
+# that are coded with lower confidence
+SKIPPED_ASSERTIONS = {"negated", "hypothetical", "family"}
+DOWNGRADED_ASSERTIONS = {"historical"}
+
+def _map_term(original_term, category, hcc_mapping):
+    """
+    Map a single medical term to its HCC code
+    
+    Args:
+        original_term: The term as extracted from the document
+        category: Category assigned during extraction
+        hcc_mapping: HCC codes mapping
+    
+    Returns:
+        Dictionary with the mapped HCC code details
+    """
+    term = original_term.lower()
+    
+    # Special handling for ICD codes - direct mapping
+    if category == "ICD CODE":
+        return {
+            "term": original_term,
+            "hcc_code": "ICD: " + term,
+            "description": "ICD Code",
+            "confidence": "high"
+        }
+    
+    # Special handling for lab values with abnormal results
+    if category in ["LAB VALUE", "ABNORMAL LAB"]:
+        # Extract lab test name and status
+        lab_parts = term.split(":")
+        if len(lab_parts) > 0:
+            lab_name = lab_parts[0].strip().lower()
+            
+            # Get lab value and unit if available
+            lab_value_info = lab_parts[1].strip() if len(lab_parts) > 1 else ""
+            
+            # Determine if high or low
+            status = "normal"
+            # First check explicit labels
+            if "high" in term.lower() or "elevated" in term.lower() or "above range" in term.lower() or "h)" in term.lower() or "(h" in term.lower():
+                status = "high"
+            elif "low" in term.lower() or "decreased" in term.lower() or "below range" in term.lower() or "l)" in term.lower() or "(l" in term.lower():
+                status = "low"
+            elif category == "ABNORMAL LAB":  # If marked as abnormal but no direction specified
+                status = "abnormal"
+            
+            # Check if we have a mapping for this lab test
+            for lab_key in LAB_TEST_MAPPINGS:
+                if lab_key in lab_name:
+                    if status == "high" and "high" in LAB_TEST_MAPPINGS[lab_key]:
+                        code_data = LAB_TEST_MAPPINGS[lab_key]["high"]
+                        return {
+                            "term": original_term,
+                            "hcc_code": code_data["code"],
+                            "description": code_data["description"],
+                            "confidence": "medium"
+                        }
+                    elif status == "low" and "low" in LAB_TEST_MAPPINGS[lab_key]:
+                        code_data = LAB_TEST_MAPPINGS[lab_key]["low"]
+                        return {
+                            "term": original_term,
+                            "hcc_code": code_data["code"],
+                            "description": code_data["description"],
+                            "confidence": "medium"
+                        }
+                    elif status == "abnormal" and ("high" in LAB_TEST_MAPPINGS[lab_key] or "low" in LAB_TEST_MAPPINGS[lab_key]):
+                        # If marked abnormal but no direction, use the first available mapping
+                        code_data = next(iter(LAB_TEST_MAPPINGS[lab_key].values()))
+                        return {
+                            "term": original_term,
+                            "hcc_code": code_data["code"],
+                            "description": code_data["description"],
+                            "confidence": "low"  # Lower confidence since we don't know if high or low
+                        }
+    
+    # Enhanced category-based mapping for more accurate results
+    confidence_level = "medium"
+    
+    # Adjust confidence based on category
+    if category in ["CHRONIC CONDITION", "DIAGNOSTIC FINDING"]:
+        confidence_level = "high"
+    elif category in ["MEDICATION", "PROCEDURE", "SERVICE DATE"]:
+        confidence_level = "low"
+        
+    # For non-lab values or unmatched lab values, continue with regular mapping
+    
+    # Try direct mapping first - highest confidence
+    if term in hcc_mapping:
+        code_data = hcc_mapping[term]
+        return {
+            "term": original_term,
+            "hcc_code": code_data["code"],
+            "description": code_data["description"],
+            "confidence": "high"
+        }
+    
+    # Try exact word matching for better accuracy: if all words in the
+    # dictionary key are in the term, it's a strong match
+    key = _first_word_subset_key(set(term.split()), hcc_mapping)
+    if key is not None:
+        code_data = hcc_mapping[key]
+        return {
+            "term": original_term,
+            "hcc_code": code_data["code"],
+            "description": code_data["description"],
+            "confidence": confidence_level
+        }
+        
+    # Try partial matching as a last resort
+    for key, code_data in hcc_mapping.items():
+        # Check if the key is contained within the term or term is contained within the key
+        if key in term or term in key:
+            return {
+                "term": original_term,
+                "hcc_code": code_data["code"],
+                "description": code_data["description"],
+                "confidence": "low"  # Lower confidence for partial matches
+            }
+    
+    # If no match is found
+    return {
+        "term": original_term,
+        "hcc_code": "Unknown",
+        "description": "No matching HCC code found",
+        "confidence": "low"
+    }
+
+def _adjust_confidence(code, term_data):
+    """
+    Lower the mapping confidence for terms that OCR was unsure about, for
+    fuzzy matches and for historical mentions
+    
+    Args:
+        code: Mapped HCC code details
+        term_data: The extracted term the code was mapped from
+    
+    Returns:
+        The (possibly adjusted) code details
+    """
+    ocr_confidence = term_data.get("ocr_confidence")
+    if ocr_confidence is not None and ocr_confidence < LOW_OCR_CONFIDENCE:
+        code["confidence"] = CONFIDENCE_DOWNGRADE[code["confidence"]]
+    # Fuzzy matches lose one level per edit needed to reach the known term
+    for _ in range(term_data.get("match_distance", 0)):
+        code["confidence"] = CONFIDENCE_DOWNGRADE[code["confidence"]]
+    if term_data.get("assertion") in DOWNGRADED_ASSERTIONS:
+        code["confidence"] = CONFIDENCE_DOWNGRADE[code["confidence"]]
+        code["assertion"] = term_data["assertion"]
+    return code
+
+def map_to_hcc_codes(medical_terms, hcc_mapping=None):
     """
     Map the extracted medical terms to HCC codes
     
     Args:
         medical_terms: List of extracted medical terms
+        hcc_mapping: Optional HCC codes mapping to use instead of the cached table
     
     Returns:
         List of mapped HCC codes with details
@@ -64,168 +508,8 @@ def map_to_hcc_codes(medical_terms):
         logger.debug("Starting HCC code mapping")
         
         # Load HCC codes
-        hcc_mapping = load_hcc_codes()
-        
-        # Expanded lab test mappings for more comprehensive coverage
-        lab_test_mappings = {
-            # Blood glucose abnormalities
-            "glucose": {"high": {"code": "HCC 19", "description": "Diabetes without Complication"}},
-            "glu": {"high": {"code": "HCC 19", "description": "Diabetes without Complication"}},
-            "a1c": {"high": {"code": "HCC 17", "description": "Diabetes with Acute Complications"}},
-            "hba1c": {"high": {"code": "HCC 17", "description": "Diabetes with Acute Complications"}},
-            "glycosylated hemoglobin": {"high": {"code": "HCC 17", "description": "Diabetes with Acute Complications"}},
-            "fasting glucose": {"high": {"code": "HCC 19", "description": "Diabetes without Complication"}},
-            
-            # Blood cell abnormalities
-            "hemoglobin": {"low": {"code": "HCC 2", "description": "Sepsis, Severe Blood Related Conditions"}},
-            "hgb": {"low": {"code": "HCC 2", "description": "Sepsis, Severe Blood Related Conditions"}},
-            "hematocrit": {"low": {"code": "HCC 2", "description": "Sepsis, Severe Blood Related Conditions"}},
-            "hct": {"low": {"code": "HCC 2", "description": "Sepsis, Severe Blood Related Conditions"}},
-            "rbc": {"low": {"code": "HCC 2", "description": "Sepsis, Severe Blood Related Conditions"}},
-            "red blood cell": {"low": {"code": "HCC 2", "description": "Sepsis, Severe Blood Related Conditions"}},
-            "wbc": {
-                "high": {"code": "HCC 2", "description": "Sepsis, Severe Blood Related Conditions"},
-                "low": {"code": "HCC 2", "description": "Sepsis, Severe Blood Related Conditions"}
-            },
-            "white blood cell": {
-                "high": {"code": "HCC 2", "description": "Sepsis, Severe Blood Related Conditions"},
-                "low": {"code": "HCC 2", "description": "Sepsis, Severe Blood Related Conditions"}
-            },
-            "platelets": {"low": {"code": "HCC 2", "description": "Sepsis, Severe Blood Related Conditions"}},
-            "plt": {"low": {"code": "HCC 2", "description": "Sepsis, Severe Blood Related Conditions"}},
-            
-            # Cholesterol and lipids
-            "cholesterol": {"high": {"code": "HCC 88", "description": "Unstable Angina and Other Acute Ischemic Heart Disease"}},
-            "triglycerides": {"high": {"code": "HCC 88", "description": "Unstable Angina and Other Acute Ischemic Heart Disease"}},
-            "ldl": {"high": {"code": "HCC 88", "description": "Unstable Angina and Other Acute Ischemic Heart Disease"}},
-            "hdl": {"low": {"code": "HCC 88", "description": "Unstable Angina and Other Acute Ischemic Heart Disease"}},
-            
-            # Kidney function
-            "creatinine": {"high": {"code": "HCC 138", "description": "Chronic Kidney Disease, Moderate (Stage 3)"}},
-            "cre": {"high": {"code": "HCC 138", "description": "Chronic Kidney Disease, Moderate (Stage 3)"}},
-            "bun": {"high": {"code": "HCC 138", "description": "Chronic Kidney Disease, Moderate (Stage 3)"}},
-            "blood urea nitrogen": {"high": {"code": "HCC 138", "description": "Chronic Kidney Disease, Moderate (Stage 3)"}},
-            "egfr": {"low": {"code": "HCC 138", "description": "Chronic Kidney Disease, Moderate (Stage 3)"}},
-            "estimated glomerular filtration rate": {"low": {"code": "HCC 138", "description": "Chronic Kidney Disease, Moderate (Stage 3)"}},
-            
-            # Liver function
-            "alt": {"high": {"code": "HCC 29", "description": "Chronic Hepatitis"}},
-            "alanine aminotransferase": {"high": {"code": "HCC 29", "description": "Chronic Hepatitis"}},
-            "ast": {"high": {"code": "HCC 29", "description": "Chronic Hepatitis"}},
-            "aspartate aminotransferase": {"high": {"code": "HCC 29", "description": "Chronic Hepatitis"}},
-            "ggt": {"high": {"code": "HCC 29", "description": "Chronic Hepatitis"}},
-            "gamma-glutamyl transferase": {"high": {"code": "HCC 29", "description": "Chronic Hepatitis"}},
-            "alkaline phosphatase": {"high": {"code": "HCC 29", "description": "Chronic Hepatitis"}},
-            "alp": {"high": {"code": "HCC 29", "description": "Chronic Hepatitis"}},
-            "bilirubin": {"high": {"code": "HCC 29", "description": "Chronic Hepatitis"}},
-            "bili": {"high": {"code": "HCC 29", "description": "Chronic Hepatitis"}},
-            
-            # Thyroid
-            "tsh": {
-                "high": {"code": "HCC 21", "description": "Hypothyroidism"},
-                "low": {"code": "HCC 21", "description": "Hyperthyroidism"}
-            },
-            "thyroid stimulating hormone": {
-                "high": {"code": "HCC 21", "description": "Hypothyroidism"},
-                "low": {"code": "HCC 21", "description": "Hyperthyroidism"}
-            },
-            "t3": {"high": {"code": "HCC 21", "description": "Hyperthyroidism"}},
-            "t4": {"high": {"code": "HCC 21", "description": "Hyperthyroidism"}},
-            "thyroxine": {"high": {"code": "HCC 21", "description": "Hyperthyroidism"}},
-            
-            # Electrolytes
-            "sodium": {
-                "high": {"code": "HCC 22", "description": "Metabolic Disorders"},
-                "low": {"code": "HCC 22", "description": "Metabolic Disorders"}
-            },
-            "na": {
-                "high": {"code": "HCC 22", "description": "Metabolic Disorders"},
-                "low": {"code": "HCC 22", "description": "Metabolic Disorders"}
-            },
-            "potassium": {
-                "high": {"code": "HCC 22", "description": "Metabolic Disorders"},
-                "low": {"code": "HCC 22", "description": "Metabolic Disorders"}
-            },
-            "k": {
-                "high": {"code": "HCC 22", "description": "Metabolic Disorders"},
-                "low": {"code": "HCC 22", "description": "Metabolic Disorders"}
-            },
-            "calcium": {
-                "high": {"code": "HCC 22", "description": "Metabolic Disorders"},
-                "low": {"code": "HCC 22", "description": "Metabolic Disorders"}
-            },
-            "ca": {
-                "high": {"code": "HCC 22", "description": "Metabolic Disorders"},
-                "low": {"code": "HCC 22", "description": "Metabolic Disorders"}
-            },
-            "chloride": {
-                "high": {"code": "HCC 22", "description": "Metabolic Disorders"},
-                "low": {"code": "HCC 22", "description": "Metabolic Disorders"}
-            },
-            "cl": {
-                "high": {"code": "HCC 22", "description": "Metabolic Disorders"},
-                "low": {"code": "HCC 22", "description": "Metabolic Disorders"}
-            },
-            "bicarbonate": {
-                "high": {"code": "HCC 22", "description": "Metabolic Disorders"},
-                "low": {"code": "HCC 22", "description": "Metabolic Disorders"}
-            },
-            "co2": {
-                "high": {"code": "HCC 22", "description": "Metabolic Disorders"},
-                "low": {"code": "HCC 22", "description": "Metabolic Disorders"}
-            },
-            "magnesium": {
-                "high": {"code": "HCC 22", "description": "Metabolic Disorders"},
-                "low": {"code": "HCC 22", "description": "Metabolic Disorders"}
-            },
-            "mg": {
-                "high": {"code": "HCC 22", "description": "Metabolic Disorders"},
-                "low": {"code": "HCC 22", "description": "Metabolic Disorders"}
-            },
-            "phosphorus": {
-                "high": {"code": "HCC 22", "description": "Metabolic Disorders"},
-                "low": {"code": "HCC 22", "description": "Metabolic Disorders"}
-            },
-            "phos": {
-                "high": {"code": "HCC 22", "description": "Metabolic Disorders"},
-                "low": {"code": "HCC 22", "description": "Metabolic Disorders"}
-            },
-            
-            # Nutritional factors
-            "vitamin d": {"low": {"code": "HCC 22", "description": "Metabolic Disorders"}},
-            "25-oh": {"low": {"code": "HCC 22", "description": "Metabolic Disorders"}},
-            "vitamin b12": {"low": {"code": "HCC 21", "description": "Nutritional Deficiency"}},
-            "folate": {"low": {"code": "HCC 21", "description": "Nutritional Deficiency"}},
-            "folic": {"low": {"code": "HCC 21", "description": "Nutritional Deficiency"}},
-            "ferritin": {
-                "high": {"code": "HCC 22", "description": "Metabolic Disorders"},
-                "low": {"code": "HCC 2", "description": "Sepsis, Severe Blood Related Conditions"}
-            },
-            "iron": {"low": {"code": "HCC 2", "description": "Sepsis, Severe Blood Related Conditions"}},
-            "transferrin": {"low": {"code": "HCC 2", "description": "Sepsis, Severe Blood Related Conditions"}},
-            
-            # Other important lab values
-            "troponin": {"high": {"code": "HCC 86", "description": "Acute Myocardial Infarction"}},
-            "trp": {"high": {"code": "HCC 86", "description": "Acute Myocardial Infarction"}},
-            "bnp": {"high": {"code": "HCC 85", "description": "Congestive Heart Failure"}},
-            "brain natriuretic peptide": {"high": {"code": "HCC 85", "description": "Congestive Heart Failure"}},
-            "nt-probnp": {"high": {"code": "HCC 85", "description": "Congestive Heart Failure"}},
-            "crp": {"high": {"code": "HCC 2", "description": "Sepsis, Severe Blood Related Conditions"}},
-            "c-reactive protein": {"high": {"code": "HCC 2", "description": "Sepsis, Severe Blood Related Conditions"}},
-            "esr": {"high": {"code": "HCC 40", "description": "Rheumatoid Arthritis and Inflammatory Connective Tissue Disease"}},
-            "erythrocyte sedimentation rate": {"high": {"code": "HCC 40", "description": "Rheumatoid Arthritis and Inflammatory Connective Tissue Disease"}},
-            "psa": {"high": {"code": "HCC 12", "description": "Breast, Prostate, Colorectal and Other Cancers and Tumors"}},
-            "prostate specific antigen": {"high": {"code": "HCC 12", "description": "Breast, Prostate, Colorectal and Other Cancers and Tumors"}},
-            "albumin": {"low": {"code": "HCC 22", "description": "Metabolic Disorders"}},
-            "alb": {"low": {"code": "HCC 22", "description": "Metabolic Disorders"}},
-            "protein": {"low": {"code": "HCC 21", "description": "Protein-Calorie Malnutrition"}},
-            "inr": {"high": {"code": "HCC 28", "description": "Cirrhosis of Liver"}},
-            "international normalized ratio": {"high": {"code": "HCC 28", "description": "Cirrhosis of Liver"}},
-            "pt": {"high": {"code": "HCC 28", "description": "Cirrhosis of Liver"}},
-            "prothrombin time": {"high": {"code": "HCC 28", "description": "Cirrhosis of Liver"}},
-            "ptt": {"high": {"code": "HCC 28", "description": "Cirrhosis of Liver"}},
-            "partial thromboplastin time": {"high": {"code": "HCC 28", "description": "Cirrhosis of Liver"}}
-        }
+        if hcc_mapping is None:
+            hcc_mapping = get_hcc_codes()
         
         # Map medical terms to HCC codes
         mapped_codes = []
@@ -235,9 +519,11 @@ def map_to_hcc_codes(medical_terms):
         mapped_terms = set()
         
         for term_data in medical_terms:
-            original_term = term_data["term"]
-            category = term_data["category"]
-            term = original_term.lower()
+            # Negated, hypothetical and family-history mentions are not coded
+            if term_data.get("assertion") in SKIPPED_ASSERTIONS:
+                continue
+            
+            term = term_data["term"].lower()
             
             # Skip if we've already mapped this exact term
             if term in mapped_terms:
@@ -246,140 +532,8 @@ def map_to_hcc_codes(medical_terms):
             # Add to tracked terms
             mapped_terms.add(term)
             
-            # Initialize the matched flag for this term
-            matched = False
-            
-            # Special handling for ICD codes - direct mapping
-            if category == "ICD CODE":
-                mapped_codes.append({
-                    "term": original_term,
-                    "hcc_code": "ICD: " + term,
-                    "description": "ICD Code",
-                    "confidence": "high"
-                })
-                continue
-            
-            # Special handling for lab values with abnormal results
-            if category in ["LAB VALUE", "ABNORMAL LAB"]:
-                # Extract lab test name and status
-                lab_parts = term.split(":")
-                if len(lab_parts) > 0:
-                    lab_name = lab_parts[0].strip().lower()
-                    
-                    # Get lab value and unit if available
-                    lab_value_info = lab_parts[1].strip() if len(lab_parts) > 1 else ""
-                    
-                    # Determine if high or low
-                    status = "normal"
-                    # First check explicit labels
-                    if "high" in term.lower() or "elevated" in term.lower() or "above range" in term.lower() or "h)" in term.lower() or "(h" in term.lower():
-                        status = "high"
-                    elif "low" in term.lower() or "decreased" in term.lower() or "below range" in term.lower() or "l)" in term.lower() or "(l" in term.lower():
-                        status = "low"
-                    elif category == "ABNORMAL LAB":  # If marked as abnormal but no direction specified
-                        status = "abnormal"
-                    
-                    # Check if we have a mapping for this lab test
-                    for lab_key in lab_test_mappings:
-                        if lab_key in lab_name:
-                            if status == "high" and "high" in lab_test_mappings[lab_key]:
-                                code_data = lab_test_mappings[lab_key]["high"]
-                                mapped_codes.append({
-                                    "term": original_term,
-                                    "hcc_code": code_data["code"],
-                                    "description": code_data["description"],
-                                    "confidence": "medium"
-                                })
-                                matched = True
-                                break
-                            elif status == "low" and "low" in lab_test_mappings[lab_key]:
-                                code_data = lab_test_mappings[lab_key]["low"]
-                                mapped_codes.append({
-                                    "term": original_term,
-                                    "hcc_code": code_data["code"],
-                                    "description": code_data["description"],
-                                    "confidence": "medium"
-                                })
-                                matched = True
-                                break
-                            elif status == "abnormal" and ("high" in lab_test_mappings[lab_key] or "low" in lab_test_mappings[lab_key]):
-                                # If marked abnormal but no direction, use the first available mapping
-                                code_data = next(iter(lab_test_mappings[lab_key].values()))
-                                mapped_codes.append({
-                                    "term": original_term,
-                                    "hcc_code": code_data["code"],
-                                    "description": code_data["description"],
-                                    "confidence": "low"  # Lower confidence since we don't know if high or low
-                                })
-                                matched = True
-                                break
-                
-                # If we've already matched a lab value, continue to the next term
-                if matched:
-                    continue
-            
-            # Enhanced category-based mapping for more accurate results
-            confidence_level = "medium"
-            
-            # Adjust confidence based on category
-            if category in ["CHRONIC CONDITION", "DIAGNOSTIC FINDING"]:
-                confidence_level = "high"
-            elif category in ["MEDICATION", "PROCEDURE", "SERVICE DATE"]:
-                confidence_level = "low"
-                
-            # For non-lab values or unmatched lab values, continue with regular mapping
-            matched = False
-            
-            # Try direct mapping first - highest confidence
-            if term in hcc_mapping:
-                code_data = hcc_mapping[term]
-                mapped_codes.append({
-                    "term": original_term,
-                    "hcc_code": code_data["code"],
-                    "description": code_data["description"],
-                    "confidence": "high"
-                })
-                continue
-            
-            # Try exact word matching for better accuracy
-            term_words = set(term.split())
-            for key, code_data in hcc_mapping.items():
-                key_words = set(key.split())
-                # If all words in the dictionary key are in the term, it's a strong match
-                if key_words.issubset(term_words):
-                    mapped_codes.append({
-                        "term": original_term,
-                        "hcc_code": code_data["code"],
-                        "description": code_data["description"],
-                        "confidence": confidence_level
-                    })
-                    matched = True
-                    break
-                    
-            if matched:
-                continue
-                
-            # Try partial matching as a last resort
-            for key, code_data in hcc_mapping.items():
-                # Check if the key is contained within the term or term is contained within the key
-                if key in term or term in key:
-                    mapped_codes.append({
-                        "term": original_term,
-                        "hcc_code": code_data["code"],
-                        "description": code_data["description"],
-                        "confidence": "low"  # Lower confidence for partial matches
-                    })
-                    matched = True
-                    break
-            
-            # If no match is found
-            if not matched:
-                mapped_codes.append({
-                    "term": original_term,
-                    "hcc_code": "Unknown",
-                    "description": "No matching HCC code found",
-                    "confidence": "low"
-                })
+            code = _map_term(term_data["term"], term_data["category"], hcc_mapping)
+            mapped_codes.append(_adjust_confidence(code, term_data))
         
         # Sort mapped codes by confidence level
         mapped_codes.sort(key=lambda x: 0 if x["confidence"] == "high" else 1 if x["confidence"] == "medium" else 2)
@@ -0,0 +1,204 @@
+import cv2
+import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Kernel sizes below are tuned for 300 DPI pages and scaled for other sizes
+REFERENCE_PAGE_WIDTH = 2550  # 8.5 in at 300 DPI
+
+# Regions smaller than this (in pixels at the reference size) are specks or noise
+MIN_REGION_AREA = 400
+
+# Fraction of inked pixels below which a region is treated as blank
+BLANK_INK_DENSITY = 0.02
+
+# Fraction of inked pixels above which a region is a logo, photo or shading
+GRAPHIC_INK_DENSITY = 0.45
+
+# Minimum number of ruling-line pixels (relative to region perimeter) for a table
+TABLE_LINE_RATIO = 0.5
+
+# Maximum share of a table's ink in its ruling lines. Solid fills and thick
+# frames survive the line opening almost entirely, real tables hold text.
+TABLE_MAX_LINE_FRACTION = 0.6
+
+# Share of the page's text width a lone region must cover to count as spanning
+# the columns (a header or footer) rather than sitting in one of them
+SPANNING_REGION_SHARE = 0.6
+
+def _scaled(value, scale, minimum=1):
+    return max(int(round(value * scale)), minimum)
+
+def _table_mask(inverted, scale):
+    """
+    Find the horizontal and vertical ruling lines of tables
+
+    Args:
+        inverted: Binary page with ink as white (255) on black
+        scale: Page size relative to REFERENCE_PAGE_WIDTH
+
+    Returns:
+        Binary mask of the ruling lines
+    """
+    horizontal_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (_scaled(80, scale), 1))
+    vertical_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (1, _scaled(40, scale)))
+    horizontal = cv2.morphologyEx(inverted, cv2.MORPH_OPEN, horizontal_kernel)
+    vertical = cv2.morphologyEx(inverted, cv2.MORPH_OPEN, vertical_kernel)
+    return cv2.bitwise_or(horizontal, vertical)
+
+def _classify_region(inverted, lines, x, y, w, h, scale):
+    region = inverted[y:y + h, x:x + w]
+    area = w * h
+    ink_pixels = cv2.countNonZero(region)
+    density = ink_pixels / area
+
+    if density < BLANK_INK_DENSITY:
+        return "blank"
+
+    # Filled boxes and shading are all ruling lines to the table mask, so
+    # they are sorted out first
+    if density > GRAPHIC_INK_DENSITY:
+        return "graphic"
+
+    # Ruled tables: enough horizontal/vertical line pixels inside the box,
+    # with text between them
+    line_pixels = cv2.countNonZero(lines[y:y + h, x:x + w])
+    if line_pixels > TABLE_LINE_RATIO * 2 * (w + h) and line_pixels < TABLE_MAX_LINE_FRACTION * ink_pixels:
+        return "table"
+
+    # Text is many small glyphs of similar height; logos and signatures are
+    # a handful of large strokes
+    _, _, stats, _ = cv2.connectedComponentsWithStats(region, connectivity=8)
+    glyph_heights = stats[1:, cv2.CC_STAT_HEIGHT]
+    glyph_heights = glyph_heights[glyph_heights > _scaled(4, scale)]
+    if len(glyph_heights) < 3:
+        return "graphic"
+    median_height = float(np.median(glyph_heights))
+    if median_height > _scaled(90, scale):
+        return "graphic"
+
+    # Borderless tables: several tall text lines with wide column gaps
+    empty_columns = (np.count_nonzero(region, axis=0) == 0).astype(np.int8)
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], empty_columns, [0]))))
+    run_lengths = edges[1::2] - edges[::2]
+    gaps = np.count_nonzero(run_lengths >= _scaled(60, scale))
+    if gaps >= 2 and h > 4 * median_height:
+        return "table"
+
+    if h < 2.5 * median_height:
+        return "line"
+    return "text"
+
+def _split_at_gaps(regions, axis):
+    """Group regions whose extents overlap along an axis (0 for x, 1 for y)"""
+    groups = []
+    end = None
+    for region in sorted(regions, key=lambda region: region["bbox"][axis]):
+        start, length = region["bbox"][axis], region["bbox"][axis + 2]
+        if groups and start < end:
+            groups[-1].append(region)
+            end = max(end, start + length)
+        else:
+            groups.append([region])
+            end = start + length
+    return groups
+
+def _reading_order(regions):
+    """
+    Order regions for reading, a column at a time
+
+    Regions are first grouped into columns at the vertical gaps between
+    them, and each column is read to its end before the next one starts.
+    Where something spans the columns, such as a header, the page is cut
+    into horizontal strips around it and the part between is ordered
+    column by column again.
+
+    Args:
+        regions: Region dictionaries with a bbox
+
+    Returns:
+        The regions in reading order
+    """
+    if len(regions) <= 1:
+        return regions
+
+    columns = _split_at_gaps(regions, 0)
+    if len(columns) > 1:
+        return [region for column in columns for region in _reading_order(column)]
+
+    strips = _split_at_gaps(regions, 1)
+    if len(strips) == 1:
+        # Nothing separates the regions either way: top to bottom, then left to right
+        return sorted(regions, key=lambda region: (region["bbox"][1], region["bbox"][0]))
+
+    # Strips of one wide region set off a section; the strips between them
+    # keep together so their columns can be found
+    left = min(region["bbox"][0] for region in regions)
+    right = max(region["bbox"][0] + region["bbox"][2] for region in regions)
+    sections = []
+    for strip in strips:
+        strip_left = min(region["bbox"][0] for region in strip)
+        strip_right = max(region["bbox"][0] + region["bbox"][2] for region in strip)
+        wide = (
+            len(_split_at_gaps(strip, 0)) == 1
+            and strip_right - strip_left >= SPANNING_REGION_SHARE * (right - left)
+        )
+        if wide or not sections or sections[-1][0]:
+            sections.append((wide, list(strip)))
+        else:
+            sections[-1][1].extend(strip)
+    if len(sections) == 1:
+        sections = [(False, strip) for strip in strips]
+    return [region for _, section in sections for region in _reading_order(section)]
+
+def detect_regions(image):
+    """
+    Segment a preprocessed page into text, table and graphic regions
+
+    Args:
+        image: Binarized page as a numpy array (dark text on white)
+
+    Returns:
+        List of region dictionaries with kind ("text", "line", "table" or
+        "graphic") and bbox (x, y, width, height), in reading order.
+        Blank regions are dropped.
+    """
+    try:
+        height, width = image.shape[:2]
+        scale = width / REFERENCE_PAGE_WIDTH
+        inverted = cv2.bitwise_not(image)
+
+        lines = _table_mask(inverted, scale)
+
+        # Smear glyphs into words and words into blocks, joining more
+        # horizontally than vertically so neighbouring columns stay apart
+        block_kernel = cv2.getStructuringElement(
+            cv2.MORPH_RECT, (_scaled(45, scale), _scaled(18, scale))
+        )
+        smeared = cv2.dilate(cv2.bitwise_or(inverted, lines), block_kernel, iterations=1)
+        contours, _ = cv2.findContours(smeared, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+        min_area = MIN_REGION_AREA * scale * scale
+        regions = []
+        for contour in contours:
+            x, y, w, h = cv2.boundingRect(contour)
+            if w * h < min_area:
+                continue
+            kind = _classify_region(inverted, lines, x, y, w, h, scale)
+            if kind == "blank":
+                continue
+            regions.append({"kind": kind, "bbox": (x, y, w, h)})
+
+        regions = _reading_order(regions)
+
+        logger.debug(
+            f"Layout analysis found {len(regions)} regions: "
+            + ", ".join(f"{kind}={sum(1 for r in regions if r['kind'] == kind)}"
+                        for kind in ("text", "line", "table", "graphic"))
+        )
+        return regions
+
+    except Exception as e:
+        logger.error(f"Error during layout analysis: {str(e)}")
+        raise
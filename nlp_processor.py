@@ -1,19 +1,45 @@
 import logging
-import spacy
-import re
+import os
+import threading
+from bisect import bisect_right
+
+from context_detector import detect_assertion, stronger_assertion, UNASSERTED_CATEGORIES
+from fuzzy_matcher import SymSpellIndex, pattern_literals, find_fuzzy_matches
+from hcc_mapper import get_hcc_codes
+from profiler import stage
+from regex_engine import finditer
+from resource_limits import Deadline, warn, limit_text, SPACY_CHUNK_LENGTH
 
 logger = logging.getLogger(__name__)
 
-# Load the spaCy model
-try:
-    nlp = spacy.load("en_core_web_sm")
-    logger.debug("Loaded spaCy model: en_core_web_sm")
-except OSError:
-    logger.warning("Default spaCy model not found, downloading...")
-    from spacy.cli import download
-    download("en_core_web_sm")
-    nlp = spacy.load("en_core_web_sm")
-    logger.debug("Downloaded and loaded spaCy model: en_core_web_sm")
+# spaCy model, loaded on first use so workers start without paying for it
+_nlp = None
+_nlp_lock = threading.Lock()
+
+def _get_nlp():
+    """
+    Get the spaCy pipeline, loading the model on first use
+    
+    Returns:
+        The loaded en_core_web_sm pipeline
+    """
+    global _nlp
+    with _nlp_lock:
+        if _nlp is None:
+            import spacy
+            try:
+                _nlp = spacy.load("en_core_web_sm")
+                logger.debug("Loaded spaCy model: en_core_web_sm")
+            except OSError:
+                logger.warning("Default spaCy model not found, downloading...")
+                from spacy.cli import download
+                download("en_core_web_sm")
+                _nlp = spacy.load("en_core_web_sm")
+                logger.debug("Downloaded and loaded spaCy model: en_core_web_sm")
+        return _nlp
+
+# Look for OCR-damaged spellings of known terms (see fuzzy_matcher)
+FUZZY_MATCHING = os.environ.get("FUZZY_MATCHING", "1") != "0"
 
 # Medical terminology patterns
 # Comprehensive list of medical terms for document processing
@@ -193,17 +219,17 @@ MEDICAL_TERMS_PATTERNS = [
     r"(?i)hysterectomy",
     
     # Common medications by category/suffix
-    r"(?i)\w+(?:mab|zumab|ximab|mumab)",  # Monoclonal antibodies
-    r"(?i)\w+(?:olol)",  # Beta blockers
-    r"(?i)\w+(?:sartan)",  # ARBs
-    r"(?i)\w+(?:pril)",  # ACE inhibitors
-    r"(?i)\w+(?:statin)",  # Statins
-    r"(?i)\w+(?:dipine)",  # Calcium channel blockers
-    r"(?i)\w+(?:methasone|sone|olone)",  # Corticosteroids
-    r"(?i)\w+(?:cycline)",  # Tetracycline antibiotics
-    r"(?i)\w+(?:mycin)",  # Macrolide antibiotics
-    r"(?i)\w+(?:floxacin)",  # Quinolone antibiotics
-    r"(?i)\w+(?:prazole)",  # Proton pump inhibitors
+    r"(?i)\b\w+(?:mab|zumab|ximab|mumab)",  # Monoclonal antibodies
+    r"(?i)\b\w+(?:olol)",  # Beta blockers
+    r"(?i)\b\w+(?:sartan)",  # ARBs
+    r"(?i)\b\w+(?:pril)",  # ACE inhibitors
+    r"(?i)\b\w+(?:statin)",  # Statins
+    r"(?i)\b\w+(?:dipine)",  # Calcium channel blockers
+    r"(?i)\b\w+(?:methasone|sone|olone)",  # Corticosteroids
+    r"(?i)\b\w+(?:cycline)",  # Tetracycline antibiotics
+    r"(?i)\b\w+(?:mycin)",  # Macrolide antibiotics
+    r"(?i)\b\w+(?:floxacin)",  # Quinolone antibiotics
+    r"(?i)\b\w+(?:prazole)",  # Proton pump inhibitors
     r"(?i)warfarin|coumadin",
     r"(?i)heparin",
     r"(?i)aspirin",
@@ -247,12 +273,137 @@ MEDICAL_TERMS_PATTERNS = [
     r"(?i)necrosis",
 ]
 
-def extract_medical_terms(text):
+# Dictionaries to map pattern types to categories
+PATTERN_CATEGORIES = {
+    # Indices for relevant pattern ranges (mapping group of patterns to categories)
+    (0, 92): "CHRONIC CONDITION",       # Chronic conditions (0-92)
+    (93, 138): "LAB TEST",              # Lab test names (93-138)
+    (139, 171): "DIAGNOSTIC FINDING",    # Diagnostic findings (139-171)
+    (172, 193): "PROCEDURE",            # Procedures (172-193)
+    (194, 215): "MEDICATION",           # Medications (194-215)
+    (216, 235): "IMAGING FINDING",      # Imaging findings (216-235)
+    (236, 247): "PATHOLOGY FINDING"     # Pathology findings (236-247)
+}
+
+def _pattern_category(pattern_idx):
+    for (start, end), category in PATTERN_CATEGORIES.items():
+        if start <= pattern_idx <= end:
+            return category
+    return "CONDITION"  # Default category
+
+# Fuzzy index over the HCC keys and the pattern vocabulary, rebuilt when the
+# HCC table is reloaded
+_fuzzy_index = {"source": None, "index": None}
+_fuzzy_index_lock = threading.Lock()
+
+def build_fuzzy_index(hcc_mapping):
+    """
+    Build the symmetric-delete index over the pattern vocabulary and HCC keys
+    
+    Args:
+        hcc_mapping: HCC codes mapping
+    
+    Returns:
+        SymSpellIndex mapping vocabulary phrases to their category
+    """
+    index = SymSpellIndex()
+    for pattern_idx, pattern in enumerate(MEDICAL_TERMS_PATTERNS):
+        for phrase in pattern_literals(pattern):
+            index.add(phrase, _pattern_category(pattern_idx))
+    for key in hcc_mapping:
+        index.add(key, "CHRONIC CONDITION")
+    logger.debug(f"Built fuzzy index over {len(index.entries)} phrases")
+    return index
+
+def prime_fuzzy_index(hcc_mapping, index):
+    """
+    Install a fuzzy index that was built ahead of time for an HCC table
+    
+    Args:
+        hcc_mapping: HCC codes mapping the index was built from
+        index: SymSpellIndex from build_fuzzy_index
+    """
+    with _fuzzy_index_lock:
+        _fuzzy_index["source"] = hcc_mapping
+        _fuzzy_index["index"] = index
+
+def get_fuzzy_index():
+    """
+    Get the symmetric-delete index used for OCR-tolerant matching
+    
+    Returns:
+        SymSpellIndex mapping vocabulary phrases to their category
+    """
+    hcc_mapping = get_hcc_codes()
+    with _fuzzy_index_lock:
+        if _fuzzy_index["source"] is not hcc_mapping:
+            _fuzzy_index["index"] = build_fuzzy_index(hcc_mapping)
+            _fuzzy_index["source"] = hcc_mapping
+        return _fuzzy_index["index"]
+
+def _span_confidence(ocr_words, word_starts, start, end):
+    """
+    Get the lowest OCR confidence of the words overlapping a text span
+    
+    Args:
+        ocr_words: OCR words with their character offsets, sorted by offset
+        word_starts: Start offsets of ocr_words, for binary search
+        start: Start offset of the span
+        end: End offset of the span
+    
+    Returns:
+        Lowest word confidence, or None if no OCR word overlaps the span
+    """
+    index = max(bisect_right(word_starts, start) - 1, 0)
+    confidences = []
+    while index < len(ocr_words) and ocr_words[index]["start"] < end:
+        if ocr_words[index]["end"] > start:
+            confidences.append(ocr_words[index]["confidence"])
+        index += 1
+    return min(confidences) if confidences else None
+
+def _text_chunks(text, size):
+    """Split text into pieces of at most size characters, preferably at line breaks"""
+    start = 0
+    while start < len(text):
+        end = start + size
+        if end < len(text):
+            cut = text.rfind("\n", start, end)
+            if cut <= start:
+                cut = text.rfind(" ", start, end)
+            if cut > start:
+                end = cut + 1
+        yield start, text[start:end]
+        start = end
+
+def _spacy_entities(text):
+    """
+    Run spaCy over the text in SPACY_CHUNK_LENGTH pieces
+
+    Only the entities are kept, so a parsed piece is freed before the next
+    one is parsed and memory stays bounded however long the text is.
+
+    Returns:
+        Generator of (text, label, start, end) tuples with offsets into text
+    """
+    nlp = _get_nlp()
+    for offset, chunk in _text_chunks(text, SPACY_CHUNK_LENGTH):
+        for ent in nlp(chunk).ents:
+            yield ent.text, ent.label_, offset + ent.start_char, offset + ent.end_char
+
+def extract_medical_terms(text, ocr_words=None, fuzzy=FUZZY_MATCHING, warnings=None):
     """
     Extract medical terminology from the extracted text
     
     Args:
         text: The text extracted from the document
+        ocr_words: Optional OCR words with character offsets and confidences,
+            as returned by perform_ocr_with_confidence. When given, every
+            term carries the lowest confidence of the words it spans.
+        fuzzy: Also look for OCR-damaged spellings of known terms
+        warnings: Optional list collecting degradation warnings. Text over
+            MAX_TEXT_LENGTH is truncated, and pattern matching stops early
+            once the extraction time budget is used up.
     
     Returns:
         List of identified medical terms
@@ -260,51 +411,75 @@ def extract_medical_terms(text):
     try:
         logger.debug("Starting medical term extraction")
         
-        # Process the text with spaCy
-        doc = nlp(text)
+        deadline = Deadline("extraction")
+        text = limit_text(text, warnings)
+        
+        # Process the text with spaCy, a piece at a time
+        with stage("extraction.spacy"):
+            entities = list(_spacy_entities(text))
         
         # Extract medical terms using pattern matching
         medical_terms = []
         
-        # Use spaCy's entity recognition
-        for ent in doc.ents:
-            if ent.label_ in ["DISEASE", "CONDITION", "DIAGNOSIS"]:
-                medical_terms.append({
-                    "term": ent.text,
-                    "category": ent.label_,
-                    "source": "spaCy NER"
-                })
+        # Terms already reported, so the same text is only listed once
+        seen_terms = {}
+        word_starts = [word["start"] for word in ocr_words] if ocr_words else []
+        
+        # Characters already matched exactly, so fuzzy matching skips them
+        covered = bytearray(len(text)) if fuzzy else None
         
-        # Dictionaries to map pattern types to categories
-        pattern_categories = {
-            # Indices for relevant pattern ranges (mapping group of patterns to categories)
-            (0, 92): "CHRONIC CONDITION",       # Chronic conditions (0-92)
-            (93, 138): "LAB TEST",              # Lab test names (93-138)
-            (139, 171): "DIAGNOSTIC FINDING",    # Diagnostic findings (139-171)
-            (172, 193): "PROCEDURE",            # Procedures (172-193)
-            (194, 215): "MEDICATION",           # Medications (194-215)
-            (216, 235): "IMAGING FINDING",      # Imaging findings (216-235)
-            (236, 247): "PATHOLOGY FINDING"     # Pathology findings (236-247)
-        }
+        def add_term(term, category, source, start, end, dedupe=False, extra=None):
+            if covered is not None and source != "fuzzy match":
+                covered[start:end] = b"\x01" * (end - start)
+            
+            # Negated, historical, hypothetical and family mentions are tagged;
+            # affirmed mentions carry no assertion key
+            assertion = "present"
+            if category not in UNASSERTED_CATEGORIES:
+                existing = seen_terms.get(term) if dedupe else None
+                if existing is not None and "assertion" not in existing:
+                    return
+                assertion = detect_assertion(text, start, end)
+                if existing is not None:
+                    # A later mention can only strengthen the earlier one
+                    assertion = stronger_assertion(existing["assertion"], assertion)
+                    if assertion == "present":
+                        del existing["assertion"]
+                    else:
+                        existing["assertion"] = assertion
+                    return
+            elif dedupe and term in seen_terms:
+                return
+            
+            term_data = {"term": term, "category": category, "source": source}
+            if extra:
+                term_data.update(extra)
+            if assertion != "present":
+                term_data["assertion"] = assertion
+            if ocr_words:
+                ocr_confidence = _span_confidence(ocr_words, word_starts, start, end)
+                if ocr_confidence is not None:
+                    term_data["ocr_confidence"] = ocr_confidence
+            medical_terms.append(term_data)
+            seen_terms.setdefault(term, term_data)
+        
+        # Use spaCy's entity recognition
+        for ent_text, label, start, end in entities:
+            if label in ["DISEASE", "CONDITION", "DIAGNOSIS"]:
+                add_term(ent_text, label, "spaCy NER", start, end)
         
         # Use regex patterns for additional medical term extraction
         for pattern_idx, pattern in enumerate(MEDICAL_TERMS_PATTERNS):
             # Determine the category based on pattern index
-            category = "CONDITION"  # Default category
-            for (start, end), cat in pattern_categories.items():
-                if start <= pattern_idx <= end:
-                    category = cat
-                    break
+            category = _pattern_category(pattern_idx)
+            
+            if deadline.expired():
+                warn(warnings, f"Term extraction time budget reached after {pattern_idx} of {len(MEDICAL_TERMS_PATTERNS)} patterns")
+                break
                     
-            matches = re.finditer(pattern, text)
+            matches = finditer(pattern, text, warnings=warnings)
             for match in matches:
-                term = match.group(0)
-                if term not in [item["term"] for item in medical_terms]:
-                    medical_terms.append({
-                        "term": term,
-                        "category": category,
-                        "source": "pattern matching"
-                    })
+                add_term(match.group(0), category, "pattern matching", match.start(), match.end(), dedupe=True)
         
         # Enhanced medication extraction
         # Common medication names and classes that might not be caught by suffixes
@@ -332,32 +507,20 @@ def extract_medical_terms(text):
         ]
         
         for med in common_meds:
-            for match in re.finditer(med, text):
-                term = match.group(0)
-                if term not in [item["term"] for item in medical_terms]:
-                    medical_terms.append({
-                        "term": term,
-                        "category": "MEDICATION",
-                        "source": "medication list"
-                    })
+            for match in finditer(med, text, warnings=warnings):
+                add_term(match.group(0), "MEDICATION", "medication list", match.start(), match.end(), dedupe=True)
         
         # Extract medication mentions by typical drug name suffixes
         medication_pattern = r"(?i)\b[A-Za-z]+(?:mab|zumab|ximab|mumab|olone|statin|sartan|pril|oxacin|cycline|prazole|dipine|kain|ide|barb|azole|micin|parib|tinib|afil|azine|asone|tadine|olam|pam)\b"
-        for match in re.finditer(medication_pattern, text):
-            term = match.group(0)
-            if term not in [item["term"] for item in medical_terms]:
-                medical_terms.append({
-                    "term": term,
-                    "category": "MEDICATION",
-                    "source": "medication suffix"
-                })
+        for match in finditer(medication_pattern, text, warnings=warnings):
+            add_term(match.group(0), "MEDICATION", "medication suffix", match.start(), match.end(), dedupe=True)
         
         # Extract lab values with abnormal markers or values - common in blood reports
         # Enhanced pattern to capture more lab test names and formats
         lab_value_pattern = r"(?i)(hemoglobin|hematocrit|hgb|hct|rbc|wbc|platelets?|plt|glucose|glu|cholesterol|triglycerides?|hdl|ldl|a1c|hba1c|creatinine|cre|bun|egfr|alt|ast|ggt|alp|bilirubin|bili|albumin|alb|protein|tsh|t[34]|sodium|na|potassium|k|chloride|cl|bicarbonate|co2|calcium|ca|phosphorus|phos|magnesium|mg|ferritin|iron|transferrin|vitamin\s*d|25-oh|vitamin\s*b12|folate|folic|inr|pt|ptt|troponin|trp|bnp|nt-probnp|crp|esr|psa|hcg|cbc|cmp)\s*:?\s*(?:<|>|≤|≥)?\s*(\d+\.?\d*)\s*([a-z%/\-]+)?\s*(?:\(?(high|low|h|l|abnormal|outside\s*reference|above\s*range|below\s*range|elevated|decreased|normal)\)?)??"
         
         # This will capture lab tests with values
-        for match in re.finditer(lab_value_pattern, text):
+        for match in finditer(lab_value_pattern, text, warnings=warnings):
             lab_name = match.group(1).strip()
             lab_value = match.group(2)
             unit = match.group(3) if match.group(3) else ""
@@ -370,30 +533,23 @@ def extract_medical_terms(text):
             status_lower = status.lower() if status else ""
             category = "ABNORMAL LAB" if status_lower in ['high', 'low', 'h', 'l', 'abnormal', 'outside reference', 'above range', 'below range', 'elevated', 'decreased'] else "LAB VALUE"
             
-            medical_terms.append({
-                "term": term,
-                "category": category,
-                "source": "lab value extraction"
-            })
+            add_term(term, category, "lab value extraction", match.start(), match.end())
         
         # Look for ranges in the format "Reference Range: 4.0-10.0"
         range_pattern = r"(?i)(reference|normal)\s+range[:\s]+(\d+\.?\d*)\s*[-–]\s*(\d+\.?\d*)"
-        for match in re.finditer(range_pattern, text):
-            medical_terms.append({
-                "term": f"Reference Range: {match.group(2)}-{match.group(3)}",
-                "category": "REFERENCE RANGE",
-                "source": "reference range extraction"
-            })
+        for match in finditer(range_pattern, text, warnings=warnings):
+            add_term(
+                f"Reference Range: {match.group(2)}-{match.group(3)}",
+                "REFERENCE RANGE",
+                "reference range extraction",
+                match.start(), match.end()
+            )
             
         # Extract ICD codes (often found in medical documents)
         icd_pattern = r"(?i)(?:ICD[-\s]?(?:9|10)[-\s]?(?:CM|PCS)?[-\s]?:?[-\s]?)?\b([A-Z]\d{1,2})\.?(\d{1,2})\b"
-        for match in re.finditer(icd_pattern, text):
+        for match in finditer(icd_pattern, text, warnings=warnings):
             code = f"{match.group(1)}.{match.group(2)}"
-            medical_terms.append({
-                "term": code,
-                "category": "ICD CODE",
-                "source": "ICD code extraction"
-            })
+            add_term(code, "ICD CODE", "ICD code extraction", match.start(), match.end())
             
         # Extract dates of service or examination dates
         date_patterns = [
@@ -403,12 +559,21 @@ def extract_medical_terms(text):
         ]
         
         for pattern in date_patterns:
-            for match in re.finditer(pattern, text):
-                medical_terms.append({
-                    "term": f"Service Date: {match.group(1)}",
-                    "category": "SERVICE DATE",
-                    "source": "date extraction"
-                })
+            for match in finditer(pattern, text, warnings=warnings):
+                add_term(f"Service Date: {match.group(1)}", "SERVICE DATE", "date extraction", match.start(), match.end())
+        
+        # Recover terms that OCR misspelled, e.g. "diabeles" or "hypertensi0n"
+        if fuzzy and not deadline.expired():
+            with stage("extraction.fuzzy"):
+                span_confidence = None
+                if ocr_words:
+                    span_confidence = lambda start, end: _span_confidence(ocr_words, word_starts, start, end)
+                fuzzy_matches = find_fuzzy_matches(text, get_fuzzy_index(), covered, span_confidence)
+            for start, end, phrase, distance, category in fuzzy_matches:
+                add_term(
+                    phrase, category, "fuzzy match", start, end, dedupe=True,
+                    extra={"ocr_text": text[start:end], "match_distance": distance}
+                )
             
         logger.debug(f"Extracted {len(medical_terms)} medical terms")
         return medical_terms
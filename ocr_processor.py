@@ -4,16 +4,90 @@ import logging
 import pytesseract
 from PIL import Image
 import fitz  # PyMuPDF
+import os
+import threading
+from warnings import catch_warnings, simplefilter
+from concurrent.futures import ThreadPoolExecutor
+
+from layout_analyzer import detect_regions
+from page_geometry import normalize_page
+from profiler import in_document_context
+from resource_limits import (
+    Deadline, warn, pdf_render_dpi, image_reduction_factor, MAX_PAGE_PIXELS, MAX_DECODE_PIXELS
+)
 
 logger = logging.getLogger(__name__)
 
-def preprocess_image(file_path, file_extension):
+# OpenCV flags that decode an image already downsampled by a power of two
+_REDUCED_READ_FLAGS = {
+    1: cv2.IMREAD_GRAYSCALE,
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+}
+
+# Correct rotation, skew and resolution before OCR (see page_geometry)
+PAGE_NORMALIZATION = os.environ.get("PAGE_NORMALIZATION", "1") != "0"
+
+# Widest page, in inches, that a resolution from image metadata may imply.
+# Phone photos often claim 72 DPI at 4000 px, which is not a real page size.
+MAX_PLAUSIBLE_PAGE_INCHES = 17
+
+def _image_size(file_path):
+    """
+    Read the pixel size, resolution and format from the image header without decoding it
+    
+    Returns:
+        Tuple of (width, height, dpi, format); dpi is None when the file does
+        not record a plausible resolution
+    """
+    # The governor in preprocess_image decides what is too large. PIL's own
+    # check is left in place (it is process-wide and shared with other
+    # threads); only its warning is silenced here.
+    try:
+        with catch_warnings():
+            simplefilter("ignore", Image.DecompressionBombWarning)
+            with Image.open(file_path) as image:
+                width, height = image.size
+                dpi = image.info.get("dpi", (None,))[0]
+                image_format = image.format
+    except Image.DecompressionBombError as e:
+        raise ValueError(f"Image too large to process: {str(e)}")
+    
+    if not dpi or dpi < 50 or width / dpi > MAX_PLAUSIBLE_PAGE_INCHES:
+        dpi = None
+    return width, height, dpi, image_format
+
+def count_pages(file_path, file_extension):
+    """
+    Count the pages of a document
+    
+    Args:
+        file_path: Path to the document
+        file_extension: File extension (pdf, jpg, png, etc.)
+    
+    Returns:
+        Number of pages; images have one
+    """
+    if file_extension != 'pdf':
+        return 1
+    with fitz.open(file_path) as pdf_document:
+        return pdf_document.page_count
+
+def preprocess_image(file_path, file_extension, warnings=None, page_number=0):
     """
     Preprocess the image to improve OCR results
     
+    Pages are kept within MAX_PAGE_PIXELS: large PDF pages are rendered at a
+    lower DPI and large images are decoded downsampled, with a warning added
+    to warnings instead of failing. Sideways and tilted pages are then
+    corrected and rescaled to TARGET_DPI.
+    
     Args:
         file_path: Path to the image file
         file_extension: File extension (pdf, jpg, png, etc.)
+        warnings: Optional list collecting degradation warnings
+        page_number: Page of a PDF to read, counting from 0
     
     Returns:
         Preprocessed image as a numpy array
@@ -25,11 +99,12 @@ def preprocess_image(file_path, file_extension):
             # Open the PDF file
             pdf_document = fitz.open(file_path)
             
-            # Get the first page
-            page = pdf_document[0]
+            # Get the requested page
+            page = pdf_document[page_number]
             
-            # Render the page as an image
-            pix = page.get_pixmap(matrix=fitz.Matrix(300/72, 300/72))
+            # Render the page as a grayscale image, at a DPI that fits the pixel budget
+            dpi = pdf_render_dpi(page.rect.width, page.rect.height, warnings)
+            pix = page.get_pixmap(matrix=fitz.Matrix(dpi/72, dpi/72), colorspace=fitz.csGRAY, alpha=False)
             
             # Convert to numpy array
             img = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.h, pix.w, pix.n)
@@ -37,13 +112,50 @@ def preprocess_image(file_path, file_extension):
             # Convert to grayscale if it's not already
             if pix.n > 1:
                 img = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+            else:
+                img = img.reshape(pix.h, pix.w)
         else:
             logger.debug(f"Processing image file: {file_extension}")
-            # Read the image
-            img = cv2.imread(file_path)
+            # Decode large images already downsampled, so the full-size
+            # bitmap is never held in memory
+            width, height, dpi, image_format = _image_size(file_path)
+            factor = image_reduction_factor(width, height)
+            # OpenCV only decodes JPEG at reduced size, and by 8x at most; other
+            # formats are decoded in full first. Whatever is decoded must fit
+            # the decode budget.
+            if image_format != "JPEG":
+                if width * height > MAX_DECODE_PIXELS:
+                    raise ValueError(
+                        f"{image_format or 'Image'} of {width} x {height} px is too large to process; "
+                        f"images over {MAX_DECODE_PIXELS} px must be JPEG"
+                    )
+                factor = 1
+            elif (width // factor) * (height // factor) > MAX_DECODE_PIXELS:
+                raise ValueError(
+                    f"JPEG of {width} x {height} px is too large to process, even decoded at 1/{factor} size"
+                )
+            if factor > 1:
+                warn(warnings, f"Large image ({width} x {height} px) downsampled by {factor}x")
             
-            # Convert to grayscale
-            img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+            # Read the image as grayscale
+            img = cv2.imread(file_path, _REDUCED_READ_FLAGS[factor])
+            if img is None:
+                raise ValueError(f"Could not read image file: {file_path}")
+            if dpi:
+                dpi /= factor
+        
+        # Whatever the decoder could not reduce enough is resized here
+        pixels = img.shape[0] * img.shape[1]
+        if pixels > MAX_PAGE_PIXELS:
+            scale = (MAX_PAGE_PIXELS / pixels) ** 0.5
+            warn(warnings, f"Page of {pixels} px resized by {scale:.2f} to fit the pixel budget")
+            img = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+            if dpi:
+                dpi *= scale
+        
+        # Turn the page upright, straighten it and bring it to TARGET_DPI
+        if PAGE_NORMALIZATION:
+            img = normalize_page(img, dpi, warnings)
         
         # Apply image enhancement techniques
         # Noise removal
@@ -64,29 +176,334 @@ def preprocess_image(file_path, file_extension):
         logger.error(f"Error during image preprocessing: {str(e)}")
         raise
 
-def perform_ocr(image):
+# Default Tesseract configuration for a full page
+OCR_CONFIG = r'--oem 3 --psm 6 -l eng'
+
+# Heavier configuration used to re-read low-confidence lines: LSTM engine only,
+# treating the crop as a single text line
+RECOVERY_OCR_CONFIG = r'--oem 1 --psm 7 -l eng'
+
+# Word confidence (0-100) below which a line is re-read
+LOW_CONFIDENCE_THRESHOLD = 60
+
+# Upscaling factor applied to low-confidence lines before re-reading them
+RECOVERY_SCALE = 2.0
+
+# Upper bound on re-read lines per page so a bad scan cannot multiply OCR time
+MAX_RECOVERY_LINES = 40
+
+# Per-region Tesseract configurations used after layout analysis
+REGION_OCR_CONFIGS = {
+    "text": r'--oem 3 --psm 6 -l eng',
+    "line": r'--oem 3 --psm 7 -l eng',
+    # Single column of variable-size text keeps each table row on one line
+    "table": r'--oem 3 --psm 4 -l eng',
+}
+
+# Region kinds whose column gaps are kept as runs of spaces in the text, so
+# cells of neighbouring columns do not read as one phrase
+SPACED_REGION_KINDS = {"table"}
+
+# Pool shared by all pages for OCR of individual regions. Tesseract runs as a
+# subprocess, so threads give real parallelism here.
+OCR_REGION_WORKERS = int(os.environ.get("OCR_REGION_WORKERS", os.cpu_count() or 4))
+_region_executor = ThreadPoolExecutor(max_workers=OCR_REGION_WORKERS, thread_name_prefix="ocr-region")
+
+class RecoveryBudget:
+    """Low-confidence line re-reads left for one page, shared by its regions"""
+    
+    def __init__(self, lines=None):
+        self.remaining = MAX_RECOVERY_LINES if lines is None else lines
+        self.skipped = False
+        self._lock = threading.Lock()
+    
+    def take(self):
+        """Claim one re-read; False once the page's budget is spent"""
+        with self._lock:
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            return True
+    
+    def skip(self, warnings):
+        """Warn, once per page, that the time budget cut re-reading short"""
+        with self._lock:
+            if self.skipped:
+                return
+            self.skipped = True
+        warn(warnings, "OCR time budget reached, skipped re-reading low-confidence lines")
+
+def _read_lines(image, config, deadline=None):
     """
-    Perform OCR on the preprocessed image
+    Run Tesseract on an image and group the recognized words into lines
+    
+    Args:
+        image: Image as a numpy array
+        config: Tesseract configuration string
+        deadline: Optional Deadline; Tesseract is stopped when it passes
+    
+    Returns:
+        List of lines, each a list of word dictionaries with text,
+        confidence and bounding box
+    """
+    timeout = 0
+    if deadline is not None:
+        timeout = deadline.remaining()
+        if timeout <= 0:
+            raise TimeoutError(f"{deadline.stage} stage exceeded {deadline.seconds:.0f}s")
+    
+    try:
+        data = pytesseract.image_to_data(
+            Image.fromarray(image), config=config, output_type=pytesseract.Output.DICT, timeout=timeout
+        )
+    except RuntimeError as e:
+        # pytesseract reports a killed Tesseract process as a RuntimeError
+        if "timeout" in str(e).lower():
+            raise TimeoutError(f"{deadline.stage} stage exceeded {deadline.seconds:.0f}s") from e
+        raise
+    
+    lines = {}
+    for i, word in enumerate(data["text"]):
+        confidence = float(data["conf"][i])
+        if not word.strip() or confidence < 0:
+            continue
+        key = (data["block_num"][i], data["par_num"][i], data["line_num"][i])
+        lines.setdefault(key, []).append({
+            "text": word,
+            "confidence": confidence,
+            "left": data["left"][i],
+            "top": data["top"][i],
+            "width": data["width"][i],
+            "height": data["height"][i],
+        })
+    
+    # Dictionaries keep insertion order, which is Tesseract's reading order
+    return [(key, words) for key, words in lines.items()]
+
+def _recover_line(image, words, deadline=None):
+    """
+    Re-read one line with the heavier OCR configuration
+    
+    Args:
+        image: Full preprocessed page image
+        words: Words of the line from the first pass
+    
+    Returns:
+        Replacement words if the re-read is more confident, otherwise None
+    """
+    padding = 4
+    left = max(min(word["left"] for word in words) - padding, 0)
+    top = max(min(word["top"] for word in words) - padding, 0)
+    right = min(max(word["left"] + word["width"] for word in words) + padding, image.shape[1])
+    bottom = min(max(word["top"] + word["height"] for word in words) + padding, image.shape[0])
+    
+    crop = image[top:bottom, left:right]
+    if crop.size == 0:
+        return None
+    
+    crop = cv2.resize(crop, None, fx=RECOVERY_SCALE, fy=RECOVERY_SCALE, interpolation=cv2.INTER_CUBIC)
+    crop = cv2.copyMakeBorder(crop, 10, 10, 10, 10, cv2.BORDER_CONSTANT, value=255)
+    
+    recovered = [word for _, line in _read_lines(crop, RECOVERY_OCR_CONFIG, deadline) for word in line]
+    if not recovered:
+        return None
+    
+    before = sum(word["confidence"] for word in words) / len(words)
+    after = sum(word["confidence"] for word in recovered) / len(recovered)
+    return recovered if after > before else None
+
+def _word_gap(previous, word, keep_spacing):
+    """Spaces between two words of a line: one, or the gap width in characters"""
+    if not keep_spacing:
+        return " "
+    char_width = max(
+        (previous["width"] + word["width"]) / max(len(previous["text"]) + len(word["text"]), 1), 1
+    )
+    gap = word["left"] - (previous["left"] + previous["width"])
+    return " " * max(int(round(gap / char_width)), 1)
+
+def perform_ocr_with_confidence(image, config=OCR_CONFIG, deadline=None, warnings=None, recovery_budget=None,
+                                keep_spacing=False):
+    """
+    Perform OCR and keep Tesseract's per-word confidences
+    
+    Lines containing a word below LOW_CONFIDENCE_THRESHOLD are cropped,
+    upscaled and re-read with RECOVERY_OCR_CONFIG; the page as a whole is
+    only read once.
     
     Args:
         image: Preprocessed image as a numpy array
+        config: Tesseract configuration for the first pass
+        deadline: Optional Deadline for the OCR stage
+        warnings: Optional list collecting degradation warnings
+        recovery_budget: Optional RecoveryBudget shared by the regions of
+            the page; a whole page gets its own
+        keep_spacing: Rebuild the gaps between words from their bounding
+            boxes instead of joining them with single spaces
     
     Returns:
-        Extracted text as a string
+        Dictionary with the extracted text, the words with their character
+        offsets and confidences, and the mean word confidence
     """
     try:
         logger.debug("Starting OCR process")
         
-        # Convert the numpy array to a PIL Image
-        pil_image = Image.fromarray(image)
+        if deadline is None:
+            deadline = Deadline("ocr")
+        if recovery_budget is None:
+            recovery_budget = RecoveryBudget()
+        lines = _read_lines(image, config, deadline)
+        
+        # Re-read the least confident lines first, within the per-page budget
+        low_confidence = [
+            index for index, (_, words) in enumerate(lines)
+            if min(word["confidence"] for word in words) < LOW_CONFIDENCE_THRESHOLD
+        ]
+        low_confidence.sort(key=lambda index: min(word["confidence"] for word in lines[index][1]))
+        recovered_count = 0
+        for index in low_confidence:
+            if deadline.expired():
+                recovery_budget.skip(warnings)
+                break
+            if not recovery_budget.take():
+                break
+            key, words = lines[index]
+            try:
+                recovered = _recover_line(image, words, deadline)
+            except TimeoutError:
+                recovery_budget.skip(warnings)
+                break
+            if recovered:
+                lines[index] = (key, recovered)
+                recovered_count += 1
+        
+        # Assemble the text, recording where each word lands in it
+        text_parts = []
+        ocr_words = []
+        offset = 0
+        previous_block = None
+        for (block, _, _), words in lines:
+            if previous_block is not None:
+                separator = "\n\n" if block != previous_block else "\n"
+                text_parts.append(separator)
+                offset += len(separator)
+            previous_block = block
+            
+            for position, word in enumerate(words):
+                if position:
+                    gap = _word_gap(words[position - 1], word, keep_spacing)
+                    text_parts.append(gap)
+                    offset += len(gap)
+                text_parts.append(word["text"])
+                ocr_words.append({
+                    "text": word["text"],
+                    "confidence": word["confidence"],
+                    "start": offset,
+                    "end": offset + len(word["text"]),
+                })
+                offset += len(word["text"])
         
-        # Perform OCR
-        custom_config = r'--oem 3 --psm 6 -l eng'
-        text = pytesseract.image_to_string(pil_image, config=custom_config)
+        text = "".join(text_parts)
+        mean_confidence = (
+            sum(word["confidence"] for word in ocr_words) / len(ocr_words) if ocr_words else 0.0
+        )
         
-        logger.debug(f"OCR completed, extracted {len(text)} characters")
-        return text
+        logger.debug(
+            f"OCR completed, extracted {len(text)} characters "
+            f"(mean confidence {mean_confidence:.1f}, {recovered_count} lines re-read)"
+        )
+        return {"text": text, "words": ocr_words, "mean_confidence": mean_confidence}
     
     except Exception as e:
         logger.error(f"Error during OCR: {str(e)}")
         raise
+
+def perform_ocr(image):
+    """
+    Perform OCR on the preprocessed image
+    
+    Args:
+        image: Preprocessed image as a numpy array
+    
+    Returns:
+        Extracted text as a string
+    """
+    return perform_ocr_with_confidence(image)["text"]
+
+def perform_layout_ocr(image, warnings=None):
+    """
+    Perform OCR region by region after layout analysis
+    
+    Text blocks, single lines and tables are read in parallel with a
+    configuration suited to each; blank and graphic regions are skipped.
+    Falls back to whole-page OCR when no text region is found.
+    
+    Args:
+        image: Preprocessed image as a numpy array
+        warnings: Optional list collecting degradation warnings
+    
+    Returns:
+        Dictionary in the same shape as perform_ocr_with_confidence
+    """
+    deadline = Deadline("ocr")
+    regions = [region for region in detect_regions(image) if region["kind"] in REGION_OCR_CONFIGS]
+    if not regions:
+        logger.debug("No text regions detected, falling back to whole-page OCR")
+        try:
+            return perform_ocr_with_confidence(image, deadline=deadline, warnings=warnings)
+        except TimeoutError as e:
+            warn(warnings, f"OCR stopped: {str(e)}")
+            return {"text": "", "words": [], "mean_confidence": 0.0}
+    
+    padding = 8
+    height, width = image.shape[:2]
+    # MAX_RECOVERY_LINES and the time-budget warning apply to the page, not to each region
+    recovery_budget = RecoveryBudget()
+    
+    def read_region(region):
+        x, y, w, h = region["bbox"]
+        crop = image[max(y - padding, 0):min(y + h + padding, height), max(x - padding, 0):min(x + w + padding, width)]
+        try:
+            return perform_ocr_with_confidence(
+                crop, REGION_OCR_CONFIGS[region["kind"]], deadline, warnings, recovery_budget,
+                keep_spacing=region["kind"] in SPACED_REGION_KINDS
+            )
+        except TimeoutError:
+            # Keep whatever the other regions produced within the budget
+            return {"text": "", "words": [], "mean_confidence": 0.0, "timed_out": True}
+    
+    region_results = list(_region_executor.map(in_document_context(read_region), regions))
+    timed_out = sum(1 for region_result in region_results if region_result.get("timed_out"))
+    if timed_out:
+        warn(warnings, f"OCR time budget of {deadline.seconds:.0f}s reached, {timed_out} of {len(regions)} regions not read")
+    
+    return stitch_ocr_results(region_results)
+
+def stitch_ocr_results(results):
+    """
+    Join the OCR results of regions or pages in reading order
+    
+    Args:
+        results: List of dictionaries as returned by perform_ocr_with_confidence
+    
+    Returns:
+        Dictionary in the same shape, with word offsets shifted into the joined text
+    """
+    text_parts = []
+    ocr_words = []
+    offset = 0
+    for result in results:
+        if not result["text"]:
+            continue
+        if text_parts:
+            text_parts.append("\n\n")
+            offset += 2
+        text_parts.append(result["text"])
+        for word in result["words"]:
+            ocr_words.append(dict(word, start=word["start"] + offset, end=word["end"] + offset))
+        offset += len(result["text"])
+    
+    mean_confidence = (
+        sum(word["confidence"] for word in ocr_words) / len(ocr_words) if ocr_words else 0.0
+    )
+    return {"text": "".join(text_parts), "words": ocr_words, "mean_confidence": mean_confidence}
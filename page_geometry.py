@@ -0,0 +1,314 @@
+import os
+import hashlib
+import logging
+
+import cv2
+import numpy as np
+import pytesseract
+from PIL import Image
+
+from pipeline import default_cache
+from resource_limits import warn, MAX_PAGE_PIXELS
+
+logger = logging.getLogger(__name__)
+
+# Resolution pages are normalized to before OCR
+TARGET_DPI = int(os.environ.get("TARGET_DPI", 300))
+
+# Scale changes smaller than this are not worth resampling the page for
+DPI_TOLERANCE = 0.1
+
+# Longest side of the thumbnails the orientation and skew are estimated on
+OSD_THUMBNAIL_SIDE = 1600
+SKEW_THUMBNAIL_SIDE = 800
+
+# Skew search range and precision, in degrees
+MAX_SKEW = 15.0
+SKEW_COARSE_STEP = 1.0
+SKEW_FINE_STEP = 0.1
+
+# Skew below this is left alone rather than resampling the page
+MIN_SKEW = 0.2
+
+# Tesseract OSD script confidence below which its rotation is not trusted
+MIN_OSD_CONFIDENCE = 2.0
+OSD_TIMEOUT = 10
+
+# How much more ragged one end of the text lines must be than the other
+# before a sideways page is turned without OSD; left-aligned text has a
+# straight start and a ragged end
+MIN_MARGIN_ASYMMETRY = 2.0
+MARGIN_SPREAD_FLOOR = 0.02
+
+# Bump when the estimation changes, so cached transforms are not reused
+GEOMETRY_VERSION = 2
+
+# Estimated transforms, keyed by page hash, so retries and reprocessing of the
+# same page skip the estimation. They share the pipeline cache, its private
+# folder and its eviction.
+_transform_cache = default_cache()
+
+
+def _thumbnail(image, max_side):
+    scale = min(max_side / max(image.shape[:2]), 1.0)
+    if scale == 1.0:
+        return image, 1.0
+    return cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA), scale
+
+
+def _rotate_right_angle(image, rotation):
+    """Rotate an image clockwise by 0, 90, 180 or 270 degrees"""
+    codes = {90: cv2.ROTATE_90_CLOCKWISE, 180: cv2.ROTATE_180, 270: cv2.ROTATE_90_COUNTERCLOCKWISE}
+    return cv2.rotate(image, codes[rotation]) if rotation in codes else image
+
+
+def _ink(image):
+    """Binary image with ink as 1, for projection profiles"""
+    return (cv2.threshold(image, 0, 1, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)[1]).astype(np.float32)
+
+
+def _line_score(ink):
+    # Text lines aligned with the rows give sharp jumps in the row profile
+    profile = ink.sum(axis=1)
+    return float(np.sum(np.diff(profile) ** 2))
+
+
+def _margin_spread(edges):
+    # Median absolute deviation: a few short lines or stray marks do not count
+    return float(np.median(np.abs(edges - np.median(edges))))
+
+
+def _sideways_rotation(ink):
+    """
+    Decide which way a sideways page is turned from its aligned margin
+
+    The text lines of a sideways page run along the columns. The end where
+    they all start is straight, the end where they stop is ragged.
+
+    Args:
+        ink: Binary sideways page with ink as 1
+
+    Returns:
+        90 or 270, or None if neither end is clearly straighter
+    """
+    inked = ink[:, ink.sum(axis=0) > 0]
+    if inked.shape[1] == 0:
+        return None
+    starts = np.argmax(inked > 0, axis=0)
+    ends = inked.shape[0] - 1 - np.argmax(inked[::-1] > 0, axis=0)
+    # Spreads within a small share of the line length count as straight
+    floor = MARGIN_SPREAD_FLOOR * inked.shape[0]
+    top_spread, bottom_spread = _margin_spread(starts) + floor, _margin_spread(ends) + floor
+    # Lines starting at the top were turned clockwise, so they are turned back
+    if bottom_spread >= MIN_MARGIN_ASYMMETRY * top_spread:
+        return 270
+    if top_spread >= MIN_MARGIN_ASYMMETRY * bottom_spread:
+        return 90
+    return None
+
+
+def _estimate_rotation(image):
+    """
+    Estimate the clockwise rotation (0, 90, 180 or 270) that makes a page upright
+
+    Tesseract OSD is used when it is confident. Otherwise the row and
+    column projection profiles decide between upright and sideways, and the
+    ragged ends of the lines decide which way a sideways page is turned.
+    Sideways pages with no clear ragged end, and upside-down pages, are
+    left as they are.
+
+    Returns:
+        Tuple of (rotation, method); the method is "osd", "projection", or
+        "unresolved" for a sideways page that was left as it is
+    """
+    thumbnail, _ = _thumbnail(image, OSD_THUMBNAIL_SIDE)
+    try:
+        osd = pytesseract.image_to_osd(
+            Image.fromarray(thumbnail), output_type=pytesseract.Output.DICT, timeout=OSD_TIMEOUT
+        )
+        if osd["orientation_conf"] >= MIN_OSD_CONFIDENCE:
+            # "rotate" is the clockwise rotation that makes the page upright
+            return int(osd["rotate"]) % 360, "osd"
+    except (pytesseract.TesseractError, pytesseract.TesseractNotFoundError, RuntimeError) as e:
+        logger.debug(f"Orientation detection failed, using projection profiles: {str(e)}")
+
+    ink = _ink(_thumbnail(image, SKEW_THUMBNAIL_SIDE)[0])
+    if _line_score(ink.T) <= _line_score(ink):
+        return 0, "projection"
+    rotation = _sideways_rotation(ink)
+    if rotation is None:
+        return 0, "unresolved"
+    return rotation, "projection"
+
+
+def _estimate_skew(image):
+    """
+    Estimate the page skew with a projection-profile search on a thumbnail
+
+    Returns:
+        Counterclockwise rotation in degrees that straightens the text lines
+    """
+    thumbnail, _ = _thumbnail(image, SKEW_THUMBNAIL_SIDE)
+    ink = _ink(thumbnail)
+    height, width = ink.shape
+    center = (width / 2, height / 2)
+
+    def score(angle):
+        matrix = cv2.getRotationMatrix2D(center, angle, 1.0)
+        return _line_score(cv2.warpAffine(ink, matrix, (width, height), flags=cv2.INTER_NEAREST))
+
+    # Coarse search over the whole range, then refine around the best angle
+    coarse = np.arange(-MAX_SKEW, MAX_SKEW + SKEW_COARSE_STEP / 2, SKEW_COARSE_STEP)
+    best = max(coarse, key=score)
+    fine = np.arange(best - SKEW_COARSE_STEP, best + SKEW_COARSE_STEP + SKEW_FINE_STEP / 2, SKEW_FINE_STEP)
+    return round(float(max(fine, key=score)), 2)
+
+
+def _dpi_scale(image, source_dpi, skew):
+    """Scale factor that brings the page to TARGET_DPI within the pixel budget"""
+    if not source_dpi:
+        return 1.0
+    scale = TARGET_DPI / source_dpi
+
+    # The deskewed page needs a larger canvas, which counts against the budget
+    height, width = image.shape[:2]
+    cos, sin = abs(np.cos(np.radians(skew))), abs(np.sin(np.radians(skew)))
+    pixels = (height * sin + width * cos) * (height * cos + width * sin)
+    scale = min(scale, (MAX_PAGE_PIXELS / pixels) ** 0.5)
+    return round(float(scale), 3) if abs(scale - 1.0) > DPI_TOLERANCE else 1.0
+
+
+def page_hash(image, source_dpi=None):
+    """
+    Hash a page bitmap (and its resolution) for the transform cache
+
+    Args:
+        image: Grayscale page as a numpy array
+        source_dpi: Resolution of the page, if known
+
+    Returns:
+        Hex SHA-256 digest
+    """
+    digest = hashlib.sha256()
+    digest.update(f"{GEOMETRY_VERSION}|{image.shape}|{source_dpi}|{TARGET_DPI}".encode('utf-8'))
+    digest.update(np.ascontiguousarray(image).data)
+    return digest.hexdigest()
+
+
+def _load_cached_transform(key):
+    if _transform_cache is None:
+        return None
+    transform = _transform_cache.load(key)
+    if not isinstance(transform, dict) or not {"rotation", "skew", "scale", "method"} <= transform.keys():
+        return None
+    return transform
+
+
+def _save_cached_transform(key, transform):
+    if _transform_cache is not None:
+        _transform_cache.store(key, transform)
+
+
+def estimate_transform(image, source_dpi=None):
+    """
+    Estimate the rotation, skew and scale that normalize a page
+
+    Args:
+        image: Grayscale page as a numpy array
+        source_dpi: Resolution of the page, if known
+
+    Returns:
+        Dictionary with the clockwise right-angle "rotation", the
+        counterclockwise "skew" in degrees, the "scale" and the "method"
+        the rotation was found with
+    """
+    rotation, method = _estimate_rotation(image)
+    skew = _estimate_skew(_rotate_right_angle(image, rotation))
+    if abs(skew) < MIN_SKEW:
+        skew = 0.0
+    return {
+        "rotation": rotation,
+        "skew": skew,
+        "scale": _dpi_scale(image, source_dpi, skew),
+        "method": method,
+    }
+
+
+def apply_transform(image, transform):
+    """
+    Rotate, deskew and rescale a page in a single resampling
+
+    The scale is capped so the output stays within MAX_PAGE_PIXELS, whatever
+    transform it is given.
+
+    Args:
+        image: Grayscale page as a numpy array
+        transform: Dictionary from estimate_transform
+
+    Returns:
+        The transformed page, on a white background
+    """
+    rotation, skew, scale = transform["rotation"], transform["skew"], transform["scale"]
+    if skew == 0.0 and scale == 1.0:
+        # Right-angle turns need no resampling at all
+        return _rotate_right_angle(image, rotation)
+
+    # cv2 angles are counterclockwise
+    height, width = image.shape[:2]
+    angle = np.radians(skew - rotation)
+    cos, sin = abs(np.cos(angle)), abs(np.sin(angle))
+    pixels = (height * sin + width * cos) * (height * cos + width * sin)
+    capped = pixels * scale ** 2 > MAX_PAGE_PIXELS
+    if capped:
+        scale = (MAX_PAGE_PIXELS / pixels) ** 0.5
+    matrix = cv2.getRotationMatrix2D((width / 2, height / 2), skew - rotation, scale)
+
+    # Grow the canvas to hold the whole rotated page (rounding down at the cap)
+    cos, sin = abs(matrix[0, 0]), abs(matrix[0, 1])
+    fit = int if capped else round
+    new_width = int(fit(height * sin + width * cos))
+    new_height = int(fit(height * cos + width * sin))
+    matrix[0, 2] += new_width / 2 - width / 2
+    matrix[1, 2] += new_height / 2 - height / 2
+
+    interpolation = cv2.INTER_LINEAR if scale < 1.0 else cv2.INTER_CUBIC
+    return cv2.warpAffine(
+        image, matrix, (new_width, new_height),
+        flags=interpolation, borderMode=cv2.BORDER_CONSTANT, borderValue=255
+    )
+
+
+def normalize_page(image, source_dpi=None, warnings=None):
+    """
+    Turn a page upright, straighten it and bring it to TARGET_DPI
+
+    The transform is estimated on thumbnails and cached by page hash, so
+    the same page processed again only pays for one warpAffine.
+
+    Args:
+        image: Grayscale page as a numpy array
+        source_dpi: Resolution of the page, if known
+        warnings: Optional list collecting degradation warnings
+
+    Returns:
+        The normalized page
+    """
+    try:
+        key = page_hash(image, source_dpi)
+        transform = _load_cached_transform(key)
+        if transform is None:
+            transform = estimate_transform(image, source_dpi)
+            _save_cached_transform(key, transform)
+        else:
+            logger.debug(f"Using cached page transform {key[:12]}")
+        if transform["method"] == "unresolved":
+            warn(warnings, "Page appears to be sideways but its direction could not be determined; it was read unrotated")
+
+        if transform["rotation"] or transform["skew"] or transform["scale"] != 1.0:
+            logger.debug(f"Normalizing page: {transform}")
+        return apply_transform(image, transform)
+
+    except Exception as e:
+        # A page that cannot be normalized is still worth reading as it is
+        warn(warnings, f"Page orientation and skew correction skipped: {str(e)}")
+        return image
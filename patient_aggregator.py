@@ -0,0 +1,212 @@
+import re
+import logging
+from datetime import date, datetime, timezone
+
+from result_store import (
+    load_metadata, iter_medical_terms, iter_hcc_codes,
+    load_patient_profile, save_patient_profile, lock_patient_profile
+)
+
+logger = logging.getLogger(__name__)
+
+CONFIDENCE_RANK = {"low": 0, "medium": 1, "high": 2}
+
+# Distinct supporting terms kept per HCC code, so a profile stays the same
+# size however many documents mention the condition
+MAX_EVIDENCE_TERMS = 20
+
+# Dates as captured by the SERVICE DATE extraction: month/day/year
+_SERVICE_DATE_PATTERN = re.compile(r"(\d{1,2})[-/\.](\d{1,2})[-/\.](\d{2,4})")
+
+
+def parse_service_date(term):
+    """
+    Parse the date of a SERVICE DATE term
+
+    Args:
+        term: Term text, e.g. "Service Date: 03/14/2023"
+
+    Returns:
+        ISO date string, or None if the date is not valid
+    """
+    match = _SERVICE_DATE_PATTERN.search(term)
+    if not match:
+        return None
+    month, day, year = (int(part) for part in match.groups())
+    if year < 100:
+        # Two-digit years up to the current one are this century
+        year += 2000 if year <= date.today().year % 100 else 1900
+    try:
+        return date(year, month, day).isoformat()
+    except ValueError:
+        return None
+
+
+def document_service_dates(medical_terms):
+    """
+    Collect the service dates found in a document
+
+    Args:
+        medical_terms: Extracted medical terms of the document
+
+    Returns:
+        Sorted list of distinct ISO dates
+    """
+    dates = set()
+    for term_data in medical_terms:
+        if term_data.get("category") == "SERVICE DATE":
+            service_date = parse_service_date(term_data["term"])
+            if service_date:
+                dates.add(service_date)
+    return sorted(dates)
+
+
+def _widen_dates(entry, first, last):
+    # ISO dates compare correctly as strings
+    if first and (entry["first_seen"] is None or first < entry["first_seen"]):
+        entry["first_seen"] = first
+    if last and (entry["last_seen"] is None or last > entry["last_seen"]):
+        entry["last_seen"] = last
+
+
+def new_patient_profile(patient_id):
+    return {
+        "patient_id": patient_id,
+        "updated_at": None,
+        "document_count": 0,
+        "first_seen": None,
+        "last_seen": None,
+        "documents": {},
+        "hcc_codes": {},
+    }
+
+
+def apply_document(profile, result_id, document_name, service_dates, hcc_codes):
+    """
+    Fold one document's HCC codes into a patient profile
+
+    Only the new document is looked at, so the cost is proportional to its
+    codes, not to the patient's history.
+
+    Args:
+        profile: Patient profile, updated in place
+        result_id: Id of the stored result
+        document_name: Name of the document
+        service_dates: Sorted ISO service dates of the document
+        hcc_codes: Mapped HCC codes of the document
+
+    Returns:
+        False if the document was already part of the profile
+    """
+    if result_id in profile["documents"]:
+        return False
+
+    first = service_dates[0] if service_dates else None
+    last = service_dates[-1] if service_dates else None
+
+    profile["documents"][result_id] = {
+        "document_name": document_name,
+        "service_dates": service_dates,
+    }
+    profile["document_count"] += 1
+    _widen_dates(profile, first, last)
+
+    counted = set()
+    for code in hcc_codes:
+        hcc_code = code["hcc_code"]
+        if hcc_code == "Unknown":
+            continue
+
+        entry = profile["hcc_codes"].get(hcc_code)
+        if entry is None:
+            entry = profile["hcc_codes"][hcc_code] = {
+                "hcc_code": hcc_code,
+                "description": code["description"],
+                "first_seen": None,
+                "last_seen": None,
+                "evidence_count": 0,
+                "document_count": 0,
+                "strongest_confidence": code["confidence"],
+                "terms": [],
+            }
+
+        entry["evidence_count"] += 1
+        if CONFIDENCE_RANK[code["confidence"]] > CONFIDENCE_RANK[entry["strongest_confidence"]]:
+            entry["strongest_confidence"] = code["confidence"]
+        term = code["term"].lower()
+        if term not in entry["terms"] and len(entry["terms"]) < MAX_EVIDENCE_TERMS:
+            entry["terms"].append(term)
+
+        if hcc_code not in counted:
+            counted.add(hcc_code)
+            entry["document_count"] += 1
+            entry["last_result_id"] = result_id
+            _widen_dates(entry, first, last)
+
+    return True
+
+
+def add_document(patient_id, result_id, medical_terms=None, hcc_codes=None):
+    """
+    Add a stored result to a patient's HCC profile
+
+    Args:
+        patient_id: Patient identifier
+        result_id: Id of the stored result
+        medical_terms: Optional terms of the result; read from the store if omitted
+        hcc_codes: Optional HCC codes of the result; read from the store if omitted
+
+    Returns:
+        The updated profile
+    """
+    try:
+        metadata = load_metadata(result_id)
+        if metadata is None:
+            raise ValueError(f"Unknown result id: {result_id}")
+        if medical_terms is None:
+            medical_terms = iter_medical_terms(result_id)
+        if hcc_codes is None:
+            hcc_codes = list(iter_hcc_codes(result_id))
+        service_dates = document_service_dates(medical_terms)
+
+        with lock_patient_profile(patient_id):
+            profile = load_patient_profile(patient_id) or new_patient_profile(patient_id)
+            if apply_document(profile, result_id, metadata["document_name"], service_dates, hcc_codes):
+                profile["updated_at"] = datetime.now(timezone.utc).isoformat()
+                save_patient_profile(profile)
+                logger.debug(f"Added result {result_id} to patient {patient_id}")
+            return profile
+
+    except Exception as e:
+        logger.error(f"Error during patient aggregation: {str(e)}")
+        raise
+
+
+def rebuild_patient_profile(patient_id):
+    """
+    Rebuild a patient's profile from the stored results, e.g. after re-mapping
+
+    Args:
+        patient_id: Patient identifier
+
+    Returns:
+        The rebuilt profile, or None if the patient has no profile
+    """
+    with lock_patient_profile(patient_id):
+        old_profile = load_patient_profile(patient_id)
+        if old_profile is None:
+            return None
+
+        profile = new_patient_profile(patient_id)
+        for result_id, document in old_profile["documents"].items():
+            if load_metadata(result_id) is None:
+                logger.warning(f"Result {result_id} of patient {patient_id} no longer exists")
+                continue
+            # Re-mapping from the text may have changed the service dates too
+            apply_document(
+                profile, result_id, document["document_name"],
+                document_service_dates(iter_medical_terms(result_id)), iter_hcc_codes(result_id)
+            )
+        profile["updated_at"] = datetime.now(timezone.utc).isoformat()
+        save_patient_profile(profile)
+        return profile
@@ -0,0 +1,423 @@
+import os
+import json
+import time
+import stat
+import hashlib
+import logging
+import tempfile
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+from profiler import in_document_context, stage as profile_stage
+from result_store import RESULTS_FOLDER
+
+logger = logging.getLogger(__name__)
+
+# Memoized stage outputs, one JSON file per stage key. They hold OCR text and
+# extracted terms, i.e. PHI, so they live next to the stored results in a
+# directory only this user can read, and are evicted by age and total size.
+# Set PIPELINE_CACHE=0 to always recompute.
+PIPELINE_CACHE = os.environ.get("PIPELINE_CACHE", "1") != "0"
+PIPELINE_CACHE_FOLDER = Path(os.environ.get("PIPELINE_CACHE_FOLDER", RESULTS_FOLDER / "pipeline_cache"))
+PIPELINE_CACHE_MAX_AGE = float(os.environ.get("PIPELINE_CACHE_MAX_AGE_DAYS", 7)) * 24 * 3600
+PIPELINE_CACHE_MAX_BYTES = int(os.environ.get("PIPELINE_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+
+# Seconds between eviction sweeps of one process
+PIPELINE_CACHE_SWEEP_INTERVAL = 600
+
+# Pages of one document processed at the same time by per-page stages
+PIPELINE_PAGE_WORKERS = int(os.environ.get("PIPELINE_PAGE_WORKERS", os.cpu_count() or 4))
+
+_page_executor = ThreadPoolExecutor(max_workers=PIPELINE_PAGE_WORKERS, thread_name_prefix="pipeline-page")
+
+
+class Stage:
+    """
+    One step of a pipeline
+
+    The function is called with the stage's inputs as positional arguments,
+    in the declared order, plus a warnings list, and returns a dictionary
+    holding every declared output. A per-page stage is called once for each
+    item of its per_page input, concurrently, and each of its outputs is the
+    list of the per-page values in page order.
+
+    Args:
+        name: Stage name, also used as the profiler stage name
+        func: Function computing the outputs
+        inputs: Names of the values the stage reads
+        outputs: Names of the values the stage produces
+        version: Bump whenever the function's results change for the same inputs
+        per_page: Name of the list input the stage is mapped over, if any
+        cacheable: Memoize the outputs on disk; they must then be JSON
+            serializable. Stages that are cheap, or whose outputs are too
+            large to be worth storing, should say False.
+        params: Optional function returning the settings the outputs depend
+            on besides the inputs (configuration, data files); they are part
+            of the cache key
+    """
+
+    def __init__(self, name, func, inputs, outputs, version=1, per_page=None, cacheable=True, params=None):
+        if per_page is not None and per_page not in inputs:
+            raise ValueError(f"Stage {name} is mapped over {per_page}, which is not one of its inputs")
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.version = version
+        self.per_page = per_page
+        self.cacheable = cacheable
+        self.params = params
+
+    def __repr__(self):
+        return f"Stage({self.name!r}, v{self.version})"
+
+
+class SourceFile:
+    """A document on disk, identified by its content rather than its path"""
+
+    def __init__(self, path, extension):
+        self.path = path
+        self.extension = extension
+
+    def content_hash(self):
+        digest = hashlib.sha256(self.extension.encode('utf-8'))
+        with open(self.path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+
+def content_hash(value):
+    """
+    Hash a pipeline input value
+
+    Args:
+        value: A SourceFile, or any JSON-serializable value
+
+    Returns:
+        Hex SHA-256 digest
+    """
+    if hasattr(value, "content_hash"):
+        return value.content_hash()
+    return hashlib.sha256(json.dumps(value, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def settings_of(*modules):
+    """
+    Collect the module-level settings of modules, for stage params
+
+    Every public UPPERCASE constant is included, so a new or changed
+    setting invalidates cached outputs without anyone having to list it.
+    Worker counts do not change results and are left out.
+
+    Args:
+        modules: Modules whose settings the stage's outputs depend on
+
+    Returns:
+        Dictionary of "module.NAME" to a JSON-serializable value
+    """
+    settings = {}
+    for module in modules:
+        for name, value in vars(module).items():
+            if not name.isupper() or name.startswith("_") or name.endswith("_WORKERS"):
+                continue
+            if isinstance(value, (bool, int, float, str, list, tuple, dict, set, frozenset)):
+                settings[f"{module.__name__}.{name}"] = _plain(value)
+    return settings
+
+
+def _plain(value):
+    # Same value, same JSON: sets are sorted and dicts become sorted pairs,
+    # which also allows keys JSON objects cannot have
+    if isinstance(value, dict):
+        return sorted(([_plain(key), _plain(item)] for key, item in value.items()), key=json.dumps)
+    if isinstance(value, (set, frozenset)):
+        return sorted((_plain(item) for item in value), key=json.dumps)
+    if isinstance(value, (list, tuple)):
+        return [_plain(item) for item in value]
+    return value
+
+
+class StageCache:
+    """
+    On-disk store of stage outputs keyed by stage key
+
+    Entries are plain JSON, never pickles, so a file planted in the cache
+    can at worst feed wrong text into a document, not run code. Reads
+    refresh an entry's age, and a periodic sweep drops entries older than
+    max_age and then the least recently used ones over max_bytes.
+    """
+
+    def __init__(self, folder, max_age=PIPELINE_CACHE_MAX_AGE, max_bytes=PIPELINE_CACHE_MAX_BYTES):
+        self.folder = Path(folder)
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self._last_sweep = 0.0
+        self._sweep_lock = threading.Lock()
+
+    def _path(self, key):
+        return self.folder / key[:2] / f"{key}.json"
+
+    def _private(self):
+        """Create the cache folder, and refuse one other users can read or write"""
+        self.folder.mkdir(mode=0o700, parents=True, exist_ok=True)
+        folder_stat = self.folder.stat()
+        if folder_stat.st_uid != os.geteuid():
+            logger.warning(f"Pipeline cache {self.folder} belongs to another user, not using it")
+            return False
+        if stat.S_IMODE(folder_stat.st_mode) & 0o077:
+            os.chmod(self.folder, 0o700)
+        return True
+
+    def load(self, key):
+        path = self._path(key)
+        try:
+            if not self._private():
+                return None
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+            os.utime(path)
+            return entry
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable pipeline cache entry {key}: {str(e)}")
+            return None
+
+    def store(self, key, entry):
+        path = self._path(key)
+        staging_path = None
+        try:
+            if not self._private():
+                return
+            path.parent.mkdir(mode=0o700, exist_ok=True)
+            fd, staging_path = tempfile.mkstemp(prefix=f".{key}-", dir=path.parent)
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(entry, f)
+            os.replace(staging_path, path)
+        except (OSError, TypeError, ValueError) as e:
+            # A full cache or an unserializable output only costs the next run its reuse
+            logger.warning(f"Could not store pipeline cache entry {key}: {str(e)}")
+            if staging_path and os.path.exists(staging_path):
+                os.remove(staging_path)
+            return
+
+        if time.monotonic() - self._last_sweep > PIPELINE_CACHE_SWEEP_INTERVAL:
+            self.evict()
+
+    def evict(self):
+        """Drop expired entries, then the least recently used ones over max_bytes"""
+        if not self._sweep_lock.acquire(blocking=False):
+            return
+        try:
+            self._last_sweep = time.monotonic()
+            cutoff = time.time() - self.max_age
+            entries = []
+            for path in self.folder.glob("*/*"):
+                try:
+                    path_stat = path.stat()
+                    # Staging files left by a crash count as expired
+                    if path_stat.st_mtime < cutoff or (path.name.startswith(".") and path_stat.st_mtime < time.time() - 3600):
+                        path.unlink()
+                    else:
+                        entries.append((path_stat.st_mtime, path_stat.st_size, path))
+                except FileNotFoundError:
+                    continue
+
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries, key=lambda entry: entry[0]):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    path.unlink()
+                except FileNotFoundError:
+                    pass
+                total -= size
+        except OSError as e:
+            logger.warning(f"Error during pipeline cache eviction: {str(e)}")
+        finally:
+            self._sweep_lock.release()
+
+
+class Pipeline:
+    """
+    A set of stages run on demand for the values a caller asks for
+
+    Only the stages needed for the requested outputs run, and a stage whose
+    outputs are cached is not run at all, nor are the stages feeding it.
+    Cache keys are derived from the stage name, version and params and the
+    keys of its inputs, down to the content hashes of the values the run
+    started from, so they are known before anything is computed.
+    """
+
+    def __init__(self, stages, cache=None):
+        self.stages = list(stages)
+        self.cache = cache
+        self._producers = {}
+        self._order = {}
+        for index, stage in enumerate(self.stages):
+            self._order[stage.name] = index
+            for output in stage.outputs:
+                if output in self._producers:
+                    raise ValueError(f"{output} is produced by both {self._producers[output].name} and {stage.name}")
+                self._producers[output] = stage
+
+    def run(self, inputs, targets, warnings=None):
+        """
+        Compute the requested values from the given ones
+
+        Args:
+            inputs: Dictionary of the values the run starts from. Any value a
+                stage would produce may be given instead, e.g. stored text
+                to skip OCR.
+            targets: Names of the values to return
+            warnings: Optional list collecting degradation warnings, in stage
+                order. Warnings of stages served from the cache are replayed.
+
+        Returns:
+            Dictionary of the target values
+        """
+        run = _PipelineRun(self, inputs)
+        for target in targets:
+            run.resolve(target)
+        if warnings is not None:
+            warnings.extend(run.warnings_for(targets))
+        return {target: run.values[target] for target in targets}
+
+    def value_key(self, inputs, name):
+        """
+        Compute the cache key of a value without running any stage
+
+        Args:
+            inputs: Dictionary of the values a run would start from
+            name: Name of the value
+
+        Returns:
+            Hex cache key of the value
+        """
+        return _PipelineRun(self, inputs).key(name)
+
+
+class _PipelineRun:
+    """State of one Pipeline.run call"""
+
+    def __init__(self, pipeline, inputs):
+        self.pipeline = pipeline
+        self.values = dict(inputs)
+        self.keys = {name: content_hash(value) for name, value in inputs.items()}
+        # Warnings behind each value, as (stage order, position, message)
+        self.provenance = {name: [] for name in inputs}
+        self.stage_keys = {}
+
+    def _producer(self, name):
+        stage = self.pipeline._producers.get(name)
+        if stage is None:
+            raise ValueError(f"No stage produces {name} and it was not given as an input")
+        return stage
+
+    def key(self, name):
+        if name not in self.keys:
+            stage_key = self.stage_key(self._producer(name))
+            self.keys[name] = hashlib.sha256(f"{stage_key}:{name}".encode('utf-8')).hexdigest()
+        return self.keys[name]
+
+    def stage_key(self, stage):
+        if stage.name not in self.stage_keys:
+            digest = hashlib.sha256(json.dumps(
+                [stage.name, stage.version, stage.params() if stage.params else None],
+                sort_keys=True, default=str
+            ).encode('utf-8'))
+            for name in stage.inputs:
+                digest.update(self.key(name).encode('utf-8'))
+            self.stage_keys[stage.name] = digest.hexdigest()
+        return self.stage_keys[stage.name]
+
+    def resolve(self, name):
+        if name in self.values:
+            return
+
+        stage = self._producer(name)
+        cache = self.pipeline.cache if stage.cacheable else None
+        key = self.stage_key(stage)
+
+        entry = cache.load(key) if cache else None
+        if entry is not None:
+            logger.debug(f"Pipeline stage {stage.name} served from cache")
+            self._set_outputs(stage, entry["outputs"], [tuple(warning) for warning in entry["warnings"]])
+            return
+
+        for input_name in stage.inputs:
+            self.resolve(input_name)
+
+        stage_warnings = []
+        with profile_stage(stage.name):
+            outputs = self._execute(stage, stage_warnings)
+
+        order = self.pipeline._order[stage.name]
+        carried = _merge_warnings(
+            [self.provenance[input_name] for input_name in stage.inputs]
+            + [[(order, position, message) for position, message in enumerate(stage_warnings)]]
+        )
+        self._set_outputs(stage, outputs, carried)
+
+        # Degraded outputs, e.g. cut short by a time budget, depend on the
+        # load of the machine and are not worth keeping
+        if cache and not stage_warnings:
+            cache.store(key, {"outputs": outputs, "warnings": carried})
+
+    def _set_outputs(self, stage, outputs, carried):
+        for output in stage.outputs:
+            self.values[output] = outputs[output]
+            self.provenance[output] = carried
+
+    def _execute(self, stage, warnings):
+        args = [self.values[name] for name in stage.inputs]
+        if stage.per_page is None:
+            return _check_outputs(stage, stage.func(*args, warnings=warnings))
+
+        page_position = stage.inputs.index(stage.per_page)
+        pages = args[page_position]
+        page_warnings = [[] for _ in pages]
+
+        def run_page(page, warnings):
+            page_args = list(args)
+            page_args[page_position] = page
+            return _check_outputs(stage, stage.func(*page_args, warnings=warnings))
+
+        if len(pages) <= 1:
+            results = [run_page(page, page_warnings[index]) for index, page in enumerate(pages)]
+        else:
+            # Each page runs in a copy of this context, so profiling follows it
+            run_page = in_document_context(run_page)
+            futures = [
+                _page_executor.submit(run_page, page, page_warnings[index])
+                for index, page in enumerate(pages)
+            ]
+            results = [future.result() for future in futures]
+
+        for messages in page_warnings:
+            warnings.extend(messages)
+        return {output: [result[output] for result in results] for output in stage.outputs}
+
+    def warnings_for(self, targets):
+        merged = _merge_warnings([self.provenance[target] for target in targets])
+        return [message for _, _, message in merged]
+
+
+def _check_outputs(stage, outputs):
+    missing = [name for name in stage.outputs if name not in outputs]
+    if missing:
+        raise ValueError(f"Stage {stage.name} did not produce {', '.join(missing)}")
+    return outputs
+
+
+def _merge_warnings(lists):
+    # The same upstream warning reaches a value along every path it took
+    merged = {tuple(warning) for warnings in lists for warning in warnings}
+    return sorted(merged)
+
+
+def default_cache():
+    """The on-disk stage cache configured by PIPELINE_CACHE, or None"""
+    return StageCache(PIPELINE_CACHE_FOLDER) if PIPELINE_CACHE else None
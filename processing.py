@@ -0,0 +1,118 @@
+import logging
+import os
+from functools import lru_cache
+
+from nlp_processor import extract_medical_terms
+from hcc_mapper import map_to_hcc_codes
+from pipeline import Pipeline, Stage, SourceFile, default_cache, settings_of
+from profiler import profile_document
+from resource_limits import MAX_PAGE_PIXELS, MAX_RENDER_DPI, MAX_TEXT_LENGTH, SPACY_CHUNK_LENGTH
+
+logger = logging.getLogger(__name__)
+
+# Pages of a PDF that are read; the rest are ignored. Pages are preprocessed
+# and OCRed concurrently.
+MAX_DOCUMENT_PAGES = int(os.environ.get("MAX_DOCUMENT_PAGES", 1))
+
+# The stage functions import ocr_processor on first use: OpenCV, PyMuPDF and
+# pytesseract dominate startup time
+
+def _list_pages(source, warnings=None):
+    from ocr_processor import count_pages
+    page_count = count_pages(source.path, source.extension)
+    if page_count > MAX_DOCUMENT_PAGES:
+        logger.debug(f"Reading {MAX_DOCUMENT_PAGES} of {page_count} pages")
+    return {"pages": list(range(min(page_count, MAX_DOCUMENT_PAGES)))}
+
+def _preprocess_page(source, page_number, warnings=None):
+    from ocr_processor import preprocess_image
+    return {"page_images": preprocess_image(source.path, source.extension, warnings, page_number)}
+
+def _pages_params():
+    return [MAX_DOCUMENT_PAGES]
+
+def _preprocess_params():
+    import page_geometry
+    from ocr_processor import PAGE_NORMALIZATION
+    from resource_limits import MAX_DECODE_PIXELS
+    return [MAX_PAGE_PIXELS, MAX_RENDER_DPI, MAX_DECODE_PIXELS, PAGE_NORMALIZATION, settings_of(page_geometry)]
+
+def _ocr_page(image, warnings=None):
+    from ocr_processor import perform_layout_ocr
+    return {"page_ocr": perform_layout_ocr(image, warnings)}
+
+@lru_cache(maxsize=None)
+def _tesseract_version():
+    import pytesseract
+    return str(pytesseract.get_tesseract_version())
+
+def _ocr_params():
+    import ocr_processor
+    import layout_analyzer
+    return [_tesseract_version(), settings_of(ocr_processor, layout_analyzer)]
+
+def _join_pages(page_ocr, warnings=None):
+    from ocr_processor import stitch_ocr_results
+    ocr_result = stitch_ocr_results(page_ocr)
+    return {"extracted_text": ocr_result["text"], "ocr_words": ocr_result["words"]}
+
+def _extract_terms(extracted_text, ocr_words, warnings=None):
+    if not extracted_text:
+        return {"medical_terms": []}
+    # Extract medical terms, carrying the OCR word confidences along
+    return {"medical_terms": extract_medical_terms(extracted_text, ocr_words, warnings=warnings)}
+
+def _extraction_params():
+    import nlp_processor
+    import fuzzy_matcher
+    import context_detector
+    import regex_engine
+    from snapshot import source_hash
+    return [
+        source_hash().hex(), MAX_TEXT_LENGTH, SPACY_CHUNK_LENGTH,
+        settings_of(nlp_processor, fuzzy_matcher, context_detector, regex_engine)
+    ]
+
+def _map_terms(medical_terms, warnings=None):
+    return {"hcc_codes": map_to_hcc_codes(medical_terms)}
+
+# The document pipeline, shared by uploads, batches and re-mapping. Bump a
+# stage's version when its results change, so cached outputs are not reused.
+DOCUMENT_PIPELINE = Pipeline([
+    Stage("pages", _list_pages, ["source"], ["pages"], cacheable=False, params=_pages_params),
+    # Page bitmaps are large and only feed OCR, whose output is cached
+    Stage("preprocess", _preprocess_page, ["source", "pages"], ["page_images"],
+          per_page="pages", cacheable=False, params=_preprocess_params),
+    Stage("ocr", _ocr_page, ["page_images"], ["page_ocr"], per_page="page_images", params=_ocr_params),
+    Stage("join", _join_pages, ["page_ocr"], ["extracted_text", "ocr_words"], cacheable=False),
+    Stage("extraction", _extract_terms, ["extracted_text", "ocr_words"], ["medical_terms"], params=_extraction_params),
+    # Mapping is cheap and must always follow the current HCC table
+    Stage("mapping", _map_terms, ["medical_terms"], ["hcc_codes"], cacheable=False),
+], cache=default_cache())
+
+def process_document(filepath, file_extension):
+    """
+    Run the full processing pipeline on a saved document
+    
+    Args:
+        filepath: Path to the uploaded document
+        file_extension: File extension (pdf, jpg, png, etc.)
+    
+    Returns:
+        Dictionary with the extracted text, OCR words, medical terms, HCC codes and any
+        warnings about degraded processing (downsampled pages, truncated text,
+        stages cut short by their time budget). The term and code lists are
+        empty when no text could be extracted. "profile" holds a timing
+        breakdown when the document was slower than
+        PROFILE_SLOW_DOCUMENT_SECONDS, and is None otherwise.
+    """
+    warnings = []
+    with profile_document(os.path.basename(filepath)) as profiled:
+        results = DOCUMENT_PIPELINE.run(
+            {"source": SourceFile(filepath, file_extension)},
+            ["extracted_text", "ocr_words", "medical_terms", "hcc_codes"],
+            warnings
+        )
+    results["warnings"] = warnings
+    results["profile"] = profiled["profile"]
+    return results
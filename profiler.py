@@ -0,0 +1,218 @@
+import os
+import sys
+import time
+import logging
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+
+logger = logging.getLogger(__name__)
+
+# Documents slower than this many seconds get their profile saved next to the
+# result. Profiling is off when unset.
+PROFILE_SLOW_DOCUMENT_SECONDS = os.environ.get("PROFILE_SLOW_DOCUMENT_SECONDS")
+
+# Interval between stack samples of the threads processing a document
+PROFILE_SAMPLE_INTERVAL = float(os.environ.get("PROFILE_SAMPLE_INTERVAL", 0.01))
+
+# Number of regexes and functions listed in a saved profile
+PROFILE_TOP_N = 25
+
+_current_profile = ContextVar("current_profile", default=None)
+
+
+class _StackSampler(threading.Thread):
+    """
+    Background thread that periodically records the stacks of the threads
+    working on one document
+
+    Works like py-spy in-process: the sampled threads are never interrupted,
+    and the cost is one sys._current_frames() call per interval. Samples of
+    all threads add up into the same stacks.
+    """
+
+    def __init__(self, thread_id, interval):
+        super().__init__(name="profile-sampler", daemon=True)
+        self.interval = interval
+        self.stacks = Counter()
+        self.sample_count = 0
+        self._stopped = threading.Event()
+        # Registrations per thread id; worker threads come and go per task
+        self._threads = Counter([thread_id])
+        self._threads_lock = threading.Lock()
+
+    def add_thread(self, thread_id):
+        with self._threads_lock:
+            self._threads[thread_id] += 1
+
+    def remove_thread(self, thread_id):
+        with self._threads_lock:
+            self._threads[thread_id] -= 1
+            if self._threads[thread_id] <= 0:
+                del self._threads[thread_id]
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            frames = sys._current_frames()
+            with self._threads_lock:
+                thread_ids = list(self._threads)
+            for thread_id in thread_ids:
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+                self.sample_count += 1
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+class DocumentProfile:
+    """Timing breakdown for processing one document"""
+
+    def __init__(self, document_name):
+        self.document_name = document_name
+        self.started_at = time.perf_counter()
+        self.total_seconds = None
+        self.stages = {}
+        self.patterns = {}
+        self.sampler = _StackSampler(threading.get_ident(), PROFILE_SAMPLE_INTERVAL)
+
+    def record_stage(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def record_pattern(self, pattern, seconds, matches):
+        timing = self.patterns.setdefault(pattern, {"seconds": 0.0, "matches": 0})
+        timing["seconds"] += seconds
+        timing["matches"] += matches
+
+    def to_dict(self):
+        slowest = sorted(self.patterns.items(), key=lambda item: item[1]["seconds"], reverse=True)
+
+        # Self time per function: the innermost frame of every sample
+        functions = Counter()
+        for stack, count in self.sampler.stacks.items():
+            functions[stack.rsplit(";", 1)[-1]] += count
+
+        return {
+            "document_name": self.document_name,
+            "total_seconds": self.total_seconds,
+            "threshold_seconds": float(PROFILE_SLOW_DOCUMENT_SECONDS),
+            "stages": self.stages,
+            "slowest_patterns": [
+                {"pattern": pattern, "seconds": timing["seconds"], "matches": timing["matches"]}
+                for pattern, timing in slowest[:PROFILE_TOP_N]
+            ],
+            "pattern_seconds_total": sum(timing["seconds"] for timing in self.patterns.values()),
+            "samples": {
+                "interval_seconds": self.sampler.interval,
+                "count": self.sampler.sample_count,
+                "top_functions": [
+                    {"function": function, "samples": count}
+                    for function, count in functions.most_common(PROFILE_TOP_N)
+                ],
+                # Collapsed stacks, one "frame;frame;frame count" per line, as
+                # consumed by flamegraph tools
+                "collapsed_stacks": [
+                    f"{stack} {count}" for stack, count in self.sampler.stacks.most_common()
+                ],
+            },
+        }
+
+
+def current_profile():
+    """Get the profile of the document being processed, or None"""
+    return _current_profile.get()
+
+
+def _sampled_call(func, args, kwargs):
+    profile = _current_profile.get()
+    if profile is None:
+        return func(*args, **kwargs)
+
+    thread_id = threading.get_ident()
+    profile.sampler.add_thread(thread_id)
+    try:
+        return func(*args, **kwargs)
+    finally:
+        profile.sampler.remove_thread(thread_id)
+
+
+def in_document_context(func):
+    """
+    Wrap a function handed to a worker thread so it runs with the caller's
+    document: stage and pattern timings go to the caller's profile, and the
+    worker's stack is sampled while it runs the function
+
+    Args:
+        func: Function to run on a worker thread
+
+    Returns:
+        Wrapped function, safe to call from several threads at once
+    """
+    context = copy_context()
+
+    def run(*args, **kwargs):
+        # A context can only be entered by one thread at a time
+        return context.copy().run(_sampled_call, func, args, kwargs)
+    return run
+
+
+@contextmanager
+def profile_document(document_name):
+    """
+    Profile the processing of one document on the current thread, and on
+    worker threads running functions wrapped with in_document_context
+
+    Yields a holder dictionary; after the block, its "profile" entry holds
+    the profile as a dictionary if the document took longer than
+    PROFILE_SLOW_DOCUMENT_SECONDS, and None otherwise.
+
+    Args:
+        document_name: Name of the document being processed
+    """
+    holder = {"profile": None}
+    if not PROFILE_SLOW_DOCUMENT_SECONDS:
+        yield holder
+        return
+
+    profile = DocumentProfile(document_name)
+    profile.sampler.start()
+    token = _current_profile.set(profile)
+    try:
+        yield holder
+    finally:
+        _current_profile.reset(token)
+        profile.sampler.stop()
+        profile.total_seconds = time.perf_counter() - profile.started_at
+        if profile.total_seconds >= float(PROFILE_SLOW_DOCUMENT_SECONDS):
+            logger.info(f"Slow document {document_name}: {profile.total_seconds:.1f}s, saving profile")
+            holder["profile"] = profile.to_dict()
+
+
+@contextmanager
+def stage(name):
+    """
+    Time a processing stage of the current document, if it is being profiled
+
+    Args:
+        name: Stage name, e.g. "ocr"
+    """
+    profile = _current_profile.get()
+    if profile is None:
+        yield
+        return
+
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.record_stage(name, time.perf_counter() - started)
+
@@ -0,0 +1,135 @@
+import os
+import re
+import time
+import logging
+
+from profiler import current_profile
+from resource_limits import warn
+
+logger = logging.getLogger(__name__)
+
+# Optional backends: google-re2 matches in linear time, and the regex module
+# can abort a search that runs over its timeout
+try:
+    import re2
+except ImportError:
+    re2 = None
+
+try:
+    import regex
+except ImportError:
+    regex = None
+
+# "regex" runs patterns on the regex module, which matches like the standard
+# library and aborts a search that runs over its timeout. "re2" runs them on
+# RE2, which never backtracks; patterns RE2 cannot express (lookarounds) fall
+# back to the regex module. "re" runs them on the standard library engine,
+# where the timeout is only checked between matches. The default is the
+# first of regex, re2 and re that is installed.
+_DEFAULT_ENGINE = "regex" if regex is not None else "re2" if re2 is not None else "re"
+REGEX_ENGINE = os.environ.get("REGEX_ENGINE", _DEFAULT_ENGINE)
+
+# Engine time, in seconds, one pattern may spend on one document
+REGEX_PATTERN_TIMEOUT = float(os.environ.get("REGEX_PATTERN_TIMEOUT", 2))
+
+if REGEX_ENGINE == "re2" and re2 is None:
+    logger.warning("REGEX_ENGINE=re2 but google-re2 is not installed, using another engine")
+if REGEX_ENGINE == "regex" and regex is None:
+    logger.warning("REGEX_ENGINE=regex but the regex module is not installed, using another engine")
+if REGEX_ENGINE not in ("re2", "regex") or (regex is None and re2 is None):
+    logger.warning(
+        "Patterns run on the standard library engine, which cannot interrupt a single "
+        "search: install regex or google-re2 to enforce REGEX_PATTERN_TIMEOUT"
+    )
+
+# Compiled patterns by pattern string, as (engine name, compiled pattern)
+_compiled_patterns = {}
+
+
+def _compile(pattern):
+    if REGEX_ENGINE == "re2" and re2 is not None:
+        try:
+            return "re2", re2.compile(pattern)
+        except re2.error as e:
+            logger.debug(f"RE2 cannot run {pattern!r} ({str(e)}), falling back")
+    if REGEX_ENGINE in ("re2", "regex") and regex is not None:
+        return "regex", regex.compile(pattern)
+    if REGEX_ENGINE == "regex" and re2 is not None:
+        try:
+            return "re2", re2.compile(pattern)
+        except re2.error as e:
+            logger.debug(f"RE2 cannot run {pattern!r} ({str(e)}), falling back")
+    return "re", re.compile(pattern)
+
+
+def compile_pattern(pattern):
+    """
+    Compile a pattern for the configured engine, once per process
+
+    Args:
+        pattern: Regex pattern string
+
+    Returns:
+        Tuple of (engine name, compiled pattern); the engine is "re2",
+        "regex" or "re"
+    """
+    compiled = _compiled_patterns.get(pattern)
+    if compiled is None:
+        compiled = _compile(pattern)
+        _compiled_patterns[pattern] = compiled
+    return compiled
+
+
+def finditer(pattern, text, timeout=None, warnings=None):
+    """
+    Iterate over the matches of a pattern, within a time limit
+
+    RE2 treats \\w and \\b as ASCII-only, so in "re2" mode accented letters
+    end a word. With the standard library engine the time limit is checked
+    between matches, so it stops a pattern that finds many matches slowly
+    but cannot interrupt a single search; the RE2 and regex backends do
+    not have that gap.
+
+    Args:
+        pattern: Regex pattern string
+        text: Text to search
+        timeout: Optional tighter time limit than REGEX_PATTERN_TIMEOUT
+        warnings: Optional list collecting degradation warnings
+
+    Returns:
+        Iterator of match objects. Iteration stops early, with a warning,
+        once the pattern has used up its time.
+    """
+    engine, compiled = compile_pattern(pattern)
+    if timeout is None or timeout > REGEX_PATTERN_TIMEOUT:
+        timeout = REGEX_PATTERN_TIMEOUT
+    return _guarded_matches(pattern, engine, compiled, text, timeout, warnings)
+
+
+def _guarded_matches(pattern, engine, compiled, text, timeout, warnings):
+    profile = current_profile()
+    elapsed = 0.0
+    count = 0
+    try:
+        started = time.perf_counter()
+        if engine == "regex":
+            matches = compiled.finditer(text, timeout=timeout)
+        else:
+            matches = compiled.finditer(text)
+
+        while True:
+            match = next(matches, None)
+            # Only time spent inside the engine counts, not handling matches
+            elapsed += time.perf_counter() - started
+            if match is None:
+                break
+            count += 1
+            yield match
+            if elapsed >= timeout:
+                raise TimeoutError
+            started = time.perf_counter()
+    except TimeoutError:
+        warn(warnings, f"Pattern {pattern[:60]!r} stopped after {count} matches: over its {timeout:.1f}s time limit")
+    finally:
+        if profile is not None:
+            profile.record_pattern(pattern, elapsed, count)
@@ -0,0 +1,208 @@
+import argparse
+import json
+import logging
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from hcc_mapper import load_hcc_codes, get_hcc_codes
+from patient_aggregator import rebuild_patient_profile
+from processing import DOCUMENT_PIPELINE
+from result_store import (
+    list_result_ids, load_metadata, iter_medical_terms, iter_hcc_codes,
+    read_extracted_text, load_ocr_words, update_hcc_codes
+)
+
+logger = logging.getLogger(__name__)
+
+REMAP_WORKERS = int(os.environ.get("REMAP_WORKERS", os.cpu_count() or 4))
+
+# Results handed to each worker process at a time; keeps IPC overhead low
+REMAP_CHUNK_SIZE = 64
+
+
+def diff_hcc_codes(old_codes, new_codes):
+    """
+    Compare two HCC code lists of the same document
+
+    Args:
+        old_codes: Previously stored HCC code mappings
+        new_codes: Freshly mapped HCC code mappings
+
+    Returns:
+        Dictionary with sorted lists of added and removed HCC codes
+    """
+    old = {code["hcc_code"] for code in old_codes if code["hcc_code"] != "Unknown"}
+    new = {code["hcc_code"] for code in new_codes if code["hcc_code"] != "Unknown"}
+    return {"added": sorted(new - old), "removed": sorted(old - new)}
+
+
+def _reattach_ocr_confidence(medical_terms, old_terms):
+    """
+    Carry the OCR confidence of previously stored terms over to re-extracted
+    terms, for results stored without their OCR words
+
+    Args:
+        medical_terms: Re-extracted medical terms, updated in place
+        old_terms: Previously stored medical terms of the same document
+
+    Returns:
+        The updated medical terms
+    """
+    confidences = {}
+    for term_data in old_terms:
+        if "ocr_confidence" in term_data:
+            key = term_data["term"].lower()
+            confidences[key] = min(confidences.get(key, 100.0), term_data["ocr_confidence"])
+
+    for term_data in medical_terms:
+        confidence = confidences.get(term_data["term"].lower())
+        if confidence is not None and "ocr_confidence" not in term_data:
+            term_data["ocr_confidence"] = confidence
+    return medical_terms
+
+
+def remap_result(result_id, from_text=False, write=True):
+    """
+    Re-run HCC mapping for one stored result without repeating OCR
+
+    Args:
+        result_id: Hex result identifier
+        from_text: Re-extract the medical terms from the stored OCR text
+            instead of reusing the stored terms
+        write: Store the new HCC codes, and the re-extracted terms, in place
+            of the old ones
+
+    Returns:
+        Dictionary with the result id, document name, patient id, code diff
+        and whether the stored result was updated
+    """
+    metadata = load_metadata(result_id)
+    if metadata is None:
+        raise ValueError(f"Unknown result id: {result_id}")
+    # An unreadable table loads as empty, which would strip every stored code
+    if not get_hcc_codes():
+        raise ValueError("HCC codes could not be loaded")
+
+    # The document pipeline picks up from the stored values, so OCR never reruns
+    old_terms = list(iter_medical_terms(result_id))
+    if from_text:
+        ocr_words = load_ocr_words(result_id)
+        new_terms = DOCUMENT_PIPELINE.run(
+            {"extracted_text": read_extracted_text(result_id), "ocr_words": ocr_words},
+            ["medical_terms"]
+        )["medical_terms"]
+        # Mapping downgrades codes of poorly read terms, so this goes first
+        if ocr_words is None:
+            _reattach_ocr_confidence(new_terms, old_terms)
+    else:
+        new_terms = old_terms
+
+    old_codes = list(iter_hcc_codes(result_id))
+    new_codes = DOCUMENT_PIPELINE.run({"medical_terms": new_terms}, ["hcc_codes"])["hcc_codes"]
+
+    diff = diff_hcc_codes(old_codes, new_codes)
+    updated = write and (old_codes != new_codes or new_terms != old_terms)
+    if updated:
+        update_hcc_codes(result_id, new_codes, new_terms if from_text else None)
+
+    return {
+        "result_id": result_id,
+        "document_name": metadata["document_name"],
+        "patient_id": metadata.get("patient_id"),
+        "added": diff["added"],
+        "removed": diff["removed"],
+        "updated": updated,
+    }
+
+
+def _remap_worker(args):
+    result_id, from_text, write = args
+    try:
+        return remap_result(result_id, from_text=from_text, write=write)
+    except Exception as e:
+        logger.error(f"Error re-mapping result {result_id}: {str(e)}")
+        return {"result_id": result_id, "error": str(e)}
+
+
+def remap_results(result_ids, from_text=False, write=True, workers=REMAP_WORKERS):
+    """
+    Re-map many stored results in parallel
+
+    Args:
+        result_ids: Iterable of result ids to re-map
+        from_text: Re-extract terms from the stored OCR text first
+        write: Store the new HCC codes
+        workers: Number of worker processes
+
+    Returns:
+        Generator of per-document diffs, in the order of result_ids. The
+        profiles of patients with updated results are rebuilt once all
+        results are re-mapped. It raises before re-mapping anything if
+        hcc_codes.json is missing or not valid JSON.
+    """
+    load_hcc_codes(strict=True)
+    tasks = ((result_id, from_text, write) for result_id in result_ids)
+    patient_ids = set()
+
+    # Mapping is pure-Python and CPU bound, so it is spread over processes
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    try:
+        if executor:
+            diffs = executor.map(_remap_worker, tasks, chunksize=REMAP_CHUNK_SIZE)
+        else:
+            diffs = map(_remap_worker, tasks)
+        for diff in diffs:
+            if diff.get("updated") and diff["patient_id"]:
+                patient_ids.add(diff["patient_id"])
+            yield diff
+    finally:
+        if executor:
+            executor.shutdown()
+
+    for patient_id in sorted(patient_ids):
+        try:
+            rebuild_patient_profile(patient_id)
+        except Exception as e:
+            logger.error(f"Error rebuilding the profile of patient {patient_id}: {str(e)}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Re-map stored results against the current hcc_codes.json without re-running OCR"
+    )
+    parser.add_argument("result_ids", nargs="*", help="Result ids to re-map (default: all stored results)")
+    parser.add_argument("--from-text", action="store_true", help="Re-extract medical terms from the stored OCR text")
+    parser.add_argument("--dry-run", action="store_true", help="Report the diff without storing the new codes")
+    parser.add_argument("--workers", type=int, default=REMAP_WORKERS, help="Number of worker processes")
+    parser.add_argument("--output", help="Write the NDJSON diff to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    result_ids = args.result_ids or list_result_ids()
+    output = open(args.output, 'w', encoding='utf-8') if args.output else sys.stdout
+
+    changed = processed = failed = 0
+    try:
+        for diff in remap_results(result_ids, args.from_text, not args.dry_run, args.workers):
+            processed += 1
+            if "error" in diff:
+                failed += 1
+            elif diff["added"] or diff["removed"]:
+                changed += 1
+            else:
+                continue
+            output.write(json.dumps(diff) + "\n")
+    except (OSError, ValueError) as e:
+        logger.error(f"Remap aborted: {str(e)}")
+        return 1
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+    logger.info(f"Re-mapped {processed} results: {changed} changed, {failed} failed")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
@@ -0,0 +1,117 @@
+import os
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Per-document resource limits. Anything above them is downsampled or
+# truncated and reported as a warning on the result, rather than failing.
+
+# Largest page bitmap handed to OpenCV/Tesseract (~8.5x11 in at 600 DPI)
+MAX_PAGE_PIXELS = int(os.environ.get("MAX_PAGE_PIXELS", 34_000_000))
+
+# Largest image decoded at full size. JPEGs are decoded already reduced, but
+# other formats (PNG, TIFF, ...) are not, so bigger ones are rejected
+# rather than expanded in memory.
+MAX_DECODE_PIXELS = int(os.environ.get("MAX_DECODE_PIXELS", 2 * MAX_PAGE_PIXELS))
+
+# Resolution PDFs are rendered at, unless the page is too large for MAX_PAGE_PIXELS
+MAX_RENDER_DPI = int(os.environ.get("MAX_RENDER_DPI", 300))
+
+# Longest OCR text passed to term extraction
+MAX_TEXT_LENGTH = int(os.environ.get("MAX_TEXT_LENGTH", 500_000))
+
+# Longest piece of text spaCy parses at once. Its memory grows with the
+# length of the document it is given, so long texts are parsed in pieces.
+SPACY_CHUNK_LENGTH = int(os.environ.get("SPACY_CHUNK_LENGTH", 20_000))
+
+# Wall-clock budget per stage, in seconds
+STAGE_TIMEOUTS = {
+    "ocr": float(os.environ.get("OCR_TIMEOUT", 120)),
+    "extraction": float(os.environ.get("EXTRACTION_TIMEOUT", 30)),
+}
+
+
+class Deadline:
+    """Wall-clock budget for one stage of processing a document"""
+
+    def __init__(self, stage, seconds=None):
+        self.stage = stage
+        self.seconds = STAGE_TIMEOUTS[stage] if seconds is None else seconds
+        self.expires_at = time.monotonic() + self.seconds
+
+    def remaining(self):
+        return max(self.expires_at - time.monotonic(), 0.0)
+
+    def expired(self):
+        return time.monotonic() >= self.expires_at
+
+
+def warn(warnings, message):
+    """
+    Record a degradation warning for the current document
+
+    Args:
+        warnings: List collecting the document's warnings, or None
+        message: Human-readable description of what was degraded
+    """
+    logger.warning(message)
+    if warnings is not None:
+        warnings.append(message)
+
+
+def pdf_render_dpi(page_width_points, page_height_points, warnings=None):
+    """
+    Pick the resolution to render a PDF page at
+
+    Args:
+        page_width_points: Page width in PDF points (1/72 in)
+        page_height_points: Page height in PDF points
+        warnings: Optional list collecting degradation warnings
+
+    Returns:
+        DPI that keeps the rendered page within MAX_PAGE_PIXELS
+    """
+    width_in = page_width_points / 72
+    height_in = page_height_points / 72
+    area_in = max(width_in * height_in, 1e-6)
+
+    dpi = min(MAX_RENDER_DPI, int((MAX_PAGE_PIXELS / area_in) ** 0.5))
+    dpi = max(dpi, 1)
+    if dpi < MAX_RENDER_DPI:
+        warn(warnings, f"Large PDF page ({width_in:.1f} x {height_in:.1f} in) rendered at {dpi} DPI instead of {MAX_RENDER_DPI}")
+    return dpi
+
+
+def image_reduction_factor(width, height):
+    """
+    Pick the power-of-two reduction to decode an image with
+
+    Args:
+        width: Image width in pixels
+        height: Image height in pixels
+
+    Returns:
+        1, 2, 4 or 8
+    """
+    for factor in (1, 2, 4):
+        if (width // factor) * (height // factor) <= MAX_PAGE_PIXELS:
+            return factor
+    return 8
+
+
+def limit_text(text, warnings=None):
+    """
+    Truncate text that is longer than MAX_TEXT_LENGTH
+
+    Args:
+        text: Document text
+        warnings: Optional list collecting degradation warnings
+
+    Returns:
+        The text, truncated if needed
+    """
+    if len(text) <= MAX_TEXT_LENGTH:
+        return text
+    warn(warnings, f"Text truncated from {len(text)} to {MAX_TEXT_LENGTH} characters before term extraction")
+    return text[:MAX_TEXT_LENGTH]
@@ -0,0 +1,565 @@
+import fcntl
+import json
+import os
+import re
+import shutil
+import tempfile
+import logging
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# Server-side storage for processing results. Each result lives in its own
+# directory so large term lists can be streamed line by line instead of
+# being loaded (or stuffed into the session cookie) in one piece.
+RESULTS_FOLDER = Path(os.environ.get(
+    "RESULTS_FOLDER", Path(tempfile.gettempdir()) / "medical_results"
+))
+
+METADATA_FILE = "metadata.json"
+TEXT_FILE = "extracted_text.txt"
+TERMS_FILE = "medical_terms.ndjson"
+CODES_FILE = "hcc_codes.ndjson"
+OCR_WORDS_FILE = "ocr_words.ndjson"
+PROFILE_FILE = "profile.json"
+
+RESULT_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+# Patient ids come from the intake system, so they are only restricted to
+# characters that are safe in a file name
+PATIENT_ID_PATTERN = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_.-]{0,63}$")
+
+# Paging of stored results. Cursors are byte offsets into the stored files,
+# so fetching a page costs the same wherever it is in the document.
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+TEXT_PAGE_BYTES = 64 * 1024
+
+# Lines a filtered page may scan before it is returned short, so a rare
+# filter value never makes a single request read the whole file
+MAX_SCAN_LINES = 5000
+
+# Terms and codes kept in the summary for the results overview
+SUMMARY_PREVIEW_SIZE = 5
+
+
+def _result_dir(result_id):
+    """
+    Resolve the storage directory for a result id
+
+    Args:
+        result_id: Hex result identifier
+
+    Returns:
+        Path of the result directory
+    """
+    if not result_id or not RESULT_ID_PATTERN.match(result_id):
+        raise ValueError(f"Invalid result id: {result_id!r}")
+    return RESULTS_FOLDER / result_id
+
+
+def _write_ndjson(path, records):
+    with open(path, 'w', encoding='utf-8') as f:
+        for record in records:
+            f.write(json.dumps(record))
+            f.write("\n")
+
+
+def _read_ndjson(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def summarize_terms(medical_terms):
+    """
+    Summarize extracted medical terms for the results overview
+
+    Args:
+        medical_terms: Iterable of extracted medical terms
+
+    Returns:
+        Dictionary with term counts per category and the first terms found
+    """
+    categories = {}
+    key_terms = []
+    for term_data in medical_terms:
+        categories[term_data["category"]] = categories.get(term_data["category"], 0) + 1
+        if len(key_terms) < SUMMARY_PREVIEW_SIZE:
+            key_terms.append({"term": term_data["term"], "category": term_data["category"]})
+    return {"categories": categories, "key_terms": key_terms}
+
+
+def summarize_codes(hcc_codes):
+    """
+    Summarize mapped HCC codes for the results overview
+
+    Args:
+        hcc_codes: Iterable of mapped HCC codes
+
+    Returns:
+        Dictionary with code counts per confidence and per HCC code, and the
+        first high-confidence codes
+    """
+    confidences = {"high": 0, "medium": 0, "low": 0}
+    codes = {}
+    primary_codes = []
+    for code in hcc_codes:
+        confidences[code["confidence"]] = confidences.get(code["confidence"], 0) + 1
+        codes[code["hcc_code"]] = codes.get(code["hcc_code"], 0) + 1
+        if code["confidence"] == "high" and len(primary_codes) < SUMMARY_PREVIEW_SIZE:
+            primary_codes.append({"term": code["term"], "hcc_code": code["hcc_code"]})
+    return {"confidences": confidences, "hcc_codes": codes, "primary_codes": primary_codes}
+
+
+def save_results(original_filename, extracted_text, medical_terms, hcc_codes, result_id=None, warnings=None, profile=None, patient_id=None, ocr_words=None):
+    """
+    Persist processing results on the server
+
+    Args:
+        original_filename: Name of the uploaded document
+        extracted_text: OCR text of the document
+        medical_terms: List of extracted medical terms
+        hcc_codes: List of mapped HCC codes
+        result_id: Optional id to store the results under
+        warnings: Optional list of processing warnings for the document
+        profile: Optional timing profile of a slow document, stored as
+            profile.json next to the results
+        patient_id: Optional id of the patient the document belongs to
+        ocr_words: Optional OCR words with character offsets and confidences,
+            kept so terms re-extracted from the text keep their OCR confidence
+
+    Returns:
+        The result id
+    """
+    result_id = result_id or uuid.uuid4().hex
+    target_dir = _result_dir(result_id)
+    RESULTS_FOLDER.mkdir(parents=True, exist_ok=True)
+
+    # Write into a scratch directory first so readers never see a partial result
+    staging_dir = Path(tempfile.mkdtemp(prefix=f".{result_id}-", dir=RESULTS_FOLDER))
+    try:
+        with open(staging_dir / TEXT_FILE, 'w', encoding='utf-8') as f:
+            f.write(extracted_text)
+        _write_ndjson(staging_dir / TERMS_FILE, medical_terms)
+        _write_ndjson(staging_dir / CODES_FILE, hcc_codes)
+        if ocr_words is not None:
+            _write_ndjson(staging_dir / OCR_WORDS_FILE, ocr_words)
+
+        metadata = {
+            "result_id": result_id,
+            "document_name": original_filename,
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "term_count": len(medical_terms),
+            "hcc_code_count": len(hcc_codes),
+            "warnings": warnings or [],
+            "summary": {**summarize_terms(medical_terms), **summarize_codes(hcc_codes)},
+        }
+        if patient_id:
+            metadata["patient_id"] = patient_id
+        with open(staging_dir / METADATA_FILE, 'w', encoding='utf-8') as f:
+            json.dump(metadata, f)
+
+        if profile:
+            with open(staging_dir / PROFILE_FILE, 'w', encoding='utf-8') as f:
+                json.dump(profile, f, indent=2)
+
+        if target_dir.exists():
+            shutil.rmtree(target_dir)
+        os.replace(staging_dir, target_dir)
+    except Exception:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        raise
+
+    logger.debug(f"Stored results {result_id} at {target_dir}")
+    return result_id
+
+
+def result_exists(result_id):
+    try:
+        return (_result_dir(result_id) / METADATA_FILE).exists()
+    except ValueError:
+        return False
+
+
+def load_metadata(result_id):
+    """
+    Load the metadata of a stored result
+
+    Args:
+        result_id: Hex result identifier
+
+    Returns:
+        Metadata dictionary, or None if the result does not exist
+    """
+    try:
+        with open(_result_dir(result_id) / METADATA_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (ValueError, FileNotFoundError):
+        return None
+
+
+def read_extracted_text(result_id):
+    with open(_result_dir(result_id) / TEXT_FILE, 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+def iter_medical_terms(result_id):
+    """Yield the stored medical terms of a result one at a time"""
+    return _read_ndjson(_result_dir(result_id) / TERMS_FILE)
+
+
+def iter_hcc_codes(result_id):
+    """Yield the stored HCC codes of a result one at a time"""
+    return _read_ndjson(_result_dir(result_id) / CODES_FILE)
+
+
+def load_ocr_words(result_id):
+    """
+    Load the stored OCR words of a result
+
+    Args:
+        result_id: Hex result identifier
+
+    Returns:
+        List of OCR words with character offsets and confidences, or None for
+        results stored without them
+    """
+    try:
+        return list(_read_ndjson(_result_dir(result_id) / OCR_WORDS_FILE))
+    except FileNotFoundError:
+        return None
+
+
+def list_result_ids():
+    """Yield the ids of all stored results"""
+    if not RESULTS_FOLDER.exists():
+        return
+    with os.scandir(RESULTS_FOLDER) as entries:
+        for entry in entries:
+            if entry.is_dir() and RESULT_ID_PATTERN.match(entry.name):
+                yield entry.name
+
+
+def update_hcc_codes(result_id, hcc_codes, medical_terms=None):
+    """
+    Replace the stored HCC codes of a result
+
+    Each file is replaced atomically, and the metadata last, so its counts
+    and summary never describe files that are not there yet.
+
+    Args:
+        result_id: Hex result identifier
+        hcc_codes: New list of mapped HCC codes
+        medical_terms: Optional new list of medical terms the codes were
+            mapped from, stored in place of the old terms
+    """
+    result_dir = _result_dir(result_id)
+    metadata = load_metadata(result_id)
+    if metadata is None:
+        raise ValueError(f"Unknown result id: {result_id}")
+
+    # Stage every file before replacing any, so a failed write changes nothing
+    staged = []
+    try:
+        if medical_terms is not None:
+            staging_path = result_dir / f".{TERMS_FILE}.tmp"
+            staged.append((staging_path, result_dir / TERMS_FILE))
+            _write_ndjson(staging_path, medical_terms)
+
+        staging_path = result_dir / f".{CODES_FILE}.tmp"
+        staged.append((staging_path, result_dir / CODES_FILE))
+        _write_ndjson(staging_path, hcc_codes)
+
+        metadata["hcc_code_count"] = len(hcc_codes)
+        if medical_terms is not None:
+            metadata["term_count"] = len(medical_terms)
+        if "summary" in metadata:
+            if medical_terms is not None:
+                metadata["summary"].update(summarize_terms(medical_terms))
+            metadata["summary"].update(summarize_codes(hcc_codes))
+        metadata["remapped_at"] = datetime.now(timezone.utc).isoformat()
+        staging_path = result_dir / f".{METADATA_FILE}.tmp"
+        staged.append((staging_path, result_dir / METADATA_FILE))
+        with open(staging_path, 'w', encoding='utf-8') as f:
+            json.dump(metadata, f)
+    except Exception:
+        for staging_path, _ in staged:
+            staging_path.unlink(missing_ok=True)
+        raise
+
+    for staging_path, target_path in staged:
+        os.replace(staging_path, target_path)
+
+
+def load_summary(result_id):
+    """
+    Load the summary counts of a stored result
+
+    Results stored before summaries were kept are summarized from their
+    files on the fly.
+
+    Args:
+        result_id: Hex result identifier
+
+    Returns:
+        Summary dictionary, or None if the result does not exist
+    """
+    metadata = load_metadata(result_id)
+    if metadata is None:
+        return None
+    if "summary" in metadata:
+        return metadata["summary"]
+    return {**summarize_terms(iter_medical_terms(result_id)), **summarize_codes(iter_hcc_codes(result_id))}
+
+
+def _seek_cursor(f, cursor):
+    # A cursor must point at the start of a line inside the file
+    size = f.seek(0, os.SEEK_END)
+    if cursor < 0 or cursor > size:
+        raise ValueError(f"Invalid cursor: {cursor}")
+    if cursor > 0:
+        f.seek(cursor - 1)
+        if f.read(1) != b"\n":
+            raise ValueError(f"Invalid cursor: {cursor}")
+    f.seek(cursor)
+
+
+def _read_ndjson_page(path, cursor, limit, match):
+    items = []
+    scanned = 0
+    with open(path, 'rb') as f:
+        _seek_cursor(f, cursor)
+        while len(items) < limit and scanned < MAX_SCAN_LINES:
+            line = f.readline()
+            if not line:
+                return items, None
+            scanned += 1
+            if line.strip():
+                record = json.loads(line)
+                if match(record):
+                    items.append(record)
+
+        next_cursor = f.tell()
+        if not f.read(1):
+            next_cursor = None
+    return items, next_cursor
+
+
+def _page_limit(limit):
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def read_terms_page(result_id, cursor=0, limit=PAGE_SIZE, categories=None):
+    """
+    Read one page of the stored medical terms of a result
+
+    Args:
+        result_id: Hex result identifier
+        cursor: Byte offset returned with the previous page, 0 for the first
+        limit: Maximum number of terms to return
+        categories: Optional categories to keep
+
+    Returns:
+        Tuple of (terms, next cursor or None after the last page). A filtered
+        page may hold fewer than limit terms before the end of the file.
+    """
+    categories = set(categories or ())
+    return _read_ndjson_page(
+        _result_dir(result_id) / TERMS_FILE, cursor, _page_limit(limit),
+        lambda term_data: not categories or term_data["category"] in categories
+    )
+
+
+def read_codes_page(result_id, cursor=0, limit=PAGE_SIZE, confidences=None, hcc_codes=None):
+    """
+    Read one page of the stored HCC codes of a result
+
+    Args:
+        result_id: Hex result identifier
+        cursor: Byte offset returned with the previous page, 0 for the first
+        limit: Maximum number of codes to return
+        confidences: Optional confidence levels to keep
+        hcc_codes: Optional HCC codes to keep
+
+    Returns:
+        Tuple of (codes, next cursor or None after the last page). A filtered
+        page may hold fewer than limit codes before the end of the file.
+    """
+    confidences = set(confidences or ())
+    hcc_codes = set(hcc_codes or ())
+    return _read_ndjson_page(
+        _result_dir(result_id) / CODES_FILE, cursor, _page_limit(limit),
+        lambda code: (not confidences or code["confidence"] in confidences)
+        and (not hcc_codes or code["hcc_code"] in hcc_codes)
+    )
+
+
+def read_text_page(result_id, cursor=0, size=TEXT_PAGE_BYTES):
+    """
+    Read one chunk of the stored OCR text of a result
+
+    Chunks end at a line break where one is near the end of the chunk, and
+    never split a UTF-8 character.
+
+    Args:
+        result_id: Hex result identifier
+        cursor: Byte offset returned with the previous chunk, 0 for the first
+        size: Approximate chunk size in bytes
+
+    Returns:
+        Tuple of (text, next cursor or None after the last chunk)
+    """
+    with open(_result_dir(result_id) / TEXT_FILE, 'rb') as f:
+        end = f.seek(0, os.SEEK_END)
+        if cursor < 0 or cursor > end:
+            raise ValueError(f"Invalid cursor: {cursor}")
+        f.seek(cursor)
+        chunk = f.read(max(4, min(size, TEXT_PAGE_BYTES)))
+        if chunk and chunk[0] & 0xC0 == 0x80:
+            raise ValueError(f"Invalid cursor: {cursor}")
+
+        if cursor + len(chunk) < end:
+            line_end = chunk.rfind(b"\n") + 1
+            if line_end > len(chunk) // 2:
+                chunk = chunk[:line_end]
+            else:
+                # Leave a character cut off by the chunk size to the next chunk
+                start = len(chunk) - 1
+                while start > 0 and chunk[start] & 0xC0 == 0x80:
+                    start -= 1
+                lead = chunk[start]
+                length = 1 if lead < 0x80 else 2 if lead < 0xE0 else 3 if lead < 0xF0 else 4
+                if len(chunk) - start < length:
+                    chunk = chunk[:start]
+
+    next_cursor = cursor + len(chunk)
+    return chunk.decode('utf-8'), (next_cursor if next_cursor < end else None)
+
+
+def load_results(result_id):
+    """
+    Load a complete stored result into memory
+
+    Args:
+        result_id: Hex result identifier
+
+    Returns:
+        Dictionary with document name, text, terms and codes, or None if missing
+    """
+    metadata = load_metadata(result_id)
+    if metadata is None:
+        return None
+
+    return {
+        "result_id": result_id,
+        "document_name": metadata["document_name"],
+        "warnings": metadata.get("warnings", []),
+        "extracted_text": read_extracted_text(result_id),
+        "medical_terms": list(iter_medical_terms(result_id)),
+        "hcc_codes": list(iter_hcc_codes(result_id)),
+    }
+
+
+def _batch_path(batch_id):
+    if not batch_id or not RESULT_ID_PATTERN.match(batch_id):
+        raise ValueError(f"Invalid batch id: {batch_id!r}")
+    return RESULTS_FOLDER / "batches" / f"{batch_id}.json"
+
+
+def save_batch(batch):
+    """
+    Persist the manifest of a batch upload
+
+    Args:
+        batch: Batch dictionary, including its batch_id
+    """
+    path = _batch_path(batch["batch_id"])
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    # Replace atomically so status polling never reads a half-written file
+    fd, staging_path = tempfile.mkstemp(prefix=".batch-", dir=path.parent)
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        json.dump(batch, f)
+    os.replace(staging_path, path)
+
+
+def load_batch(batch_id):
+    """
+    Load the manifest of a batch upload
+
+    Args:
+        batch_id: Hex batch identifier
+
+    Returns:
+        Batch dictionary, or None if the batch does not exist
+    """
+    try:
+        with open(_batch_path(batch_id), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (ValueError, FileNotFoundError):
+        return None
+
+
+def _patient_path(patient_id):
+    if not patient_id or not PATIENT_ID_PATTERN.match(patient_id):
+        raise ValueError(f"Invalid patient id: {patient_id!r}")
+    return RESULTS_FOLDER / "patients" / f"{patient_id}.json"
+
+
+@contextmanager
+def lock_patient_profile(patient_id):
+    """
+    Hold an exclusive lock on a patient's profile for a read-modify-write
+
+    The lock is a file lock next to the profile, so web workers, batch
+    workers and remap processes all serialize on it.
+
+    Args:
+        patient_id: Patient identifier
+    """
+    path = _patient_path(patient_id).with_suffix(".lock")
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def save_patient_profile(profile):
+    """
+    Persist the aggregated HCC profile of a patient
+
+    Args:
+        profile: Profile dictionary, including its patient_id
+    """
+    path = _patient_path(profile["patient_id"])
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    fd, staging_path = tempfile.mkstemp(prefix=".patient-", dir=path.parent)
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        json.dump(profile, f)
+    os.replace(staging_path, path)
+
+
+def load_patient_profile(patient_id):
+    """
+    Load the aggregated HCC profile of a patient
+
+    Args:
+        patient_id: Patient identifier
+
+    Returns:
+        Profile dictionary, or None if no documents were added for the patient
+    """
+    try:
+        with open(_patient_path(patient_id), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (ValueError, FileNotFoundError):
+        return None
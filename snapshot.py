@@ -0,0 +1,276 @@
+import os
+import sys
+import json
+import stat
+import time
+import hashlib
+import logging
+import argparse
+import subprocess
+import tempfile
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# Prepared extraction state, built ahead of time with "python snapshot.py build"
+# so a new worker does not rebuild the indexes on its first request. It lives
+# in the instance folder, which the web app does not serve, and is plain
+# JSON: a planted or tampered file can at worst feed wrong indexes, not run
+# code.
+SNAPSHOT_FILE = Path(os.environ.get(
+    "EXTRACTION_SNAPSHOT", Path(__file__).parent / "instance" / "extraction_snapshot.json"
+))
+
+# File layout: a header line with the format and the SHA-256 of the sources,
+# so a stale snapshot is rejected without parsing it, then the state line
+SNAPSHOT_FORMAT = "extraction-snapshot"
+SNAPSHOT_VERSION = 2
+
+
+def source_hash():
+    """
+    Hash everything the snapshot is derived from
+
+    Returns:
+        SHA-256 digest of the HCC table, the pattern catalog and the fuzzy
+        matching settings
+    """
+    from hcc_mapper import HCC_CODES_FILE
+    from nlp_processor import MEDICAL_TERMS_PATTERNS, PATTERN_CATEGORIES
+    from fuzzy_matcher import FUZZY_MAX_EDIT_DISTANCE, FUZZY_MIN_LENGTH, PREFIX_LENGTH
+
+    digest = hashlib.sha256()
+    try:
+        with open(HCC_CODES_FILE, 'rb') as f:
+            digest.update(f.read())
+    except OSError:
+        digest.update(b"fallback HCC codes")
+    digest.update(json.dumps([
+        MEDICAL_TERMS_PATTERNS,
+        [[start, end, category] for (start, end), category in PATTERN_CATEGORIES.items()],
+        FUZZY_MAX_EDIT_DISTANCE,
+        FUZZY_MIN_LENGTH,
+        PREFIX_LENGTH,
+    ], sort_keys=True).encode('utf-8'))
+    return digest.digest()
+
+
+def build_snapshot(path=SNAPSHOT_FILE):
+    """
+    Build the extraction state and write it to a snapshot file
+
+    LAB_TEST_MAPPINGS is not included: it is a literal table with nothing
+    derived from it, so importing hcc_mapper is all it costs.
+
+    Args:
+        path: File to write
+
+    Returns:
+        Size of the written file in bytes
+    """
+    from hcc_mapper import load_hcc_codes, build_hcc_word_index
+    from nlp_processor import MEDICAL_TERMS_PATTERNS, build_fuzzy_index, _pattern_category
+
+    hcc_codes = load_hcc_codes()
+    state = {
+        "hcc_codes": hcc_codes,
+        "hcc_word_index": build_hcc_word_index(hcc_codes),
+        "patterns": [
+            (pattern, _pattern_category(pattern_idx))
+            for pattern_idx, pattern in enumerate(MEDICAL_TERMS_PATTERNS)
+        ],
+        "fuzzy_index": build_fuzzy_index(hcc_codes).to_dict(),
+    }
+    header = json.dumps({
+        "format": SNAPSHOT_FORMAT, "version": SNAPSHOT_VERSION, "source_sha256": source_hash().hex()
+    }).encode('utf-8') + b"\n"
+    payload = json.dumps(state).encode('utf-8')
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, staging_path = tempfile.mkstemp(prefix=f".{path.name}-", dir=path.parent)
+    try:
+        os.fchmod(fd, 0o644)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(header)
+            f.write(payload)
+        os.replace(staging_path, path)
+    except Exception:
+        os.unlink(staging_path)
+        raise
+
+    logger.info(f"Wrote extraction snapshot to {path} ({len(header) + len(payload)} bytes)")
+    return len(header) + len(payload)
+
+
+def _trusted(path):
+    """Check that a snapshot file was written by this user or root, and only they can change it"""
+    file_stat = os.stat(path)
+    if file_stat.st_uid not in (os.geteuid(), 0):
+        logger.warning(f"Ignoring extraction snapshot {path}: owned by another user")
+        return False
+    if stat.S_IMODE(file_stat.st_mode) & 0o022:
+        logger.warning(f"Ignoring extraction snapshot {path}: writable by other users")
+        return False
+    return True
+
+
+def load_snapshot(path=SNAPSHOT_FILE):
+    """
+    Load a snapshot file, if it exists and matches the current sources
+
+    Args:
+        path: Snapshot file
+
+    Returns:
+        The snapshot state dictionary, or None if the snapshot is missing,
+        untrusted, from another format version, or stale
+    """
+    try:
+        if not _trusted(path):
+            return None
+        with open(path, 'rb') as f:
+            try:
+                header = json.loads(f.readline())
+            except ValueError:
+                header = None
+            if not isinstance(header, dict) or header.get("format") != SNAPSHOT_FORMAT or header.get("version") != SNAPSHOT_VERSION:
+                logger.warning(f"Ignoring extraction snapshot {path}: unsupported format")
+                return None
+            if header.get("source_sha256") != source_hash().hex():
+                logger.warning(f"Ignoring stale extraction snapshot {path}, rebuild it with 'python snapshot.py build'")
+                return None
+            return json.load(f)
+    except FileNotFoundError:
+        logger.debug(f"No extraction snapshot at {path}")
+        return None
+    except Exception as e:
+        logger.error(f"Error loading extraction snapshot: {str(e)}")
+        return None
+
+
+def warm_start(path=SNAPSHOT_FILE):
+    """
+    Prepare the extraction state for a new worker
+
+    Installs the indexes from the snapshot when it is current, and compiles
+    the pattern catalog. Compiled regexes cannot be serialized, so they are
+    always compiled here rather than stored.
+
+    Args:
+        path: Snapshot file
+
+    Returns:
+        True if the snapshot was used
+    """
+    from hcc_mapper import prime_hcc_cache
+    from nlp_processor import MEDICAL_TERMS_PATTERNS, prime_fuzzy_index
+    from fuzzy_matcher import SymSpellIndex
+    from regex_engine import compile_pattern
+
+    state = load_snapshot(path)
+    if state is not None:
+        logger.info(f"Loaded extraction snapshot {path}")
+        prime_hcc_cache(state["hcc_codes"], state["hcc_word_index"])
+        prime_fuzzy_index(state["hcc_codes"], SymSpellIndex.from_dict(state["fuzzy_index"]))
+        patterns = [pattern for pattern, _ in state["patterns"]]
+    else:
+        patterns = MEDICAL_TERMS_PATTERNS
+
+    for pattern in patterns:
+        compile_pattern(pattern)
+    return state is not None
+
+
+# Short document used to time the first extraction
+_BENCHMARK_TEXT = (
+    "Patient has a history of type 2 diabetes and hypertension. "
+    "Denies chest pain. Glucose: 182 mg/dL (high). Creatinine 1.9 mg/dL. "
+    "Medications: metformin, lisinopril, atorvastatin. Date of service: 03/14/2023. "
+    "Assessment: chronic kidney disease stage 3, diabeles mellitus."
+)
+
+
+def _measure_startup():
+    """Time a cold start of the web app in this (fresh) process"""
+    timings = {}
+    started = time.perf_counter()
+
+    # Importing the app runs warm_start
+    from app import app
+    timings["import_app"] = time.perf_counter() - started
+
+    client = app.test_client()
+    checkpoint = time.perf_counter()
+    client.get('/')
+    timings["first_request"] = time.perf_counter() - checkpoint
+
+    from nlp_processor import extract_medical_terms
+    from hcc_mapper import map_to_hcc_codes
+    checkpoint = time.perf_counter()
+    map_to_hcc_codes(extract_medical_terms(_BENCHMARK_TEXT))
+    timings["first_extraction"] = time.perf_counter() - checkpoint
+
+    timings["total"] = time.perf_counter() - started
+    return timings
+
+
+def benchmark(runs=3, path=SNAPSHOT_FILE):
+    """
+    Measure worker startup with and without the snapshot
+
+    Each run is a fresh interpreter, so module imports and model loading
+    are cold.
+
+    Args:
+        runs: Number of runs per configuration
+        path: Snapshot file to benchmark
+
+    Returns:
+        List of dictionaries with the timings of each run, in seconds
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as scratch_dir:
+        configurations = [("without snapshot", Path(scratch_dir) / "missing.json"), ("with snapshot", Path(path))]
+        for name, snapshot_path in configurations:
+            environment = dict(os.environ, EXTRACTION_SNAPSHOT=str(snapshot_path))
+            for _ in range(runs):
+                completed = subprocess.run(
+                    [sys.executable, __file__, "_measure"],
+                    env=environment, capture_output=True, text=True, check=True
+                )
+                timings = json.loads(completed.stdout.strip().splitlines()[-1])
+                results.append({"configuration": name, "seconds": timings})
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build the extraction snapshot and measure worker startup")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser("build", help="Write the extraction snapshot")
+    build_parser.add_argument("--output", default=str(SNAPSHOT_FILE), help="Snapshot file to write")
+
+    benchmark_parser = subparsers.add_parser("benchmark", help="Time cold worker startup with and without the snapshot")
+    benchmark_parser.add_argument("--runs", type=int, default=3, help="Runs per configuration")
+    benchmark_parser.add_argument("--snapshot", default=str(SNAPSHOT_FILE), help="Snapshot file to benchmark")
+
+    subparsers.add_parser("_measure")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "build":
+        build_snapshot(args.output)
+    elif args.command == "benchmark":
+        if not Path(args.snapshot).exists():
+            build_snapshot(args.snapshot)
+        for result in benchmark(args.runs, args.snapshot):
+            print(json.dumps(result))
+    else:
+        print(json.dumps(_measure_startup()))
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main())
@@ -6,9 +6,6 @@ document.addEventListener('DOMContentLoaded', function() {
     const uploadForm = document.querySelector('#upload-form');
     const spinner = document.querySelector('.processing-spinner');
     
-    // Export functionality
-    const exportBtn = document.querySelector('#export-btn');
-    
     // Initialize the UI
     initializeUI();
     
@@ -63,9 +60,12 @@ document.addEventListener('DOMContentLoaded', function() {
         }
         
         // Export functionality
-        if (exportBtn) {
-            exportBtn.addEventListener('click', exportResults);
-        }
+        document.querySelectorAll('.export-option').forEach(option => {
+            option.addEventListener('click', exportResults);
+        });
+        
+        // Result lists are paged in from the API as they scroll into view
+        document.querySelectorAll('.lazy-list').forEach(initLazyList);
     }
     
     // Update file name display when a file is selected
@@ -84,42 +84,166 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     }
     
-    // Export results as JSON
-    function exportResults() {
-        fetch('/export', {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/x-www-form-urlencoded',
-            },
-            body: 'format=json'
-        })
-        .then(response => {
-            if (!response.ok) {
-                throw new Error('Export failed');
+    // Export results in the selected format
+    // The form is submitted directly so the browser streams the download to disk
+    function exportResults(e) {
+        const option = e.target.closest('.export-option');
+        const exportForm = document.querySelector('#export-form');
+        if (!option || !exportForm) {
+            return;
+        }
+        
+        exportForm.querySelector('input[name="format"]').value = option.dataset.format;
+        exportForm.submit();
+    }
+    
+    // Load a result list page by page whenever its end scrolls into view
+    function initLazyList(list) {
+        const rows = list.querySelector('.lazy-rows');
+        const sentinel = list.querySelector('.lazy-sentinel');
+        const empty = list.querySelector('.lazy-empty');
+        const filters = list.querySelector('.lazy-filters');
+        const render = {text: renderText, terms: renderTerm, codes: renderCode}[list.dataset.kind];
+        
+        // Lists inside their own scroll box are observed against that box
+        const root = list.classList.contains('text-area-container') ? list : null;
+        const margin = '400px';
+        let cursor = 0;
+        let loading = false;
+        let generation = 0;
+        
+        const observer = new IntersectionObserver(entries => {
+            if (entries.some(entry => entry.isIntersecting)) {
+                loadNextPage();
             }
-            return response.json();
-        })
-        .then(data => {
-            // Create a JSON file and trigger download
-            const jsonData = JSON.stringify(data, null, 2);
-            const blob = new Blob([jsonData], { type: 'application/json' });
-            const url = URL.createObjectURL(blob);
+        }, {root: root, rootMargin: margin});
+        observer.observe(sentinel);
+        
+        if (filters) {
+            filters.addEventListener('change', resetList);
+            filters.addEventListener('submit', e => e.preventDefault());
+        }
+        
+        function resetList() {
+            generation += 1;
+            cursor = 0;
+            loading = false;
+            rows.replaceChildren();
+            if (empty) {
+                empty.hidden = true;
+            }
+            loadNextPage();
+        }
+        
+        async function loadNextPage() {
+            if (loading || cursor === null) {
+                return;
+            }
+            loading = true;
+            const requested = generation;
             
-            const a = document.createElement('a');
-            a.href = url;
-            a.download = 'medical_document_analysis.json';
-            document.body.appendChild(a);
-            a.click();
+            const params = new URLSearchParams();
+            if (filters) {
+                new FormData(filters).forEach((value, name) => {
+                    if (value) {
+                        params.append(name, value);
+                    }
+                });
+            }
+            params.set('cursor', cursor);
             
-            // Clean up
-            setTimeout(() => {
-                document.body.removeChild(a);
-                URL.revokeObjectURL(url);
-            }, 100);
-        })
-        .catch(error => {
-            console.error('Error exporting results:', error);
-            alert('Failed to export results. Please try again.');
-        });
+            try {
+                const response = await fetch(`${list.dataset.url}?${params}`);
+                const page = await response.json();
+                if (requested !== generation) {
+                    return;
+                }
+                if (!response.ok) {
+                    throw new Error(page.error || response.statusText);
+                }
+                
+                if (list.dataset.kind === 'text') {
+                    render(page.text);
+                } else {
+                    page.items.forEach(render);
+                }
+                cursor = page.next_cursor;
+                if (empty) {
+                    empty.hidden = cursor !== null || rows.childElementCount > 0;
+                }
+            } catch (error) {
+                console.error('Error loading results:', error);
+                cursor = null;
+            } finally {
+                if (requested === generation) {
+                    loading = false;
+                }
+            }
+            
+            // The observer only fires on changes, so keep going while the end is still in view
+            if (requested === generation && cursor !== null && sentinelInView()) {
+                loadNextPage();
+            }
+        }
+        
+        function sentinelInView() {
+            // Lists in an inactive tab are not displayed
+            if (sentinel.offsetParent === null) {
+                return false;
+            }
+            const bottom = root ? root.getBoundingClientRect().bottom : window.innerHeight;
+            return sentinel.getBoundingClientRect().top <= bottom + parseInt(margin, 10);
+        }
+        
+        function renderText(text) {
+            rows.append(document.createTextNode(text));
+        }
+        
+        function renderTerm(term) {
+            const column = document.createElement('div');
+            column.className = 'col-md-6';
+            const card = appendElement(column, 'div', 'medical-term');
+            appendElement(card, 'h6', 'mb-1', term.term);
+            const details = appendElement(card, 'div');
+            appendElement(details, 'span', 'badge bg-secondary', term.category);
+            if (term.assertion !== undefined) {
+                details.append(' ');
+                appendElement(details, 'span', 'badge bg-warning text-dark', term.assertion);
+            }
+            details.append(' ');
+            appendElement(details, 'small', 'text-muted', `Source: ${term.source}`);
+            if (term.ocr_confidence !== undefined) {
+                appendElement(details, 'small', 'text-muted ms-2', `OCR confidence: ${Math.round(term.ocr_confidence)}%`);
+            }
+            rows.append(column);
+        }
+        
+        function renderCode(code) {
+            const badges = {
+                high: ['badge bg-success', 'High'],
+                medium: ['badge bg-warning text-dark', 'Medium'],
+                low: ['badge bg-danger', 'Low']
+            };
+            const row = document.createElement('tr');
+            appendElement(row, 'td', '', code.term);
+            appendElement(appendElement(row, 'td'), 'span', 'badge bg-primary', code.hcc_code);
+            appendElement(row, 'td', '', code.description);
+            const [badgeClass, label] = badges[code.confidence] || badges.low;
+            appendElement(appendElement(row, 'td'), 'span', badgeClass, label);
+            rows.append(row);
+        }
+        
+        // Text is always set as text content, never parsed as HTML
+        function appendElement(parent, tag, className, text) {
+            const element = document.createElement(tag);
+            if (className) {
+                element.className = className;
+            }
+            if (text !== undefined) {
+                element.textContent = text;
+            }
+            parent.append(element);
+            return element;
+        }
     }
 });